@@ -0,0 +1,159 @@
+"""
+Benchmarks the embodied-carbon and logistics-emissions calculation.
+
+Synthetic final orders (a mix of given weights, volume-only rows, percentage
+strings and "Insufficient Data") are run through compute_emissions and the
+r_embodied_carbon / r_logistics_emissions summaries, and through a plain
+per-row Python loop computing the same figures, which also checks the results.
+"from frame" times compute_emissions on orders already in a DataFrame, as when
+reporting from a database extract rather than a just-extracted document.
+
+    python OpenWebUI/benchmarks/bench_carbon.py [--sizes 1000,10000,50000] [--repeat 3]
+"""
+
+import argparse
+import math
+import random
+import statistics
+import time
+
+import pandas as pd
+
+from common import load_pipe_module
+
+SUPPLIERS = ["Carters", "PlaceMakers Ltd", "ITM", "Mitre 10", "Bunnings", "Firth Industries"]
+
+
+def synthetic_orders(wastex, count: int, rng: random.Random) -> list:
+    pairs = list(wastex.MATERIAL_PAIRS.items()) + [("Unknown Composite", "Other Waste")]
+    missing = wastex.INSUFFICIENT_DATA
+    orders = []
+    for i in range(count):
+        sub_material, material = rng.choice(pairs)
+        weighed = rng.random() < 0.4
+        orders.append(
+            wastex.FinalOrder.model_construct(
+                project_id=missing,
+                delivery_date=missing,
+                stage=missing,
+                trade_provider=rng.choice(SUPPLIERS + [missing]),
+                item_name=f"item {i}",
+                material=material,
+                sub_material=sub_material,
+                excess_percentage=rng.choice([10.0, "25.00%", missing]),
+                density=missing,
+                cubic_m3=round(rng.uniform(0.001, 2), 4) if rng.random() < 0.9 else missing,
+                weight_per_unit=missing,
+                total_material_weight=round(rng.uniform(1, 900), 2) if weighed else missing,
+                waste_weight=missing,
+                waste_value=missing,
+                unit_quantities=str(rng.randint(1, 100)),
+                unit_measure="ea",
+                price_per_unit=missing,
+                purchase_cost_total=missing,
+                estimated_removal_cost=missing,
+                estimated_destination=missing,
+                created_by_name=missing,
+                created_by_email=missing,
+            )
+        )
+    return orders
+
+
+def per_row(wastex, orders, densities, factors, delivery_km, removal_km) -> list:
+    # The same figures, one order at a time
+    density_by_sub = dict(zip(densities["sub_material"], densities["density_kg_per_m3"]))
+    rows = []
+    for order in orders:
+        weight = wastex.parse_number(order.total_material_weight)
+        if weight is None:
+            volume = wastex.parse_number(order.cubic_m3)
+            density = density_by_sub.get(order.sub_material)
+            weight = volume * density if volume is not None and density is not None else None
+        excess = wastex.parse_number(order.excess_percentage)
+        waste = weight * excess / 100 if weight is not None and excess is not None else None
+        factor = factors.get(order.sub_material)
+        material_carbon = weight * factor if weight is not None and factor is not None else None
+        waste_carbon = waste * factor if waste is not None and factor is not None else None
+        freight = wastex.FREIGHT_KG_CO2E_PER_TKM
+        logistics = None
+        if weight is not None:
+            logistics = weight / 1000 * delivery_km * freight
+            logistics += waste / 1000 * removal_km * freight if waste is not None else 0.0
+        total = (
+            material_carbon + (waste_carbon or 0.0) + logistics
+            if material_carbon is not None
+            else None
+        )
+        rows.append((weight, waste, material_carbon, waste_carbon, logistics, total))
+    return rows
+
+
+def matches(frame, rows) -> bool:
+    columns = [
+        "total_material_weight_kg",
+        "waste_weight_kg",
+        "material_carbon",
+        "waste_carbon",
+        "logistics_carbon",
+        "total_embodied_carbon",
+    ]
+    for vectorized, expected in zip(frame[columns].itertuples(index=False), rows):
+        for x, y in zip(vectorized, expected):
+            if y is None:
+                if not math.isnan(x):
+                    return False
+            elif not math.isclose(x, y, rel_tol=1e-9, abs_tol=1e-9):
+                return False
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", default="1000,10000,50000")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    wastex = load_pipe_module()
+    densities = wastex.load_densities()
+    factors = wastex.load_carbon_factors()
+    delivery_km, removal_km = 30.0, 25.0
+    rng = random.Random(args.seed)
+
+    print(
+        f"{'orders':>8} {'vectorized ms':>14} {'orders/s':>10} {'from frame ms':>14} "
+        f"{'summaries ms':>13} "
+        f"{'per-row ms':>11} {'orders/s':>10} {'speedup':>8}  match"
+    )
+    for size in (int(value) for value in args.sizes.split(",")):
+        orders = synthetic_orders(wastex, size, rng)
+        frame = pd.DataFrame([order.model_dump() for order in orders])
+        vectorized, from_frame, summaries, looped = [], [], [], []
+        for _ in range(max(1, args.repeat)):
+            started = time.perf_counter()
+            emissions = wastex.compute_emissions(
+                orders, densities, factors, None, delivery_km, removal_km
+            )
+            vectorized.append(time.perf_counter() - started)
+            started = time.perf_counter()
+            wastex.compute_emissions(frame, densities, factors, None, delivery_km, removal_km)
+            from_frame.append(time.perf_counter() - started)
+            started = time.perf_counter()
+            wastex.summarize_embodied_carbon(emissions)
+            wastex.summarize_logistics_emissions(emissions)
+            summaries.append(time.perf_counter() - started)
+            started = time.perf_counter()
+            rows = per_row(wastex, orders, densities, factors, delivery_km, removal_km)
+            looped.append(time.perf_counter() - started)
+        fast, slow = statistics.median(vectorized), statistics.median(looped)
+        print(
+            f"{size:>8} {fast * 1000:>14.1f} {size / fast:>10.0f} "
+            f"{statistics.median(from_frame) * 1000:>14.1f} "
+            f"{statistics.median(summaries) * 1000:>13.1f} {slow * 1000:>11.1f} "
+            f"{size / slow:>10.0f} {slow / fast:>7.1f}x  {matches(emissions, rows)}"
+        )
+
+
+if __name__ == "__main__":
+    main()
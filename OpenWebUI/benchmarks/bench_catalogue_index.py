@@ -0,0 +1,251 @@
+"""
+Benchmarks the item catalogue index.
+
+A synthetic l_item_details catalogue is generated at each size: item names in
+the shapes suppliers use (brand, product, dimensions, stock code) for every
+sub-material, plus the item names of the materials table in golds.sql. Queries
+are those items as another docket might spell them (case, separators, units
+and codes changed, words swapped, a typo), so each query has one correct
+catalogue item. Reports:
+
+  build      embedding the catalogue and writing the index (first load)
+  load       reading the catalogue and memory-mapping the saved index
+  query      p50/p95 ms for one row, and ms/row for a 50 row batch
+  recall     recall@1 and @5 for the synthetic items and for the golds.sql
+             items; at CATALOGUE_MATCH_THRESHOLD, the share of queries
+             matched to the right item (coverage) and to a wrong one, and
+             how often a query for an item missing from the catalogue
+             matches something anyway (false matches)
+
+The same queries also go through difflib.get_close_matches over the
+normalized names, the fuzzy matching the classifier used before the index,
+on a sample of --difflib-queries.
+
+    python OpenWebUI/benchmarks/bench_catalogue_index.py [--sizes 1000,10000,50000]
+        [--queries 500] [--difflib-queries 50]
+"""
+
+import argparse
+import difflib
+import os
+import random
+import re
+import statistics
+import tempfile
+import time
+
+import pandas as pd
+
+from common import REPO_DIR, load_pipe_module, percentile
+
+BRANDS = ["GIB", "Carters", "PlaceMakers", "ITM", "Mitre 10", "Firth", "James Hardie", "Resene"]
+PRODUCT_WORDS = ["standard", "premium", "sheet", "length", "pack", "roll", "bag", "board", "panel"]
+# Sub-materials of the golds.sql items, for the catalogue's sub_material column
+GOLD_SUB_MATERIALS = {
+    "H1.2 - 100x45 - bracing & steel packing": "Treated",
+    "Freo Rebar HD10 6M Deformed 500E": "Steel",
+    "GIB BD 3000X1200X13MM STANDARD SH": "Plasterboard",
+    "T/Thene Orange 300MU 4000MM X 25M 100M2": "Polyethene",
+    "Hebel walls": "Concrete-based",
+}
+
+
+def gold_item_names() -> list:
+    """Item names from the materials table data in golds.sql."""
+    names, copying = [], False
+    with open(os.path.join(REPO_DIR, "golds.sql"), encoding="utf-8") as f:
+        for line in f:
+            if line.startswith("COPY public.materials "):
+                copying = True
+            elif copying and line.startswith("\\."):
+                break
+            elif copying:
+                name = line.rstrip("\n").split("\t")[3].strip()
+                if name not in names:
+                    names.append(name)
+    return names
+
+
+def synthetic_item(wastex, rng: random.Random):
+    """Returns (item name, sub-material)."""
+    sub_material = rng.choice(list(wastex.MATERIAL_PAIRS))
+    keywords = [
+        keyword
+        for keywords, name, _ in wastex.MATERIAL_KEYWORDS
+        if name == sub_material
+        for keyword in keywords
+    ]
+    dims = rng.choice(
+        [
+            f"{rng.choice([90, 100, 140, 190, 240])}X{rng.choice([35, 45, 50])} "
+            f"{rng.choice([2.4, 3.6, 4.8, 6.0]):.1f}M",
+            f"{rng.choice([2400, 2700, 3000, 3600])}X{rng.choice([600, 900, 1200])}X"
+            f"{rng.choice([6, 10, 13, 16])}MM",
+            f"{rng.choice([10, 12, 16, 20, 25])}MM X {rng.choice([3, 6, 10, 25])}M",
+        ]
+    )
+    code = rng.choice([f"SKU{rng.randint(100000, 999999)}", f"PA-{rng.randint(100, 999)}", ""])
+    name = f"{rng.choice(BRANDS)} {rng.choice(keywords)} {rng.choice(PRODUCT_WORDS)} {dims} {code}"
+    return " ".join(name.upper().split()), sub_material
+
+
+def swap_words(name: str, rng: random.Random) -> str:
+    words = name.split()
+    if len(words) > 2:
+        i = rng.randrange(len(words) - 1)
+        words[i], words[i + 1] = words[i + 1], words[i]
+    return " ".join(words)
+
+
+def typo(name: str, rng: random.Random) -> str:
+    words = name.split()
+    candidates = [i for i, word in enumerate(words) if word.isalpha() and len(word) > 4]
+    if candidates:
+        i = rng.choice(candidates)
+        pos = rng.randrange(1, len(words[i]) - 1)
+        words[i] = words[i][:pos] + words[i][pos + 1 :]
+    return " ".join(words)
+
+
+def perturb(name: str, rng: random.Random) -> str:
+    """name as a different docket might spell it."""
+    changes = [
+        lambda s: s.lower(),
+        lambda s: s.title(),
+        lambda s: re.sub(r"(?<=\d)\s*[xX]\s*(?=\d)", rng.choice([" x ", "*", "X"]), s),
+        lambda s: re.sub(r"(?i)(?<=\d)\s*mm\b", "", s),
+        lambda s: re.sub(r"\b(SKU\d+|PA-\d+)\b", "", s),
+        lambda s: f"{rng.randint(10000, 99999)} - {s}",
+        lambda s: swap_words(s, rng),
+        lambda s: typo(s, rng),
+    ]
+    for change in rng.sample(changes, rng.randint(2, 3)):
+        name = change(name)
+    return " ".join(name.split())
+
+
+def build_catalogue(wastex, size: int, golds: list, rng: random.Random):
+    """Returns (catalogue frame, names of items left out of it)."""
+    rows = [
+        (name, GOLD_SUB_MATERIALS.get(name), round(rng.uniform(0.5, 60), 2), 10.0)
+        for name in golds
+    ]
+    seen = {wastex.normalize_item_text(name) for name in golds}
+    held_out = []
+    while len(rows) < size or len(held_out) < 200:
+        name, sub_material = synthetic_item(wastex, rng)
+        key = wastex.normalize_item_text(name)
+        if key in seen:
+            continue
+        seen.add(key)
+        if len(held_out) < 200 and (rng.random() < 0.2 or len(rows) >= size):
+            held_out.append(name)
+        elif len(rows) < size:
+            rows.append(
+                (name, sub_material, round(rng.uniform(0.5, 60), 2), rng.choice([5.0, 10.0, 15.0]))
+            )
+    return pd.DataFrame(rows, columns=wastex.CATALOGUE_COLUMNS), held_out
+
+
+def recall(ranked: list, expected: list, k: int) -> float:
+    return sum(target in found[:k] for found, target in zip(ranked, expected)) / max(
+        1, len(expected)
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", default="1000,10000,50000")
+    parser.add_argument("--queries", type=int, default=500, help="synthetic item queries")
+    parser.add_argument("--difflib-queries", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    wastex = load_pipe_module()
+    threshold = wastex.Pipe.Valves().CATALOGUE_MATCH_THRESHOLD
+    golds = gold_item_names()
+    rng = random.Random(args.seed)
+    print(f"{len(golds)} golds.sql items; match threshold {threshold}")
+    print(
+        f"{'items':>7} {'build s':>8} {'load s':>7} {'MB':>6} {'1 row p50/p95 ms':>17} "
+        f"{'batch ms/row':>12}  {'method':<8} {'R@1':>5} {'R@5':>5} {'gold R@1':>8} "
+        f"{'covered':>7} {'wrong':>6} {'false':>6}"
+    )
+    for size in (int(value) for value in args.sizes.split(",")):
+        catalogue, held_out = build_catalogue(wastex, size, golds, rng)
+        workdir = tempfile.mkdtemp()
+        path = os.path.join(workdir, "l_item_details.csv")
+        catalogue.to_csv(path, index=False)
+        index_dir = os.path.join(workdir, "index")
+
+        started = time.perf_counter()
+        wastex.CatalogueIndex.load(path, index_dir)
+        build = time.perf_counter() - started
+        started = time.perf_counter()
+        index = wastex.CatalogueIndex.load(path, index_dir)
+        load = time.perf_counter() - started
+        megabytes = sum(
+            os.path.getsize(os.path.join(index_dir, name)) for name in os.listdir(index_dir)
+        ) / 1e6
+
+        position = {name: i for i, name in enumerate(index.entries["item_name"])}
+        sources = rng.sample(list(catalogue["item_name"]), min(args.queries, size)) + golds * 5
+        queries = [perturb(name, rng) for name in sources]
+        expected = [position[name] for name in sources]
+        negatives = [perturb(name, rng) for name in held_out]
+
+        single = []
+        for query in queries[:200]:
+            started = time.perf_counter()
+            index.search([query], 1)
+            single.append((time.perf_counter() - started) * 1000)
+        started = time.perf_counter()
+        ranked, scores = [], []
+        for start in range(0, len(queries), 50):
+            indices, similarities = index.search(queries[start : start + 50], 5)
+            ranked.extend(indices.tolist())
+            scores.extend(similarities[:, 0].tolist())
+        batched = (time.perf_counter() - started) * 1000 / len(queries)
+        _, negative_scores = index.search(negatives, 1)
+
+        top = [found[0] for found in ranked]
+        covered = sum(
+            score >= threshold and found == target
+            for found, score, target in zip(top, scores, expected)
+        ) / len(queries)
+        wrong = sum(
+            score >= threshold and found != target
+            for found, score, target in zip(top, scores, expected)
+        ) / len(queries)
+        false = float((negative_scores[:, 0] >= threshold).mean())
+        print(
+            f"{size:>7} {build:>8.2f} {load:>7.3f} {megabytes:>6.1f} "
+            f"{percentile(single, 50):>8.2f}/{percentile(single, 95):<8.2f} {batched:>12.3f}  "
+            f"{'index':<8} {recall(ranked, expected, 1):>5.2f} {recall(ranked, expected, 5):>5.2f} "
+            f"{recall(ranked[-len(golds) * 5 :], expected[-len(golds) * 5 :], 1):>8.2f} "
+            f"{covered:>7.2f} {wrong:>6.2f} {false:>6.2f}"
+        )
+
+        # The classifier's previous fuzzy matching, on a sample of the queries
+        normalized = [
+            wastex.normalize_item_text(name).strip() for name in index.entries["item_name"]
+        ]
+        by_name = {name: i for i, name in enumerate(normalized)}
+        sample = rng.sample(range(len(queries)), min(args.difflib_queries, len(queries)))
+        timings, hits = [], 0
+        for i in sample:
+            started = time.perf_counter()
+            match = difflib.get_close_matches(
+                wastex.normalize_item_text(queries[i]).strip(), normalized, n=1, cutoff=0.75
+            )
+            timings.append((time.perf_counter() - started) * 1000)
+            hits += bool(match) and by_name[match[0]] == expected[i]
+        print(
+            f"{'':>7} {'':>8} {'':>7} {'':>6} {percentile(timings, 50):>8.2f}/"
+            f"{percentile(timings, 95):<8.2f} {statistics.mean(timings):>12.3f}  "
+            f"{'difflib':<8} {hits / len(sample):>5.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
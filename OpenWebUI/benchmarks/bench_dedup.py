@@ -0,0 +1,113 @@
+"""
+Benchmarks duplicate and near-duplicate uploads.
+
+Each fixture is uploaded through Pipe.pipe against the replay stand-ins three
+times, with a fresh document index per fixture:
+
+  first    the original file, extracted in full
+  exact    the same file again, returned from the document index
+  revised  a copy with --edit-rate of its data rows changed (a quantity
+           bumped on each), where only the changed rows should be extracted
+
+The per-row extraction cache is off, so the saved model calls come from the
+document index alone. Reports model calls, rows extracted, seconds, and
+whether the unchanged rows of the revised copy came back identical to the
+first extraction.
+
+    python OpenWebUI/benchmarks/bench_dedup.py [--edit-rate 0.05] [--latency-scale 0.05] [csv ...]
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import tempfile
+import time
+import types
+
+from common import DATA_DIR, load_pipe_module
+from replay import ReplayCompletion, ReplayConfig
+
+DEFAULT_FIXTURES = [
+    "Exemplar Input Data - WasteX.csv",
+    "delivery document sample.csv",
+]
+
+
+def revise(wastex, text: str, edit_rate: float, rng: random.Random):
+    """Returns (revised CSV text, indices of the edited data rows)."""
+    header_row, data_rows, _ = wastex.ingest_csv(text)
+    edited = sorted(rng.sample(range(len(data_rows)), max(1, int(len(data_rows) * edit_rate))))
+    rows = list(data_rows)
+    for idx in edited:
+        values = wastex.parse_csv_row(rows[idx])
+        position = rng.randrange(len(values))
+        values[position] = (values[position] + " 2").strip()
+        rows[idx] = wastex.format_csv_row(values)
+    return "\n".join([header_row] + rows), edited
+
+
+async def upload(pipe, text: str):
+    body = {
+        "messages": [
+            {"role": "system", "content": ""},
+            {"role": "user", "content": text, "file": {"mime_type": "text/csv"}},
+        ]
+    }
+    started = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        result = await pipe.pipe(body, {"id": "bench"}, None)
+    return json.loads(result), time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("csv", nargs="*", help="fixture CSVs (default: Data/Archive samples)")
+    parser.add_argument("--edit-rate", type=float, default=0.05)
+    parser.add_argument("--latency-scale", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    wastex = load_pipe_module()
+    replay = ReplayCompletion(wastex, ReplayConfig(latency_scale=args.latency_scale))
+    wastex.generate_chat_completion = replay
+    wastex.Users = types.SimpleNamespace(get_user_by_id=lambda user_id: {"id": user_id})
+    rng = random.Random(args.seed)
+
+    print(f"{'fixture':<36} {'upload':<8} {'rows':>5} {'edited':>6} {'calls':>6} {'secs':>7}")
+    for path in args.csv or [os.path.join(DATA_DIR, name) for name in DEFAULT_FIXTURES]:
+        with open(path, encoding="utf-8-sig", errors="replace") as f:
+            text = f.read()
+        pipe = wastex.Pipe()
+        pipe.valves.MODEL_RATE_LIMITS = ""
+        pipe.valves.TRACE_EXPORTER = ""
+        pipe.valves.CACHE_ENABLED = False
+        pipe.valves.CACHE_PATH = os.path.join(tempfile.mkdtemp(), "wastex_cache.sqlite3")
+        revised, edited = revise(wastex, text, args.edit_rate, rng)
+        outputs = {}
+        for label, upload_text in (("first", text), ("exact", text), ("revised", revised)):
+            replay.reset()
+            outputs[label], elapsed = asyncio.run(upload(pipe, upload_text))
+            calls = sum(stats.calls for stats in replay.stats.values())
+            print(
+                f"{os.path.basename(path)[:36]:<36} {label:<8} "
+                f"{len(outputs[label]['ordered_items']):>5} "
+                f"{len(edited) if label == 'revised' else 0:>6} {calls:>6} {elapsed:>7.2f}"
+            )
+        first = {item["row_id"]: item for item in outputs["first"]["ordered_items"]}
+        unchanged = [
+            item
+            for item in outputs["revised"]["ordered_items"]
+            if item["row_id"] not in edited
+        ]
+        print(
+            f"{'':<36} exact copy identical: {outputs['exact'] == outputs['first']}; "
+            "unchanged rows identical: "
+            f"{all(first.get(item['row_id']) == item for item in unchanged)}"
+        )
+
+
+if __name__ == "__main__":
+    main()
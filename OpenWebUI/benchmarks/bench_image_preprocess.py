@@ -0,0 +1,85 @@
+"""
+Benchmarks the image pre-processing run before Gemini extraction.
+
+Every image is encoded the way Open WebUI forwards it (base64) and run through
+preprocess_image with the pipe's default valves. Gemini image tokens are
+estimated at 258 tokens per 768x768 tile (one tile for images up to 384px).
+
+    python OpenWebUI/benchmarks/bench_image_preprocess.py [--repeat N] [image ...]
+"""
+
+import argparse
+import base64
+import glob
+import math
+import os
+import statistics
+
+from common import REPO_DIR, load_pipe_module
+
+SPEC_DIR = os.path.join(REPO_DIR, "Archive", "Spec")
+
+
+def estimated_tokens(size):
+    width, height = size
+    if width <= 384 and height <= 384:
+        return 258
+    return 258 * math.ceil(width / 768) * math.ceil(height / 768)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("images", nargs="*", help="images (default: Archive/Spec/*)")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per image")
+    args = parser.parse_args()
+
+    wastex = load_pipe_module()
+    if wastex.Image is None:
+        raise SystemExit("Pillow is not installed")
+    valves = wastex.Pipe.Valves()
+    paths = args.images or sorted(
+        path
+        for pattern in ("*.png", "*.jpg", "*.jpeg")
+        for path in glob.glob(os.path.join(SPEC_DIR, pattern))
+    )
+
+    print(
+        f"{'image':<16} {'original':>11} {'size':>11} {'bytes':>9} {'saved':>6} "
+        f"{'angle':>6} {'tokens':>11} {'median ms':>9}"
+    )
+    totals = {"original": 0, "bytes": 0, "tokens_before": 0, "tokens_after": 0}
+    for path in paths:
+        with open(path, "rb") as f:
+            data = base64.b64encode(f.read()).decode("ascii")
+        timings = []
+        for _ in range(max(1, args.repeat)):
+            _, _, stats = wastex.preprocess_image(
+                data,
+                valves.IMAGE_TARGET_DPI,
+                valves.IMAGE_MAX_DIMENSION,
+                valves.IMAGE_JPEG_QUALITY,
+            )
+            timings.append(stats["seconds"])
+        before = estimated_tokens(stats["original_size"])
+        after = estimated_tokens(stats["size"])
+        totals["original"] += stats["original_bytes"]
+        totals["bytes"] += stats["bytes"]
+        totals["tokens_before"] += before
+        totals["tokens_after"] += after
+        print(
+            f"{os.path.basename(path)[:16]:<16} "
+            f"{'%dx%d' % stats['original_size']:>11} {'%dx%d' % stats['size']:>11} "
+            f"{stats['bytes']:>9} {100 * (1 - stats['bytes'] / stats['original_bytes']):>5.0f}% "
+            f"{stats['angle']:>6.2f} {f'{before}->{after}':>11} "
+            f"{statistics.median(timings) * 1000:>9.1f}"
+        )
+    if paths:
+        print(
+            f"\n{len(paths)} images: {totals['original']} -> {totals['bytes']} bytes "
+            f"({100 * (1 - totals['bytes'] / max(1, totals['original'])):.0f}% smaller), "
+            f"estimated tokens {totals['tokens_before']} -> {totals['tokens_after']}"
+        )
+
+
+if __name__ == "__main__":
+    main()
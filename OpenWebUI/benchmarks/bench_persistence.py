@@ -0,0 +1,218 @@
+"""
+Benchmarks writing extracted final orders to i_materials.
+
+Builds a SQLite stand-in from schema.sql (or uses --database-url), seeds the
+l_materials / l_submaterials / l_units / l_suppliers lookups from the pipe's
+material taxonomy, and persists synthetic documents two ways:
+
+  row-at-a-time  one SELECT per foreign key and one INSERT + COMMIT per row,
+                 the way a naive loader would do it
+  bulk           Pipe._persist_orders: lookups loaded once into dicts, rows
+                 resolved in memory, one executemany / execute_values in a
+                 single transaction
+
+    python OpenWebUI/benchmarks/bench_persistence.py [--rows 500] [--documents 5]
+        [--database-url postgresql://...]
+
+A PostgreSQL database must already have the tables from schema.sql; the
+lookups and an i_sites row are added by the benchmark.
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+import uuid
+
+from common import create_sqlite_schema, load_pipe_module
+
+UNITS = [("m", "length"), ("m2", "area"), ("m3", "volume"), ("ea", "count"), ("kg", "weight")]
+UNIT_SPELLINGS = ["m", "lm", "metres", "m2", "sqm", "m3", "ea", "each", "pcs", "kg", "bags"]
+SUPPLIERS = ["Carters", "PlaceMakers", "ITM", "Mitre 10", "Bunnings", "Firth", "Winstone Wallboards"]
+
+
+def seed_lookups(connection, placeholder: str, wastex) -> str:
+    """Adds the lookup rows and a site, and returns the site id."""
+    materials = {name: str(uuid.uuid4()) for name in sorted(set(wastex.MATERIAL_PAIRS.values()))}
+    q = placeholder
+    with connection:
+        cursor = connection.cursor()
+        for name, material_id in materials.items():
+            cursor.execute(
+                f"INSERT INTO l_materials (material_id, material_name) VALUES ({q}, {q})",
+                (material_id, name),
+            )
+        for sub_material, material in wastex.MATERIAL_PAIRS.items():
+            cursor.execute(
+                "INSERT INTO l_submaterials (submaterial_id, material_id, submaterial_name) "
+                f"VALUES ({q}, {q}, {q})",
+                (str(uuid.uuid4()), materials[material], sub_material),
+            )
+        for name, category in UNITS:
+            cursor.execute(
+                f"INSERT INTO l_units (unit_id, unit_name, unit_category) VALUES ({q}, {q}, {q})",
+                (str(uuid.uuid4()), name, category),
+            )
+        for name in SUPPLIERS:
+            cursor.execute(
+                f"INSERT INTO l_suppliers (supplier_id, supplier_name) VALUES ({q}, {q})",
+                (str(uuid.uuid4()), name + " Ltd"),
+            )
+        site_id = str(uuid.uuid4())
+        cursor.execute(
+            f"INSERT INTO i_sites (site_id, site_name) VALUES ({q}, {q})", (site_id, "Benchmark")
+        )
+    return site_id
+
+
+def synthetic_orders(wastex, rows: int, rng: random.Random) -> list:
+    pairs = list(wastex.MATERIAL_PAIRS.items())
+    orders = []
+    for i in range(rows):
+        sub_material, material = rng.choice(pairs)
+        quantity = rng.randint(1, 200)
+        price = round(rng.uniform(1, 80), 2)
+        orders.append(
+            wastex.FinalOrder(
+                project_id=wastex.INSUFFICIENT_DATA,
+                delivery_date=f"2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+                stage=wastex.INSUFFICIENT_DATA,
+                trade_provider=rng.choice(SUPPLIERS),
+                item_name=f"{sub_material} item {i}",
+                material=material,
+                sub_material=sub_material,
+                excess_percentage=10.0,
+                density=wastex.INSUFFICIENT_DATA,
+                cubic_m3=round(rng.uniform(0.01, 2), 3),
+                weight_per_unit=wastex.INSUFFICIENT_DATA,
+                total_material_weight=round(rng.uniform(1, 500), 1),
+                waste_weight=wastex.INSUFFICIENT_DATA,
+                waste_value=wastex.INSUFFICIENT_DATA,
+                unit_quantities=str(quantity),
+                unit_measure=rng.choice(UNIT_SPELLINGS),
+                price_per_unit=price,
+                purchase_cost_total=f"${quantity * price:,.2f}",
+                estimated_removal_cost=wastex.INSUFFICIENT_DATA,
+                estimated_destination=wastex.INSUFFICIENT_DATA,
+                created_by_name=wastex.INSUFFICIENT_DATA,
+                created_by_email=wastex.INSUFFICIENT_DATA,
+            )
+        )
+    return orders
+
+
+def persist_row_at_a_time(wastex, connection, placeholder: str, orders: list, site_id: str):
+    q = placeholder
+    columns = ", ".join(wastex.I_MATERIALS_COLUMNS)
+    values = ", ".join([q] * len(wastex.I_MATERIALS_COLUMNS))
+    cursor = connection.cursor()
+
+    def lookup(sql, *params):
+        cursor.execute(sql, params)
+        found = cursor.fetchone()
+        return found[0] if found else None
+
+    for order in orders:
+        submaterial_id = lookup(
+            "SELECT s.submaterial_id FROM l_submaterials s JOIN l_materials m "
+            f"ON m.material_id = s.material_id WHERE m.material_name = {q} "
+            f"AND s.submaterial_name = {q}",
+            order.material,
+            order.sub_material,
+        )
+        unit_id = lookup(
+            f"SELECT unit_id FROM l_units WHERE unit_name = {q}",
+            wastex.canonical_unit(order.unit_measure),
+        )
+        supplier_id = lookup(
+            f"SELECT supplier_id FROM l_suppliers WHERE supplier_name = {q}",
+            order.trade_provider + " Ltd",
+        )
+        cursor.execute(
+            f"INSERT INTO i_materials ({columns}) VALUES ({values})",
+            (
+                str(uuid.uuid4()),
+                site_id,
+                submaterial_id,
+                wastex.parse_number(order.unit_quantities) or 0,
+                unit_id,
+                order.total_material_weight,
+                order.cubic_m3,
+                order.price_per_unit,
+                wastex.parse_number(order.purchase_cost_total),
+                supplier_id,
+                order.delivery_date,
+                None,
+                order.item_name,
+                None,
+                order.excess_percentage,
+            ),
+        )
+        connection.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=500, help="rows per document")
+    parser.add_argument("--documents", type=int, default=5)
+    parser.add_argument("--database-url", default="", help="default: a temporary SQLite file")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    wastex = load_pipe_module()
+    url = args.database_url or "sqlite:///" + os.path.join(tempfile.mkdtemp(), "wastex.db")
+    connection, placeholder = wastex.connect_database(url)
+    if url.startswith("sqlite:///"):
+        create_sqlite_schema(connection)
+    site_id = seed_lookups(connection, placeholder, wastex)
+
+    pipe = wastex.Pipe()
+    pipe.valves.PERSIST_DATABASE_URL = url
+    pipe.valves.REPORTS_ENABLED = False  # bench_reports.py covers the report tables
+    rng = random.Random(args.seed)
+    documents = [synthetic_orders(wastex, args.rows, rng) for _ in range(args.documents)]
+
+    naive = []
+    for orders in documents:
+        started = time.perf_counter()
+        persist_row_at_a_time(wastex, connection, placeholder, orders, site_id)
+        naive.append(time.perf_counter() - started)
+
+    bulk, stats = [], []
+    for orders in documents:
+        started = time.perf_counter()
+        stats.append(pipe._persist_orders(orders, site_id))
+        bulk.append(time.perf_counter() - started)
+
+    cursor = connection.cursor()
+    cursor.execute("SELECT COUNT(*) FROM i_materials WHERE site_id = " + placeholder, (site_id,))
+    written = cursor.fetchone()[0]
+    connection.close()
+
+    rows = args.rows * args.documents
+    print(f"{args.documents} documents x {args.rows} rows ({url.split(':')[0]})")
+    print(f"{'mode':<16} {'secs':>8} {'rows/s':>9} {'ms/document':>12}")
+    for mode, timings in (("row-at-a-time", naive), ("bulk", bulk)):
+        total = sum(timings)
+        print(
+            f"{mode:<16} {total:>8.3f} {rows / max(total, 1e-9):>9.0f} "
+            f"{1000 * total / len(timings):>12.1f}"
+        )
+    print(
+        "bulk breakdown (ms/document): lookups {:.1f} (first {:.1f}), resolve {:.1f}, "
+        "insert {:.1f}".format(
+            1000 * sum(s["lookup_seconds"] for s in stats) / len(stats),
+            1000 * stats[0]["lookup_seconds"],
+            1000 * sum(s["resolve_seconds"] for s in stats) / len(stats),
+            1000 * sum(s["insert_seconds"] for s in stats) / len(stats),
+        )
+    )
+    unresolved = {
+        kind: sum(s["unresolved"][kind] for s in stats) for kind in stats[0]["unresolved"]
+    }
+    print(f"unresolved lookups (bulk): {unresolved}; i_materials rows written: {written}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""
+End-to-end benchmark of Pipe.pipe against offline model stand-ins.
+
+Every fixture is uploaded to the pipe the way Open WebUI does it, with
+generate_chat_completion, genai.configure and genai.GenerativeModel replaced
+by the replay stand-ins in replay.py. Reports rows/sec, p50/p95 call latency
+per stage, retries, injected failures, failed rows and peak Python memory per
+fixture.
+
+    python OpenWebUI/benchmarks/bench_pipeline.py [--latency-scale 0.05]
+        [--error-rate 0.02] [--invalid-rate 0.05] [--drop-rate 0.05]
+        [--pages N] [--recordings rows.jsonl] [--cache] [csv ...]
+
+--latency-scale 1 replays roughly live model latencies; the default keeps a
+run under a minute. --pages N uploads each fixture as an N page "PDF" so the
+Gemini path is exercised instead of the CSV one. --check exits non-zero when
+any row fails to extract, for use as a smoke test.
+"""
+
+import argparse
+import asyncio
+import base64
+import contextlib
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+
+from common import DATA_DIR, load_pipe_module, percentile
+from replay import (
+    STAGES,
+    ReplayCompletion,
+    ReplayConfig,
+    ReplayGeminiModel,
+    load_recordings,
+)
+
+DEFAULT_FIXTURES = [
+    "Messy materials input.csv",
+    "Exemplar Input Data - WasteX.csv",
+    "delivery document sample.csv",
+]
+
+
+def page_upload(wastex, text: str, pages: int) -> dict:
+    header_row, data_rows, _ = wastex.ingest_csv(text)
+    size = max(1, -(-len(data_rows) // pages))
+    images = []
+    for start in range(0, max(1, len(data_rows)), size):
+        page = "\n".join([header_row] + data_rows[start : start + size])
+        data = base64.b64encode(page.encode("utf-8")).decode("ascii")
+        images.append({"type": "image_url", "image_url": {"url": "data:text/csv;base64," + data}})
+    return {"role": "user", "content": images, "file": {"mime_type": "application/pdf"}}
+
+
+async def run_fixture(pipe, message: dict, measure_memory: bool):
+    body = {"messages": [{"role": "system", "content": ""}, message]}
+    if measure_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        result = await pipe.pipe(body, {"id": "bench"}, None)
+    elapsed = time.perf_counter() - started
+    peak = 0
+    if measure_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("csv", nargs="*", help="fixture CSVs (default: Data/Archive samples)")
+    parser.add_argument("--latency-scale", type=float, default=0.05)
+    parser.add_argument("--jitter", type=float, default=0.2)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--invalid-rate", type=float, default=0.0)
+    parser.add_argument("--drop-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--pages", type=int, default=0, help="upload fixtures as N page PDFs")
+    parser.add_argument("--recordings", default="", help="JSONL of recorded row responses")
+    parser.add_argument("--cache", action="store_true", help="enable the extraction cache")
+    parser.add_argument("--no-memory", action="store_true", help="skip tracemalloc")
+    parser.add_argument("--check", action="store_true", help="fail if any row fails")
+    args = parser.parse_args()
+
+    wastex = load_pipe_module()
+    replay = ReplayCompletion(
+        wastex,
+        ReplayConfig(
+            latency_scale=args.latency_scale,
+            jitter=args.jitter,
+            error_rate=args.error_rate,
+            invalid_rate=args.invalid_rate,
+            drop_rate=args.drop_rate,
+            seed=args.seed,
+        ),
+        load_recordings(args.recordings),
+    )
+    ReplayGeminiModel.replay = replay
+    wastex.generate_chat_completion = replay
+    wastex.genai.configure = lambda **kwargs: None
+    wastex.genai.GenerativeModel = ReplayGeminiModel
+    wastex.Users = types.SimpleNamespace(get_user_by_id=lambda user_id: {"id": user_id})
+
+    pipe = wastex.Pipe()
+    pipe.valves.MODEL_RATE_LIMITS = ""
+    pipe.valves.GOOGLE_API_KEY = "replay"
+    pipe.valves.IMAGE_PREPROCESS_ENABLED = False
+    pipe.valves.RETRY_BACKOFF_SECONDS *= args.latency_scale
+    pipe.valves.CACHE_ENABLED = args.cache
+    pipe.valves.CACHE_PATH = os.path.join(tempfile.mkdtemp(), "wastex_cache.sqlite3")
+
+    paths = args.csv or [os.path.join(DATA_DIR, name) for name in DEFAULT_FIXTURES]
+    stages_reported = STAGES + (["gemini"] if args.pages else [])
+    print(
+        f"{'fixture':<36} {'rows':>5} {'failed':>6} {'secs':>7} {'rows/s':>7} {'peak MB':>8}  "
+        + "  ".join(f"{stage + ' p50/p95 (calls, retries)':<34}" for stage in stages_reported)
+    )
+    any_failed = False
+    for path in paths:
+        with open(path, encoding="utf-8-sig", errors="replace") as f:
+            text = f.read()
+        message = (
+            page_upload(wastex, text, args.pages)
+            if args.pages
+            else {"role": "user", "content": text, "file": {"mime_type": "text/csv"}}
+        )
+        replay.reset()
+        try:
+            result, elapsed, peak = asyncio.run(run_fixture(pipe, message, not args.no_memory))
+        except Exception as e:
+            # The cleaning and Gemini calls are not retried, so an injected error
+            # there fails the whole upload
+            print(f"{os.path.basename(path)}: pipe raised {e!r}")
+            if tracemalloc.is_tracing():
+                tracemalloc.stop()
+            any_failed = True
+            continue
+        try:
+            output = wastex.ExtendedFinalOrderExtraction.model_validate_json(result)
+            extracted, failed = len(output.ordered_items), len(output.failed_rows)
+        except wastex.ValidationError:
+            print(f"{os.path.basename(path)}: pipe returned {result[:200]!r}")
+            any_failed = True
+            continue
+        any_failed = any_failed or failed > 0
+        stages = []
+        for stage in stages_reported:
+            stats = replay.stats[stage]
+            stages.append(
+                f"{percentile(stats.latencies, 50):>6.2f}/{percentile(stats.latencies, 95):<6.2f}"
+                f" ({stats.calls}, {stats.retries})".ljust(34)
+            )
+        print(
+            f"{os.path.basename(path)[:36]:<36} {extracted:>5} {failed:>6} {elapsed:>7.2f} "
+            f"{extracted / max(elapsed, 1e-9):>7.1f} {peak / 1e6:>8.1f}  " + "  ".join(stages)
+        )
+        injected = {
+            stage: (stats.errors, stats.invalid, stats.dropped)
+            for stage, stats in replay.stats.items()
+            if stats.errors or stats.invalid or stats.dropped
+        }
+        if injected:
+            print(f"{'':<36} injected (errors, invalid, dropped): {injected}")
+    if args.check and any_failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
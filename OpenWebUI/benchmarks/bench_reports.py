@@ -0,0 +1,240 @@
+"""
+Benchmarks maintaining the r_* report tables.
+
+Generates a synthetic multi-year history of delivery dockets (i_materials) and
+waste removals (i_resource_removal) for several sites and loads it one
+document at a time, the way uploads arrive. After each document the report
+tables are brought up to date with ReportAggregator (incremental mode). At the
+end rebuild_reports recomputes them from scratch (full-rebuild mode), and the
+two results are compared.
+
+    python OpenWebUI/benchmarks/bench_reports.py [--sites 5] [--years 3]
+        [--documents-per-month 4] [--rows 40] [--database-url postgresql://...]
+
+Incremental timings are reported for the first and the last year of history:
+they should stay flat as history grows, while a rebuild grows with it.
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+import uuid
+
+from bench_persistence import seed_lookups
+from common import create_sqlite_schema, load_pipe_module, percentile
+
+DISPOSAL_METHODS = ["Landfill", "Cleanfill", "Recycling", "Reuse", "Incineration"]
+REMOVAL_COLUMNS = [
+    "removal_id",
+    "site_id",
+    "submaterial_id",
+    "waste_weight_kg",
+    "waste_volume_m3",
+    "removal_date",
+    "disposal_method_id",
+    "removal_cost",
+    "appx_resource_value",
+]
+
+
+def seed_sites(connection, q: str, first_site: str, count: int, rng: random.Random):
+    """Adds sites and disposal methods; returns (site ids, disposal method ids)."""
+    sites = [first_site] + [str(uuid.uuid4()) for _ in range(count - 1)]
+    with connection:
+        cursor = connection.cursor()
+        cursor.execute(
+            f"UPDATE i_sites SET project_cost = {q}, floor_area_m_2 = {q} WHERE site_id = {q}",
+            (rng.randint(1, 20) * 1e6, rng.randint(500, 20000), first_site),
+        )
+        for i, site_id in enumerate(sites[1:], 2):
+            cursor.execute(
+                "INSERT INTO i_sites (site_id, site_name, project_cost, floor_area_m_2) "
+                f"VALUES ({q}, {q}, {q}, {q})",
+                (site_id, f"Site {i}", rng.randint(1, 20) * 1e6, rng.randint(500, 20000)),
+            )
+        methods = []
+        for name in DISPOSAL_METHODS:
+            methods.append(str(uuid.uuid4()))
+            cursor.execute(
+                "INSERT INTO l_disposal_methods (disposal_method_id, disposal_method_name) "
+                f"VALUES ({q}, {q})",
+                (methods[-1], name),
+            )
+    return sites, methods
+
+
+def synthetic_document(lookups, site_id, year, month, rows, methods, rng):
+    submaterials = sorted(lookups.material_of)
+    units = sorted(lookups.units.values())
+    suppliers = sorted(lookups.suppliers.values())
+    material_rows, removal_rows = [], []
+    for _ in range(rows):
+        day = f"{year}-{month:02d}-{rng.randint(1, 28):02d}"
+        submaterial_id = rng.choice(submaterials)
+        quantity = rng.randint(1, 200)
+        price = round(rng.uniform(1, 80), 2)
+        weight = round(rng.uniform(1, 500), 2)
+        material_rows.append(
+            (
+                str(uuid.uuid4()),
+                site_id,
+                submaterial_id if rng.random() > 0.05 else None,
+                quantity,
+                rng.choice(units),
+                weight,
+                round(rng.uniform(0.01, 2), 2),
+                price,
+                round(quantity * price, 2),
+                rng.choice(suppliers),
+                day,
+                None,
+                "synthetic item",
+                None,
+                rng.choice([None, 5.0, 10.0, 15.0]),
+            )
+        )
+        if rng.random() < 0.4:
+            removal_rows.append(
+                (
+                    str(uuid.uuid4()),
+                    site_id,
+                    submaterial_id,
+                    round(weight * rng.uniform(0.05, 0.2), 2),
+                    round(rng.uniform(0.01, 0.5), 2),
+                    day,
+                    rng.choice(methods),
+                    round(rng.uniform(10, 200), 2),
+                    round(rng.uniform(0, 50), 2),
+                )
+            )
+    return material_rows, removal_rows
+
+
+def snapshot(connection):
+    # Report rows without their generated ids, for comparing the two modes
+    cursor = connection.cursor()
+    tables = {
+        "r_materials": "site_id, material_id, total_weight_kg, total_volume_m3, total_cost, "
+        "avg_excess_percentage, materials_budget_percentage",
+        "r_waste": "site_id, submaterial_id, waste_weight_kg, landfill_weight, "
+        "recycle_weight, reuse_weight, diversion_rate_pct",
+        "r_waste_summary": "site_id, total_waste_weight_kg, diversion_percentage, "
+        "waste_generation_rate_kg_m2",
+        "r_embodied_carbon": "site_id, submaterial_id, total_material_weight_kg, waste_weight_kg",
+        "r_diversion_pct_by_month": "year_num, month_num, diversion_pct",
+        "r_removal_by_month_and_method": "year_num, month_num, disposal_method_id, mass_kg",
+    }
+    result = {}
+    for table, columns in tables.items():
+        cursor.execute(f"SELECT {columns} FROM {table}")
+        result[table] = sorted(
+            tuple(str(v) if isinstance(v, str) or v is None else round(float(v), 2) for v in row)
+            for row in cursor.fetchall()
+        )
+    return result
+
+
+def same(a, b) -> bool:
+    if a.keys() != b.keys():
+        return False
+    for table in a:
+        if len(a[table]) != len(b[table]):
+            return False
+        for row_a, row_b in zip(a[table], b[table]):
+            for x, y in zip(row_a, row_b):
+                if isinstance(x, float) and isinstance(y, float):
+                    if abs(x - y) > 0.02:
+                        return False
+                elif x != y:
+                    return False
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sites", type=int, default=5)
+    parser.add_argument("--years", type=int, default=3)
+    parser.add_argument("--documents-per-month", type=int, default=4)
+    parser.add_argument("--rows", type=int, default=40, help="rows per document")
+    parser.add_argument("--database-url", default="", help="default: a temporary SQLite file")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    wastex = load_pipe_module()
+    url = args.database_url or "sqlite:///" + os.path.join(tempfile.mkdtemp(), "wastex.db")
+    connection, q = wastex.connect_database(url)
+    if url.startswith("sqlite:///"):
+        create_sqlite_schema(connection)
+    rng = random.Random(args.seed)
+    sites, methods = seed_sites(connection, q, seed_lookups(connection, q, wastex), args.sites, rng)
+    lookups = wastex.LookupTables.load(connection, url)
+
+    removal_sql = "INSERT INTO i_resource_removal ({}) VALUES ({})".format(
+        ", ".join(REMOVAL_COLUMNS), ", ".join([q] * len(REMOVAL_COLUMNS))
+    )
+    material_columns = [
+        wastex.I_MATERIALS_COLUMNS.index(name) for name in wastex.MATERIAL_AGGREGATE_COLUMNS
+    ]
+    removal_columns = [REMOVAL_COLUMNS.index(name) for name in wastex.REMOVAL_AGGREGATE_COLUMNS]
+    first_year = 2020
+    timings = {}  # year -> seconds spent on report updates per document
+    source_rows = 0
+    for year in range(first_year, first_year + args.years):
+        for month in range(1, 13):
+            for site_id in sites:
+                for _ in range(args.documents_per_month):
+                    material_rows, removal_rows = synthetic_document(
+                        lookups, site_id, year, month, args.rows, methods, rng
+                    )
+                    source_rows += len(material_rows) + len(removal_rows)
+                    with connection:
+                        wastex.insert_material_rows(connection, q, material_rows)
+                        connection.cursor().executemany(removal_sql, removal_rows)
+                        started = time.perf_counter()
+                        aggregator = wastex.ReportAggregator(lookups)
+                        aggregator.add_materials(
+                            [tuple(row[i] for i in material_columns) for row in material_rows]
+                        )
+                        aggregator.add_removals(
+                            [tuple(row[i] for i in removal_columns) for row in removal_rows]
+                        )
+                        aggregator.apply(connection, q)
+                        timings.setdefault(year, []).append(time.perf_counter() - started)
+    incremental = snapshot(connection)
+
+    started = time.perf_counter()
+    stats = wastex.rebuild_reports(connection, q, lookups)
+    rebuild_seconds = time.perf_counter() - started
+    rebuilt = snapshot(connection)
+    connection.close()
+
+    documents = sum(len(values) for values in timings.values())
+    last_year = first_year + args.years - 1
+    print(
+        f"{args.sites} sites x {args.years} years: {documents} documents, "
+        f"{source_rows} source rows ({url.split(':')[0]})"
+    )
+    print(f"{'mode':<28} {'p50 ms':>8} {'p95 ms':>8} {'total s':>8}")
+    for label, values in (
+        (f"incremental, {first_year}", timings[first_year]),
+        (f"incremental, {last_year}", timings[last_year]),
+        ("incremental, all", [t for values in timings.values() for t in values]),
+    ):
+        print(
+            f"{label:<28} {1000 * percentile(values, 50):>8.2f} "
+            f"{1000 * percentile(values, 95):>8.2f} {sum(values):>8.2f}"
+        )
+    print(f"{'full rebuild':<28} {'':>8} {'':>8} {rebuild_seconds:>8.2f}")
+    print(
+        f"rebuilding after every upload instead: ~{rebuild_seconds * 1000:.0f} ms per document "
+        f"at the end of history ({rebuild_seconds / max(percentile(timings[last_year], 50), 1e-9):.0f}x "
+        f"the incremental p50); rebuild read {stats['source_rows']} rows into "
+        f"{stats['totals_rows']} totals, {stats['unattributed_rows']} unattributed"
+    )
+    print(f"incremental and rebuilt report tables match: {same(incremental, rebuilt)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""
+Benchmarks the local dimension parser against the o3-mini vol/mass prompt.
+
+Every order line in the fixture CSVs is run through parse_volume_mass. With
+--llm (and OPENAI_API_KEY set) the same rows are also sent to the vol/mass
+prompt in batches of 20, the way the pipe does, and the two volumes are
+compared for the rows both paths resolved.
+
+    python OpenWebUI/benchmarks/bench_volume_mass.py [--llm] [csv ...]
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import time
+
+from common import DATA_DIR, load_pipe_module, read_csv_rows
+
+DEFAULT_FIXTURES = [
+    "Clean materials input.csv",
+    "(new clean materials input) CLEAN WX TEMPLATE FILLED OUT.xlsx - Sheet1.csv",
+    "delivery document sample.csv",
+    "image_input_line_items.csv",
+    "demo_clean1.csv",
+    "demo_image1.csv",
+    "demo_messy1.csv",
+]
+BATCH_SIZE = 20
+
+
+def run_local(wastex, header_row, data_rows):
+    column_map = wastex.map_header_columns(header_row)
+    classifier = wastex.MaterialClassifier()
+    results = []
+    started = time.perf_counter()
+    for row in data_rows:
+        values = wastex.parse_csv_row(row)
+
+        def column(field):
+            idx = column_map.get(field)
+            return values[idx] if idx is not None and idx < len(values) else ""
+
+        text = column("item_name") or row
+        classification, _ = classifier.classify(text)
+        results.append(
+            wastex.parse_volume_mass(
+                text,
+                column("unit_quantities"),
+                column("unit_measure"),
+                classification.sub_material if classification else "",
+            )
+        )
+    return results, time.perf_counter() - started
+
+
+async def run_llm(wastex, header_row, data_rows):
+    from openai import AsyncOpenAI
+
+    client = AsyncOpenAI()
+    classifier = wastex.MaterialClassifier()
+    results, latencies = [], []
+    for start in range(0, len(data_rows), BATCH_SIZE):
+        batch = data_rows[start : start + BATCH_SIZE]
+        items = []
+        for row in batch:
+            classification, _ = classifier.classify(row)
+            items.append(
+                wastex.OrderedItem(
+                    raw_data=row,
+                    material_classification=classification
+                    or wastex.MaterialClassification(
+                        material="not applicable",
+                        sub_material="not applicable",
+                        confidence=wastex.Confidence(
+                            score=0, reasoning="not applicable", assumptions=[]
+                        ),
+                    ),
+                )
+            )
+        payload = wastex.MaterialsExtraction(ordered_items=items)
+        started = time.perf_counter()
+        response = await client.chat.completions.create(
+            model="o3-mini",
+            messages=[
+                {"role": "system", "content": wastex.VOLUME_MASS_PROMPT},
+                {
+                    "role": "user",
+                    "content": "Here are the column names (associated with the 'raw_data' attribute): \n"
+                    + header_row
+                    + "\n\nHere is the data: \n"
+                    + payload.model_dump_json(indent=4),
+                },
+            ],
+        )
+        latencies.append(time.perf_counter() - started)
+        try:
+            output = wastex.VolumeMassExtraction.model_validate_json(
+                response.choices[0].message.content
+            )
+            volumes = [item.volume_mass_data for item in output.ordered_items]
+        except wastex.ValidationError:
+            volumes = []
+        volumes += [None] * (len(batch) - len(volumes))
+        results.extend(volumes[: len(batch)])
+    return results, sum(latencies)
+
+
+def resolved_volume(data):
+    if data is None or not isinstance(data.total_volume_m3, (int, float)):
+        return None
+    return float(data.total_volume_m3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("csv", nargs="*", help="fixture CSVs (default: Data/Archive samples)")
+    parser.add_argument("--llm", action="store_true", help="also run the o3-mini prompt")
+    args = parser.parse_args()
+
+    wastex = load_pipe_module()
+    paths = args.csv or [os.path.join(DATA_DIR, name) for name in DEFAULT_FIXTURES]
+    run_llm_path = args.llm and bool(os.getenv("OPENAI_API_KEY"))
+    if args.llm and not run_llm_path:
+        print("OPENAI_API_KEY is not set; only the local parser is benchmarked")
+
+    print(
+        f"{'fixture':<48} {'rows':>5} {'local ok':>8} {'local ms/row':>12}"
+        + (f" {'llm ok':>7} {'llm s/row':>9} {'median rel diff':>15}" if run_llm_path else "")
+    )
+    for path in paths:
+        header_row, data_rows = read_csv_rows(path)
+        local, local_seconds = run_local(wastex, header_row, data_rows)
+        local_volumes = [resolved_volume(data) for data in local]
+        line = (
+            f"{os.path.basename(path)[:48]:<48} {len(data_rows):>5} "
+            f"{sum(v is not None for v in local_volumes):>8} "
+            f"{local_seconds * 1000 / max(1, len(data_rows)):>12.3f}"
+        )
+        if run_llm_path:
+            llm, llm_seconds = asyncio.run(run_llm(wastex, header_row, data_rows))
+            llm_volumes = [resolved_volume(data) for data in llm]
+            diffs = [
+                abs(a - b) / max(abs(b), 1e-9)
+                for a, b in zip(local_volumes, llm_volumes)
+                if a is not None and b is not None
+            ]
+            line += (
+                f" {sum(v is not None for v in llm_volumes):>7} "
+                f"{llm_seconds / max(1, len(data_rows)):>9.3f} "
+                f"{(statistics.median(diffs) if diffs else float('nan')):>15.3f}"
+            )
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+Shared helpers for the wastex extraction benchmarks.
+
+The pipe is a single Open WebUI function file, so it is loaded straight from
+its path. The benchmarks replace the model calls with stand-ins, so Open WebUI,
+FastAPI and the Gemini SDK are stubbed out when they aren't installed; numpy,
+pandas and pydantic are still needed, e.g.
+
+    python OpenWebUI/benchmarks/bench_volume_mass.py
+"""
+
+import csv
+import glob
+import importlib.util
+import io
+import os
+import re
+import sys
+import types
+
+OPENWEBUI_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REPO_DIR = os.path.dirname(OPENWEBUI_DIR)
+DATA_DIR = os.path.join(REPO_DIR, "Data", "Archive")
+
+
+def _not_available(*args, **kwargs):
+    raise RuntimeError("not installed; stubbed out for the offline benchmarks and tests")
+
+
+class _GenerationConfig:
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+
+
+# module -> attributes, parents before their submodules
+STUB_MODULES = {
+    "fastapi": {"Request": type("Request", (), {})},
+    "open_webui": {},
+    "open_webui.models": {},
+    "open_webui.models.users": {
+        "Users": types.SimpleNamespace(get_user_by_id=_not_available)
+    },
+    "open_webui.utils": {},
+    "open_webui.utils.chat": {"generate_chat_completion": _not_available},
+    "google": {},
+    "google.generativeai": {"configure": _not_available, "GenerativeModel": _not_available},
+    "google.generativeai.types": {"GenerationConfig": _GenerationConfig},
+}
+
+
+def _is_installed(name: str) -> bool:
+    try:
+        return importlib.util.find_spec(name) is not None
+    except ModuleNotFoundError:  # a parent package is missing
+        return False
+
+
+def stub_missing_modules():
+    """Registers stand-ins for the pipe's server-side imports that aren't installed."""
+    for name, attributes in STUB_MODULES.items():
+        if name in sys.modules or _is_installed(name):
+            continue
+        module = types.ModuleType(name)
+        module.__path__ = []  # so submodules can be imported from it
+        module.__dict__.update(attributes)
+        sys.modules[name] = module
+        parent, _, child = name.rpartition(".")
+        if parent in sys.modules:
+            setattr(sys.modules[parent], child, module)
+
+
+def load_pipe_module():
+    """Imports the newest wastex extraction function export as a module."""
+    stub_missing_modules()
+    path = sorted(
+        glob.glob(os.path.join(OPENWEBUI_DIR, "function-wastex_extraction-export-*.py"))
+    )[-1]
+    spec = importlib.util.spec_from_file_location("wastex_extraction", path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["wastex_extraction"] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def read_csv_rows(path):
+    """Returns (header_row, data_rows) as CSV text lines, skipping blank rows."""
+    with open(path, newline="", encoding="utf-8-sig", errors="replace") as f:
+        records = [record for record in csv.reader(f) if any(cell.strip() for cell in record)]
+    lines = []
+    for record in records:
+        buffer = io.StringIO()
+        csv.writer(buffer).writerow(record)
+        lines.append(buffer.getvalue().rstrip("\r\n"))
+    return lines[0], lines[1:]
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[idx]
+
+
+def create_sqlite_schema(connection, tables=None):
+    """
+    Creates the tables and indexes from schema.sql in a SQLite database, as a
+    local stand-in for the Supabase PostgreSQL schema. Storage clauses and uuid
+    defaults are dropped and grants are skipped.
+    """
+    with open(os.path.join(REPO_DIR, "schema.sql"), encoding="utf-8") as f:
+        schema = f.read()
+    for statement in schema.split(";"):
+        statement = statement.strip()
+        match = re.match(r"create (?:table (\w+)|index \w+\s+on (\w+))", statement)
+        if not match or (tables is not None and (match.group(1) or match.group(2)) not in tables):
+            continue
+        statement = re.sub(r"\)\s*using \?\?\?$", ")", statement)
+        statement = statement.replace("using ??? ", "")
+        statement = statement.replace("default gen_random_uuid()", "")
+        connection.execute(statement)
+    connection.commit()
@@ -0,0 +1,223 @@
+"""
+Offline stand-ins for the model calls the wastex pipe makes.
+
+ReplayCompletion replaces open_webui's generate_chat_completion and
+ReplayGeminiModel replaces genai.GenerativeModel. Responses are assembled per
+row: a row found in the recordings file gets its recorded item back, any other
+row gets a schema-valid synthesized one (materials from the local classifier,
+fixed vol/mass and final order values). Each call sleeps for a simulated
+latency, and failures (API errors, truncated JSON, dropped rows) are injected
+at configurable rates, so retries and repair paths get exercised too.
+
+Recordings are JSONL, one row per line:
+
+    {"stage": "materials", "raw_data": "<csv row>", "item": {...}}
+
+where stage is "cleaning", "materials", "vol/mass" or "final order" and item is
+the stage's response item for that row (without row_id). For "cleaning" the
+raw_data is the whole uploaded CSV and item is {"csv": "<cleaned csv>"}.
+"""
+
+import asyncio
+import base64
+import json
+import random
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List
+
+STAGES = ["cleaning", "materials", "vol/mass", "final order"]
+
+# stage -> (seconds per call, seconds per row), roughly what the live models take
+DEFAULT_LATENCY = {
+    "cleaning": (8.0, 0.05),
+    "materials": (3.0, 0.15),
+    "vol/mass": (6.0, 0.5),
+    "final order": (4.0, 0.3),
+    "gemini": (10.0, 0.0),
+}
+
+
+@dataclass
+class ReplayConfig:
+    latency_scale: float = 1.0  # multiplies DEFAULT_LATENCY
+    jitter: float = 0.2  # latency is scaled by uniform(1 - jitter, 1 + jitter)
+    error_rate: float = 0.0  # calls that raise
+    invalid_rate: float = 0.0  # calls that return truncated JSON
+    drop_rate: float = 0.0  # calls that leave one row out of the response
+    seed: int = 0
+
+
+@dataclass
+class StageStats:
+    calls: int = 0
+    retries: int = 0
+    rows: int = 0
+    errors: int = 0
+    invalid: int = 0
+    dropped: int = 0
+    latencies: List[float] = field(default_factory=list)
+
+
+def load_recordings(path: str) -> Dict[tuple, dict]:
+    recordings = {}
+    if not path:
+        return recordings
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                recordings[(record["stage"], record["raw_data"].strip())] = record["item"]
+    return recordings
+
+
+class ReplayCompletion:
+    def __init__(self, wastex, config: ReplayConfig, recordings: Dict[tuple, dict] = None):
+        self.wastex = wastex
+        self.config = config
+        self.recordings = recordings or {}
+        self.random = random.Random(config.seed)
+        self.classifier = wastex.MaterialClassifier()
+        self.stats = {stage: StageStats() for stage in STAGES + ["gemini"]}
+        self._seen_rows = {stage: set() for stage in STAGES}
+        self._prompts = {
+            wastex.CSV_CLEANING_PROMPT: "cleaning",
+            wastex.MATERIALS_PROMPT: "materials",
+            wastex.VOLUME_MASS_PROMPT: "vol/mass",
+            wastex.FINAL_ORDER_PROMPT: "final order",
+        }
+
+    def reset(self):
+        self.stats = {stage: StageStats() for stage in STAGES + ["gemini"]}
+        self._seen_rows = {stage: set() for stage in STAGES}
+
+    async def simulate_latency(self, stage: str, rows: int) -> float:
+        base, per_row = DEFAULT_LATENCY[stage]
+        jitter = self.random.uniform(1 - self.config.jitter, 1 + self.config.jitter)
+        seconds = max(0.0, (base + per_row * rows) * self.config.latency_scale * jitter)
+        await asyncio.sleep(seconds)
+        return seconds
+
+    async def __call__(self, request, body: dict, user) -> dict:
+        messages = body["messages"]
+        stage = self._prompts.get(messages[0]["content"])
+        if stage is None:
+            raise ValueError("Unrecognised system prompt")
+        user_content = messages[-1]["content"]
+        rows = self.parse_rows(stage, user_content)
+        stats = self.stats[stage]
+        stats.calls += 1
+        stats.rows += len(rows)
+        seen = self._seen_rows[stage]
+        if any(row_id in seen for row_id, _ in rows):
+            stats.retries += 1
+        seen.update(row_id for row_id, _ in rows)
+
+        started = time.perf_counter()
+        await self.simulate_latency(stage, len(rows))
+        stats.latencies.append(time.perf_counter() - started)
+
+        if self.random.random() < self.config.error_rate:
+            stats.errors += 1
+            raise RuntimeError("Simulated API error")
+        if stage == "cleaning":
+            content = self.cleaned_csv(user_content)
+        else:
+            items = [self.item(stage, row_id, raw_data) for row_id, raw_data in rows]
+            if len(items) > 1 and self.random.random() < self.config.drop_rate:
+                stats.dropped += 1
+                items.pop(self.random.randrange(len(items)))
+            content = json.dumps({"ordered_items": items})
+            if self.random.random() < self.config.invalid_rate:
+                stats.invalid += 1
+                content = content[: len(content) * 2 // 3]
+        return {"choices": [{"message": {"content": content}}]}
+
+    def parse_rows(self, stage: str, content: str) -> List[tuple]:
+        # (row_id, raw_data) for every row in a request
+        if stage == "cleaning":
+            return [(0, content)]
+        if stage == "materials":
+            lines = content.split("\n")[2:]
+            rows = []
+            for line in lines:
+                row_id, _, raw_data = line.partition(",")
+                rows.append((int(row_id) if row_id.isdigit() else None, raw_data))
+            return rows
+        payload = json.loads(content[content.index("Here is the data:") + len("Here is the data:") :])
+        return [(item.get("row_id"), item["raw_data"]) for item in payload["ordered_items"]]
+
+    def cleaned_csv(self, content: str) -> str:
+        recorded = self.recordings.get(("cleaning", content.strip()))
+        if recorded:
+            return recorded["csv"]
+        header_row, data_rows, _ = self.wastex.ingest_csv(content)
+        return "\n".join([header_row] + data_rows)
+
+    def item(self, stage: str, row_id, raw_data: str) -> dict:
+        wastex = self.wastex
+        recorded = self.recordings.get((stage, raw_data.strip()))
+        if recorded is not None:
+            item = dict(recorded)
+        elif stage == "materials":
+            classification, _ = self.classifier.classify(raw_data)
+            if classification is None:
+                classification = wastex.MaterialClassification(
+                    material="not applicable",
+                    sub_material="not applicable",
+                    confidence=wastex.Confidence(
+                        score=0, reasoning="not applicable", assumptions=[]
+                    ),
+                )
+            item = {
+                "raw_data": raw_data,
+                "material_classification": classification.model_dump(),
+            }
+        elif stage == "vol/mass":
+            item = {
+                "raw_data": raw_data,
+                "volume_mass_data": {
+                    "total_volume_m3": 0.05,
+                    "purchase_weight_kg": wastex.INSUFFICIENT_DATA,
+                    "weight_per_unit": wastex.INSUFFICIENT_DATA,
+                    "calculation_method": "rectangular prism",
+                    "mass_calculation_method": "not applicable",
+                    "conversion_steps": ["replayed"],
+                    "confidence": {"score": 0.7, "reasoning": "replayed", "assumptions": []},
+                },
+            }
+        else:
+            item = {
+                name: wastex.INSUFFICIENT_DATA
+                for name in wastex.FinalOrder.model_fields
+                if name != "row_id"
+            }
+            item["item_name"] = raw_data[:40]
+        item["row_id"] = row_id
+        return item
+
+
+class ReplayGeminiModel:
+    """Stands in for genai.GenerativeModel. Every "page image" is the text of
+    one page CSV, base64 encoded, and is answered with that CSV."""
+
+    replay: ReplayCompletion = None
+
+    def __init__(self, model_name=None):
+        self.model_name = model_name
+
+    async def generate_content_async(self, contents, generation_config=None):
+        stats = self.replay.stats["gemini"]
+        stats.calls += 1
+        started = time.perf_counter()
+        await self.replay.simulate_latency("gemini", 0)
+        stats.latencies.append(time.perf_counter() - started)
+        if self.replay.random.random() < self.replay.config.error_rate:
+            stats.errors += 1
+            raise RuntimeError("Simulated API error")
+        page = contents[-1]["parts"][0]["inline_data"]["data"]
+
+        class Response:
+            text = base64.b64decode(page).decode("utf-8")
+
+        return Response()
@@ -15,16 +15,53 @@ version: 0.1
 """
 
 from pydantic import BaseModel, Field, ValidationError
-from typing import List, Literal, Union
+from typing import AsyncGenerator, Dict, List, Literal, Union, get_args, get_origin
 from fastapi import Request
 
+import numpy as np
+import pandas as pd
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # images are sent to Gemini as-is without Pillow
+    Image = None
+
+try:
+    import psycopg2
+    from psycopg2.extras import execute_values
+except ImportError:  # PostgreSQL persistence is unavailable without it
+    psycopg2 = None
+
+try:
+    from opentelemetry import trace as otel_trace
+    from opentelemetry.trace import Status, StatusCode
+except ImportError:  # the "otel" span exporter is unavailable without it
+    otel_trace = None
+
 import google.generativeai as genai
 from google.generativeai.types import GenerationConfig
 
 from open_webui.models.users import Users
 from open_webui.utils.chat import generate_chat_completion
 
+import asyncio
+import base64
+import contextlib
+import contextvars
+import csv
+import difflib
+import hashlib
+import io
+import json
+import math
 import os
+import random
+import re
+import sqlite3
+import time
+import uuid
+import warnings
+from datetime import datetime
 
 # Pydantic models for confidence details and material classification
 
@@ -100,6 +137,9 @@ class MaterialClassification(BaseModel):
 
 
 class OrderedItem(BaseModel):
+    row_id: Union[int, None] = Field(
+        default=None, description="Row id of the line item, copied from the input"
+    )
     raw_data: str = Field(..., description="Original CSV row data")
     material_classification: MaterialClassification = Field(
         ..., description="Extracted material classification and confidence details"
@@ -147,6 +187,9 @@ class VolumeMassData(BaseModel):
 
 
 class OrderedItem2(BaseModel):
+    row_id: Union[int, None] = Field(
+        default=None, description="Row id of the line item, copied from the input"
+    )
     raw_data: str = Field(..., description="Original CSV row data")
     volume_mass_data: VolumeMassData = Field(
         ..., description="Extracted volume and mass information"
@@ -164,6 +207,9 @@ class VolumeMassExtraction(BaseModel):
 
 
 class CombinedItem(BaseModel):
+    row_id: Union[int, None] = Field(
+        default=None, description="Row id of the line item, copied from the input"
+    )
     raw_data: str
     volume_mass_data: VolumeMassData
     material_classification: MaterialClassification
@@ -177,6 +223,9 @@ class ComboExtraction(BaseModel):
 
 
 class FinalOrder(BaseModel):
+    row_id: Union[int, None] = Field(
+        default=None, description="Row id of the line item, copied from the input"
+    )
     project_id: str = Field(..., description="Project ID, or 'Insufficient Data'")
     delivery_date: str = Field(
         ..., description="Delivery date in ISO format or 'Insufficient Data'"
@@ -256,40 +305,23 @@ class FinalOrderExtraction(BaseModel):
     )
 
 
-class ExtendedFinalOrderExtraction(BaseModel):
-    ordered_items: List[ExtendedFinalOrder]
-
-
-class Pipe:
-    class Valves(BaseModel):
-        MODEL_ID: str = Field(default="")
-        GOOGLE_API_KEY: str = Field(default="")
+class FailedRow(BaseModel):
+    row_index: int = Field(..., description="Index of the row among the data rows")
+    raw_data: str = Field(..., description="Original CSV row data")
+    stage: str = Field(..., description="Extraction step the row failed in")
+    reason: str = Field(..., description="Why the row could not be extracted")
 
-    def __init__(self):
-        self.valves = self.Valves(
-            **{
-                "GOOGLE_API_KEY": os.getenv("GOOGLE_API_KEY", ""),
-            }
-        )
 
-    async def pipe(self, body: dict, __user__: dict, __request__: Request) -> str:
-        # Retrieve user details using the provided user id.
-        user = Users.get_user_by_id(__user__["id"])
+class ExtendedFinalOrderExtraction(BaseModel):
+    ordered_items: List[ExtendedFinalOrder]
+    failed_rows: List[FailedRow] = Field(default_factory=list)
 
-        file_body = body["messages"][-1].get("file", None)
-        file_content = body["messages"][-1]["content"]
-        file_type = ""
-        if not file_body:
-            file_type = "text/csv"
-        else:
-            file_type = file_body["mime_type"]
 
-        body["stream"] = False
+# System prompts. These are sent verbatim, so changing one also invalidates
+# the cached results for its step.
 
-        # ---------------------------------------------------------------------
-        # System prompt for CSV cleaning (data reorganization)
-        # ---------------------------------------------------------------------
-        csv_cleaning_prompt = """
+# System prompt for CSV cleaning (data reorganization)
+CSV_CLEANING_PROMPT = """
         You are an expert in **data cleaning and CSV reorganization**.
 
         1. **Input Sources**  
@@ -326,8 +358,8 @@ class Pipe:
         THE FIRST LINE OF YOUR OUTPUT MUST BE THE ROW OF COLUMN NAMES. IT IS IMPERATIVE THAT THE FIRST LINE OF YOUR OUTPUT IS THE ROW OF COLUMN NAMES!
         """
 
-        # For image files, use the image extraction prompt.
-        image_extraction_prompt = """
+# For image files, use the image extraction prompt.
+IMAGE_EXTRACTION_PROMPT = """
         1. Input:
            - The provided file (PDF or image) may contain one or more tables with various layouts, borders, and fonts. Tables might span multiple pages or have complex structures such as merged cells.
         
@@ -352,150 +384,14 @@ class Pipe:
         THE FIRST LINE OF YOUR OUTPUT MUST BE THE ROW OF COLUMN NAMES. IT IS IMPERATIVE THAT THE FIRST LINE OF YOUR OUTPUT IS THE ROW OF COLUMN NAMES!
         """
 
-        # ---------------------------------------------------------------------
-        # Helper function: Calls the chat completion API with the current body,
-        # validates the response against the provided Pydantic schema, and retries
-        # until either a valid response is obtained or the max retries are reached.
-        # This function uses and updates the nonlocal 'retry_count' variable.
-        # ---------------------------------------------------------------------
-        async def get_validated_response(schema_model, prompt_desc: str) -> any:
-            nonlocal retry_count, max_retries, body, __request__, user, i
-            while retry_count < max_retries:
-                chat_call = await generate_chat_completion(__request__, body, user)
-                response_content = chat_call["choices"][0]["message"]["content"]
-                try:
-                    validated_output = schema_model.model_validate_json(
-                        response_content
-                    )
-                    print(f"Successfully processed {prompt_desc} batch {i}")
-                    return validated_output
-                except ValidationError:
-                    retry_count += 1
-                    print("RESPONSE CONTENT: \n\n" + response_content)
-                    print("Failed, trying again")
-                    continue
-            return None
-
-        # Helper function for Google Gemini API calls
-        async def call_google_gemini(
-            system_prompt, image_content, image_type="image/jpeg"
-        ):
-            # Configure Google API with the API key from environment or valves
-            if not self.valves.GOOGLE_API_KEY:
-                return "Error: GOOGLE_API_KEY is not set"
-            genai.configure(api_key=GOOGLE_API_KEY)
-            # google_api_key = "<FILL IN API KEY>"
-            # genai.configure(api_key=google_api_key)
-            model_id = "gemini-2.0-pro-exp"
-
-            # Format content for Gemini API
-            contents = []
-
-            # Add system prompt as a user message (since Gemini doesn't have system role)
-            if system_prompt:
-                contents.append(
-                    {"role": "user", "parts": [{"text": f"System: {system_prompt}"}]}
-                )
-
-            # Handle the image content
-            parts = []
-
-            # For single image
-            if not isinstance(image_content, list):
-                image_data = image_content
-                if image_data.startswith("data:"):
-                    image_data = image_data.split(",")[1]
-
-                parts.append(
-                    {"inline_data": {"mime_type": image_type, "data": image_data}}
-                )
-            else:
-                # For multiple images (PDF case)
-                for image_item in image_content:
-                    if image_item.get("type") == "image_url":
-                        image_url = image_item["image_url"]["url"]
-                        # If it's a data URL, extract the base64 part
-                        if image_url.startswith("data:"):
-                            image_data = image_url.split(",")[1]
-                        else:
-                            image_data = image_url
-
-                        parts.append(
-                            {
-                                "inline_data": {
-                                    "mime_type": "image/jpeg",
-                                    "data": image_data,
-                                }
-                            }
-                        )
-
-            # Add the parts to the contents
-            contents.append({"role": "user", "parts": parts})
-
-            # Create model and configuration
-            model = genai.GenerativeModel(model_name=model_id)
-            generation_config = GenerationConfig(
-                temperature=0.7,
-                top_p=0.9,
-                top_k=40,
-                max_output_tokens=16384,
-            )
-
-            try:
-                response = model.generate_content(
-                    contents,
-                    generation_config=generation_config,
-                )
-                return response.text
-            except Exception as e:
-                return f"Error calling Google Gemini API: {str(e)}"
-
-        # ---------------------------------------------------------------------
-        # First model call: Branch based on file type.
-        # ---------------------------------------------------------------------
-        if file_type == "text/csv":
-            # For CSV files, use the original approach
-            body["model"] = "gpt-4o"
-            body["messages"][0]["content"] = csv_cleaning_prompt
-
-            # Call the completion function to obtain the cleaned CSV output.
-            first_call = await generate_chat_completion(__request__, body, user)
-            first_response = first_call["choices"][0]["message"]["content"]
-
-        elif file_type == "image/png" or file_type == "image/jpeg":
-            # For image files, use Google Gemini
-            print("Processing image with Google Gemini")
-            first_response = await call_google_gemini(
-                image_extraction_prompt, file_content, file_type
-            )
-
-        else:
-            # For PDF files (which are a list of images)
-            print("Processing PDF images with Google Gemini")
-            first_response = await call_google_gemini(
-                image_extraction_prompt, file_content
-            )
-        print("RECEIVED:", first_response)
-
-        body["model"] = "gpt-4o"
-
-        # Split the CSV output into rows and separate the header from data rows.
-        rows = first_response.splitlines()
-        if not rows:
-            return "error in parsing rows"  # or handle error accordingly
-        header_row = rows[0]
-        print("HEADER ROW: \n\n", header_row)
-        data_rows = rows[1:]
-
-        # ---------------------------------------------------------------------
-        # Define system prompts for the three extraction steps.
-        # ---------------------------------------------------------------------
-        materials_prompt = """
+# System prompts for the three extraction steps.
+MATERIALS_PROMPT = """
         You are an expert construction materials analyst. Your task is to analyze construction material orders and extract standardized information about material type and quantity.
         
         For each line item in the document:
         Identify the material and sub-material from the allowed enumerations. Pay attention to descriptive terms, brand names, and common abbreviations that indicate material types.
         Transfer the original CSV row data into the output under the 'raw_data' field.
+        The first column of every row is its row_id: copy it unchanged into the 'row_id' field (it is not part of 'raw_data').
         Assign confidence scores (0-1) for material classification:
         Material Classification Confidence:
         1.0: Exact match to enumerated material/sub-material
@@ -548,6 +444,7 @@ class Pipe:
         
         {
           "ordered_items": [{
+            "row_id": "integer (copied from the input row)",
             "raw_data": "string",
             "material_classification": {
               "material": "string (one of [Timber, Plastics, Plasterboard, Other Waste, Metals, Glass, Carpet, Concrete or Masonry, not applicable])",
@@ -564,7 +461,7 @@ class Pipe:
         Very important: Respond with ONLY JSON conforming to the schema. Do not include any backticks ("`"), code fences, comments, etc. Only respond with conforming JSON.
         """
 
-        volume_mass_prompt = """
+VOLUME_MASS_PROMPT = """
         You are an expert in material quantity calculations, dimensional analysis, unit conversions, and weight extraction. Your task is to analyze a set of CSV rows representing a construction material order and extract mass (weight) data and/or standardized volume. 
         The input is provided as a list of objects, with each objection containing the raw csv data for that line item as well as a material classification. For each line item, perform the following steps and be as explicit as possible in showing all your calculation steps, assumptions, and conversion details:
         
@@ -585,12 +482,13 @@ class Pipe:
     
         6. DO NOT infer density or weight if it is not explicitly provided. Only return weight values if they are directly given in the data. If no direct weight is provided, mark the weight fields as "Insufficient Data."
     
-        7. Output your result as a JSON object with exactly one field "ordered_items", which is a list of objects. 
+        7. Output your result as a JSON object with exactly one field "ordered_items", which is a list of objects. Copy each input object's row_id unchanged into its output object.
     
         Your response should conform to the following schema:
     
         {
           "ordered_items": [{
+            "row_id": "integer (copied from the input object)",
             "raw_data": "string",
             "volume_mass_data": {
               "total_volume_m3": "number or 'Insufficient Data'",
@@ -620,7 +518,7 @@ class Pipe:
         Very important: Respond with ONLY JSON conforming to the schema. Do not include any backticks ("`"), code fences, comments, etc. Only respond with conforming JSON.
         """
 
-        final_order_prompt = """
+FINAL_ORDER_PROMPT = """
         You are an expert in final order data extraction and mapping. Your task is to take as input a ComboExtraction – a JSON object with a single field "ordered_items", where each item contains:
           • raw_data: the original CSV row data,
           • material_classification: an object with fields "material", "sub_material", and associated confidence details,
@@ -654,6 +552,7 @@ class Pipe:
           • Map only the data that is present; do not force or invent values for any attribute. 
           • Ensure you fill in something meaningful for 'item_name' - do your best to deduce a reasonable item name from the 'raw_data' field
           • If an attribute is missing or cannot be reliably derived from the input ComboExtraction, set its value to "Insufficient Data".
+          • Copy each input item's row_id unchanged into its final order object.
           • Your output must be a JSON object with a single field "ordered_items", which is a list of final order objects exactly matching the schema below.
           • Do not include any extra text, code fences, or formatting. Respond with ONLY valid JSON.
         
@@ -661,6 +560,7 @@ class Pipe:
         
         {
           "ordered_items": [{
+            "row_id": "integer (copied from the input item)",
             "project_id": "string",
             "delivery_date": "string",
             "stage": "string",
@@ -689,137 +589,5027 @@ class Pipe:
         Very important: Respond with ONLY JSON conforming to the schema. Do not include any backticks ("`"), code fences, comments, etc. Only respond with conforming JSON.
         """
 
-        all_extracted_final_items = []
-        batch_size = 20  # Process rows in batches
-        max_retries = 3  # Maximum number of retries for each API call
-        print("Total rows: " + str(len(data_rows)))
-        print("Batch size: " + str(batch_size))
-        # Process each batch of CSV data rows
-        for i in range(0, len(data_rows), batch_size):
-            # Reset retry counter at the beginning of each batch
-            retry_count = 0
-
-            # Create a batch that includes the header row and a subset of data rows.
-            current_batch = [header_row] + data_rows[i : i + batch_size]
-            print(f"Processing batch {i}")
-
-            # ---------------------------
-            # Step 1: Material Classification Extraction
-            # ---------------------------
-            body["messages"] = [
-                {"role": "system", "content": materials_prompt},
-                {
-                    "role": "user",
-                    "content": "Here is the table data: \n" + "\n".join(current_batch),
-                },
-            ]
-            materials_output = await get_validated_response(
-                MaterialsExtraction, "materials"
+
+# Deterministic final order mapping.
+# Most FinalOrder fields are either copied from the combined extraction or read
+# straight out of a CSV column, so they are mapped locally. Column roles are
+# recognised from the header row; only rows missing a field listed in the
+# FINAL_ORDER_LLM_FALLBACK_FIELDS valve are sent to the final order prompt.
+
+INSUFFICIENT_DATA = "Insufficient Data"
+VALIDATION_FAILED = "No response matching the schema within the retry budget"
+
+# FinalOrder field -> header names that identify its column. Fields are matched
+# in this order, so more specific roles (price, total) claim their column before
+# the generic ones (unit, description) can.
+FINAL_ORDER_COLUMN_HINTS = {
+    "price_per_unit": ["price per unit", "unit price", "cost per unit", "rate", "price"],
+    "purchase_cost_total": [
+        "purchase cost total",
+        "total cost",
+        "line total",
+        "total",
+        "amount",
+        "cost",
+    ],
+    "excess_percentage": ["excess %", "% excess", "excess percentage", "excess"],
+    "delivery_date": ["delivery date", "arrival date", "date delivered", "date"],
+    "unit_quantities": [
+        "quantity ordered",
+        "order quantity",
+        "quantity",
+        "qty",
+    ],
+    "unit_measure": ["unit measurement", "unit measure", "uom", "units", "unit"],
+    "trade_provider": ["trade provider", "supplier", "vendor", "merchant", "provider"],
+    "item_name": [
+        "item name",
+        "description of goods",
+        "description",
+        "product",
+        "item",
+        "goods",
+    ],
+    "stage": ["stage"],
+    "project_id": ["project id", "project no", "project number", "job no"],
+    "estimated_destination": ["estimated destination", "destination"],
+}
+
+DATE_FORMATS = ["%d/%m/%Y", "%d/%m/%y", "%Y-%m-%d", "%d-%m-%Y", "%d.%m.%Y", "%d %b %Y"]
+
+
+def normalize_header(name: str) -> str:
+    name = re.sub(r"\(.*?\)", " ", name.lower())
+    return " ".join(re.sub(r"[^a-z0-9%]+", " ", name).split())
+
+
+def parse_csv_row(row: str) -> List[str]:
+    try:
+        return next(csv.reader([row]))
+    except (StopIteration, csv.Error):
+        return [row]
+
+
+def map_header_columns(header_row: str) -> Dict[str, int]:
+    """Returns FinalOrder field -> column index for the columns it can identify."""
+    headers = [normalize_header(h) for h in parse_csv_row(header_row)]
+    column_map: Dict[str, int] = {}
+    # Exact header matches win over partial ones, regardless of field order.
+    for exact in (True, False):
+        for field, hints in FINAL_ORDER_COLUMN_HINTS.items():
+            if field in column_map:
+                continue
+            for hint in hints:
+                matches = [
+                    idx
+                    for idx, header in enumerate(headers)
+                    if idx not in column_map.values()
+                    and header
+                    and (
+                        header == hint
+                        if exact
+                        else re.search(rf"(^|\s){re.escape(hint)}($|\s)", header)
+                    )
+                ]
+                if matches:
+                    column_map[field] = matches[0]
+                    break
+    return column_map
+
+
+def parse_number(value) -> Union[float, None]:
+    if isinstance(value, (int, float)):
+        return float(value)
+    if not isinstance(value, str):
+        return None
+    cleaned = re.sub(r"[$,%\s]|NZD", "", value, flags=re.IGNORECASE)
+    try:
+        return float(cleaned)
+    except ValueError:
+        return None
+
+
+def parse_date(value: str) -> Union[str, None]:
+    value = value.strip()
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format).date().isoformat()
+        except ValueError:
+            continue
+    return None
+
+
+def map_final_order(item: CombinedItem, column_map: Dict[str, int]):
+    """
+    Builds a FinalOrder from a combined extraction item and the row's CSV
+    columns. Returns the order and the names of the fields it could not resolve.
+    """
+    values = parse_csv_row(item.raw_data)
+
+    def column(field: str) -> str:
+        idx = column_map.get(field)
+        if idx is None or idx >= len(values):
+            return ""
+        return values[idx].strip()
+
+    vol_mass = item.volume_mass_data
+    classification = item.material_classification
+    order = {field: INSUFFICIENT_DATA for field in FinalOrder.model_fields}
+    order["row_id"] = item.row_id
+    order.update(
+        material=classification.material,
+        sub_material=classification.sub_material,
+        cubic_m3=vol_mass.total_volume_m3,
+        weight_per_unit=vol_mass.weight_per_unit,
+        total_material_weight=vol_mass.purchase_weight_kg,
+    )
+
+    for field in ("project_id", "stage", "trade_provider", "item_name", "unit_measure"):
+        if column(field):
+            order[field] = column(field)
+    if column("unit_quantities"):
+        order["unit_quantities"] = column("unit_quantities")
+    if column("delivery_date"):
+        order["delivery_date"] = parse_date(column("delivery_date")) or INSUFFICIENT_DATA
+    for field in ("price_per_unit", "purchase_cost_total", "excess_percentage"):
+        number = parse_number(column(field))
+        if number is not None:
+            order[field] = number
+    if column("estimated_destination"):
+        order["estimated_destination"] = column("estimated_destination")
+
+    # Derive the price or the total from the other one and the quantity.
+    quantity = parse_number(order["unit_quantities"])
+    if quantity:
+        if order["price_per_unit"] == INSUFFICIENT_DATA and isinstance(
+            order["purchase_cost_total"], float
+        ):
+            order["price_per_unit"] = round(order["purchase_cost_total"] / quantity, 4)
+        elif order["purchase_cost_total"] == INSUFFICIENT_DATA and isinstance(
+            order["price_per_unit"], float
+        ):
+            order["purchase_cost_total"] = round(order["price_per_unit"] * quantity, 2)
+
+    unresolved = [field for field, value in order.items() if value == INSUFFICIENT_DATA]
+    return FinalOrder(**order), unresolved
+
+
+# Item catalogue index.
+# l_item_details names the items suppliers actually sell, with their
+# sub-material, unit weight (weight_kg) and default_excess_pct. Order lines
+# rarely spell an item exactly as the catalogue does ("GIB BD 3000X1200X13MM
+# STANDARD SH" vs "GIB Standard 13mm 3000x1200"), so items are matched by
+# nearest neighbour over embeddings of their names. The embedding is a hashed
+# bag of character trigrams of the normalized name, weighted by tf-idf over the
+# catalogue and L2 normalized, so cosine similarity is a dot product; it needs
+# no model download and handles the abbreviations, codes and dimensions that
+# order lines are made of. The catalogue's vectors are built once per set of
+# item names and saved under CATALOGUE_INDEX_DIR, and later loads memory-map
+# them. Queries are answered by brute force, a matrix product over the
+# catalogue in chunks.
+
+CATALOGUE_EMBEDDING_BITS = 10  # 1024 dimensions
+CATALOGUE_INDEX_VERSION = f"trigram-{CATALOGUE_EMBEDDING_BITS}-v1"
+CATALOGUE_SEARCH_CHUNK_ROWS = 65536
+CATALOGUE_BUILD_GRACE_SECONDS = 24 * 3600  # earlier builds are kept this long
+CATALOGUE_COLUMNS = ["item_name", "sub_material", "weight_kg", "default_excess_pct"]
+
+
+def item_trigram_counts(names: List[str]) -> np.ndarray:
+    """Hashed character trigram counts of each normalized name."""
+    dimensions = 1 << CATALOGUE_EMBEDDING_BITS
+    counts = np.zeros((len(names), dimensions), dtype=np.float32)
+    for start in range(0, len(names), 4096):
+        texts = [normalize_item_text(str(name)) for name in names[start : start + 4096]]
+        lengths = np.array([len(text) for text in texts])
+        data = np.frombuffer("".join(texts).encode("ascii"), dtype=np.uint8).astype(np.uint64)
+        if len(data) < 3:
+            continue
+        codes = (data[:-2] << np.uint64(16)) | (data[1:-1] << np.uint64(8)) | data[2:]
+        rows = np.repeat(np.arange(len(texts)), lengths)[:-2]
+        offsets = np.arange(len(data) - 2) - np.repeat(np.cumsum(lengths) - lengths, lengths)[:-2]
+        # Trigrams that would run into the next name are dropped
+        valid = offsets <= lengths[rows] - 3
+        # Multiplicative hashing, keeping the top bits of the 32 bit product
+        buckets = ((codes[valid] * np.uint64(2654435761)) & np.uint64(0xFFFFFFFF)) >> np.uint64(
+            32 - CATALOGUE_EMBEDDING_BITS
+        )
+        block = np.bincount(
+            rows[valid] * dimensions + buckets.astype(np.int64),
+            minlength=len(texts) * dimensions,
+        )
+        counts[start : start + len(texts)] = block.reshape(len(texts), dimensions)
+    return counts
+
+
+def weight_item_vectors(counts: np.ndarray, idf: np.ndarray) -> np.ndarray:
+    vectors = np.log1p(counts, out=counts) * idf
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def read_item_catalogue(source: str) -> pd.DataFrame:
+    """
+    Reads the catalogue from a CSV export of l_item_details (item_name,
+    sub_material and optionally weight_kg, default_excess_pct), or from the
+    l_item_details table of a database URL. Names are deduplicated after
+    normalization.
+    """
+    if source.startswith(("sqlite:///", "postgres://", "postgresql://")):
+        connection, _ = connect_database(source)
+        try:
+            cursor = connection.cursor()
+            cursor.execute(
+                "SELECT i.item_name, s.submaterial_name, i.weight_kg, i.default_excess_pct "
+                "FROM l_item_details i "
+                "LEFT JOIN l_submaterials s ON s.submaterial_id = i.submaterial_id"
             )
+            catalogue = pd.DataFrame(cursor.fetchall(), columns=CATALOGUE_COLUMNS)
+        finally:
+            connection.close()
+    elif source and os.path.exists(source):
+        catalogue = pd.read_csv(source, dtype={"item_name": str})
+    else:
+        return pd.DataFrame(columns=CATALOGUE_COLUMNS)
+    for column in CATALOGUE_COLUMNS:
+        if column not in catalogue:
+            catalogue[column] = None
+    catalogue = catalogue[CATALOGUE_COLUMNS].dropna(subset=["item_name"])
+    catalogue["sub_material"] = catalogue["sub_material"].where(
+        catalogue["sub_material"].isin(list(MATERIAL_PAIRS))
+    )
+    for column in ("weight_kg", "default_excess_pct"):
+        catalogue[column] = pd.to_numeric(catalogue[column], errors="coerce")
+    keys = catalogue["item_name"].astype(str).map(lambda name: normalize_item_text(name).strip())
+    catalogue = catalogue[(keys != "") & ~keys.duplicated()]
+    return catalogue.reset_index(drop=True)
 
-            if not materials_output:
-                print(f"Unsuccessfully processed batch {i}")
-                return f"Unsuccessfully processed batch {i}"
 
-            print("Materials Output: \n\n", materials_output.model_dump_json(indent=4))
-            materials_metadata = [
-                mat.material_classification.confidence
-                for mat in materials_output.ordered_items
-            ]
-            # ---------------------------
-            # Step 2: Volume/Mass Extraction
-            # ---------------------------
-            body["messages"] = [
-                {"role": "system", "content": volume_mass_prompt},
-                {
-                    "role": "user",
-                    "content": "Here are the column names (associated with the 'raw_data' attribute): \n"
-                    + header_row
-                    + "\n\nHere is the data: \n"
-                    + materials_output.model_dump_json(indent=4),
-                },
-            ]
-            body["model"] = "o3-mini"
-            # body["model"] = "gpt-4o"
-            vol_mass_output = await get_validated_response(
-                VolumeMassExtraction, "vol/mass"
+def remove_stale_catalogue_builds(index_dir: str, prefix: str, current: str):
+    # Other processes may still have an earlier build of the source mapped, so
+    # builds (and temporary files of interrupted builds) are only removed once
+    # they are CATALOGUE_BUILD_GRACE_SECONDS old.
+    cutoff = time.time() - CATALOGUE_BUILD_GRACE_SECONDS
+    for name in os.listdir(index_dir):
+        path = os.path.join(index_dir, name)
+        if not name.startswith(prefix + "-") or path in (current + ".npy", current + ".idf.npy"):
+            continue
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:  # removed by another process, or still open
+            pass
+
+
+class CatalogueIndex:
+    def __init__(self, source: str, entries: pd.DataFrame, vectors: np.ndarray, idf: np.ndarray):
+        self.source = source
+        self.loaded_at = time.monotonic()
+        self.entries = entries
+        self.vectors = vectors  # memory-mapped, one L2 normalized row per entry
+        self.idf = idf
+        self.build_seconds = None  # set when the vectors had to be built
+        self.excess_by_sub_material = entries.groupby("sub_material")[
+            "default_excess_pct"
+        ].median()
+
+    @classmethod
+    def load(cls, source: str, index_dir: str):
+        """Returns the index for a catalogue source, or None if it has no items."""
+        entries = read_item_catalogue(source)
+        if entries.empty:
+            return None
+        names = entries["item_name"].astype(str).tolist()
+        fingerprint = hashlib.sha256(
+            "\x1f".join([CATALOGUE_INDEX_VERSION] + names).encode()
+        ).hexdigest()[:16]
+        prefix = "catalogue-" + hashlib.sha256(source.encode()).hexdigest()[:8]
+        path = os.path.join(index_dir, f"{prefix}-{fingerprint}")
+        build_seconds = None
+        if not os.path.exists(path + ".npy"):
+            started = time.perf_counter()
+            os.makedirs(index_dir, exist_ok=True)
+            counts = item_trigram_counts(names)
+            document_frequency = (counts > 0).sum(axis=0)
+            idf = (np.log((1 + len(names)) / (1 + document_frequency)) + 1).astype(np.float32)
+            vectors = weight_item_vectors(counts, idf)
+            # Each file is written under a name unique to this build and
+            # renamed into place, so concurrent builds don't write over each
+            # other and a concurrent load never maps a half-written file. The
+            # vectors go last, as their presence marks the build complete.
+            for suffix, array in ((".idf.npy", idf), (".npy", vectors)):
+                temporary = f"{path}.{os.getpid()}-{uuid.uuid4().hex[:8]}.tmp.npy"
+                np.save(temporary, array)
+                os.replace(temporary, path + suffix)
+            remove_stale_catalogue_builds(index_dir, prefix, path)
+            build_seconds = time.perf_counter() - started
+        index = cls(
+            source,
+            entries,
+            np.load(path + ".npy", mmap_mode="r"),
+            np.load(path + ".idf.npy"),
+        )
+        index.build_seconds = build_seconds
+        print(
+            f"Loaded {len(entries)} catalogue items "
+            + (f"(index built in {build_seconds:.2f}s)" if build_seconds else "(memory-mapped)")
+        )
+        return index
+
+    def search(self, names: List[str], k: int = 1):
+        """Returns (entry indices, cosine similarities), both len(names) x k,
+        best match first."""
+        queries = weight_item_vectors(item_trigram_counts(names), self.idf)
+        k = min(k, len(self.entries))
+        best_scores = np.full((len(names), 0), -1.0, dtype=np.float32)
+        best_indices = np.zeros((len(names), 0), dtype=np.int64)
+        for start in range(0, len(self.entries), CATALOGUE_SEARCH_CHUNK_ROWS):
+            chunk = np.asarray(self.vectors[start : start + CATALOGUE_SEARCH_CHUNK_ROWS])
+            scores = queries @ chunk.T
+            if scores.shape[1] > k:
+                top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            else:
+                top = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+            best_scores = np.concatenate(
+                [best_scores, np.take_along_axis(scores, top, axis=1)], axis=1
             )
+            best_indices = np.concatenate([best_indices, top + start], axis=1)
+            order = np.argsort(-best_scores, axis=1, kind="stable")[:, :k]
+            best_scores = np.take_along_axis(best_scores, order, axis=1)
+            best_indices = np.take_along_axis(best_indices, order, axis=1)
+        return best_indices, best_scores
+
+    def match(self, names: List[str], threshold: float) -> pd.DataFrame:
+        """
+        Returns the closest catalogue item for each name, aligned with names:
+        catalogue_item, sub_material, weight_kg, default_excess_pct and
+        similarity. Names whose closest item is below threshold get NaN values.
+        """
+        indices, scores = self.search(names, 1)
+        matched = self.entries.iloc[indices[:, 0]].reset_index(drop=True)
+        matched = matched.rename(columns={"item_name": "catalogue_item"})
+        matched["similarity"] = scores[:, 0]
+        values = ["catalogue_item", "sub_material", "weight_kg", "default_excess_pct"]
+        matched[values] = matched[values].where(matched["similarity"] >= threshold)
+        return matched
 
-            if not vol_mass_output:
-                print(f"Unsuccessfully processed batch {i}")
-                return f"Unsuccessfully processed batch {i}"
 
-            print("Vol/Mass output: \n\n", vol_mass_output.model_dump_json(indent=4))
-            vol_mass_metadata = [
-                VolMassMetadata(
-                    calculation_method=vm.volume_mass_data.calculation_method,
-                    mass_calculation_method=vm.volume_mass_data.mass_calculation_method,
-                    conversion_steps=vm.volume_mass_data.conversion_steps,
-                    confidence=vm.volume_mass_data.confidence,
+# Local rule-based material classification.
+# The material/sub-material vocabulary is closed, and most order lines name
+# their material outright ("Plasterboard 13mm", "HDPE pipe"), so rows are first
+# classified in-process from a keyword/abbreviation index and, when an item
+# catalogue is configured, by the nearest item in the catalogue index. Rows
+# whose confidence clears LOCAL_CLASSIFIER_THRESHOLD skip the materials prompt
+# entirely.
+
+MATERIAL_PAIRS = {
+    "MDF": "Timber",
+    "Timber": "Timber",
+    "Treated": "Timber",
+    "Untreated": "Timber",
+    "Weatherboard": "Timber",
+    "Polystyrene": "Plastics",
+    "Plastic - Hard": "Plastics",
+    "Shrink Wrap (Pallets)": "Plastics",
+    "Building Wrap": "Plastics",
+    "HDPE": "Plastics",
+    "Polyethene": "Plastics",
+    "LDPE": "Plastics",
+    "Plasterboard": "Plasterboard",
+    "Linoleum": "Other Waste",
+    "Cardboard": "Other Waste",
+    "Non-Ferrous": "Metals",
+    "Steel": "Metals",
+    "Metals (mixed) e.g. metal joinery, fittings": "Metals",
+    "Copper (pure)": "Metals",
+    "Cable (copper)": "Metals",
+    "Brass": "Metals",
+    "Aluminium": "Metals",
+    "Glass": "Glass",
+    "Broadloom Carpet": "Carpet",
+    "Carpet Tiles": "Carpet",
+    "Underlay": "Carpet",
+    "Tiles": "Concrete or Masonry",
+    "Fibre Cement (Cladding)": "Concrete or Masonry",
+    "Concrete-based": "Concrete or Masonry",
+    "Clay-based": "Concrete or Masonry",
+    "Ceramic": "Concrete or Masonry",
+    "Rubble": "Concrete or Masonry",
+    "Concrete": "Concrete or Masonry",
+}
+
+# (keywords, sub_material, score). Keywords are matched as whole words/phrases
+# against the normalized item text; the score is the confidence the keyword
+# alone carries, following the scale in the materials prompt (0.9 for standard
+# abbreviations and brand names, 0.8 for clear inference from product type).
+# A sub_material of "not applicable" marks non-material lines (labour, freight).
+# Keywords in AMBIGUOUS_KEYWORDS only carry their group's score when another
+# keyword for the same material also matches.
+MATERIAL_KEYWORDS = [
+    (["mdf", "medium density fibreboard"], "MDF", 0.95),
+    (["weatherboard", "bevelback", "bevel back", "rusticated"], "Weatherboard", 0.9),
+    (["h1 2", "h3 1", "h3 2", "h4", "h5", "treated", "tanalised", "cca"], "Treated", 0.9),
+    (["ut", "untreated", "un treated"], "Untreated", 0.9),
+    (["timber", "pine", "radiata", "rad", "kd", "msg8", "sg8", "framing", "ply", "plywood", "lvl", "glulam", "batten"], "Timber", 0.85),
+    (["polystyrene", "eps", "xps"], "Polystyrene", 0.95),
+    (["pvc", "upvc", "uvpc", "acrylic", "polycarbonate"], "Plastic - Hard", 0.85),
+    (["shrink wrap", "pallet wrap", "stretch wrap"], "Shrink Wrap (Pallets)", 0.95),
+    (["building wrap", "building paper", "thermakraft", "tyvek", "wall wrap", "roof underlay"], "Building Wrap", 0.9),
+    (["hdpe"], "HDPE", 0.95),
+    (["ldpe"], "LDPE", 0.95),
+    (["polythene", "polyethene", "polyethylene", "t thene", "dpc", "dpm", "underslab"], "Polyethene", 0.9),
+    (["plasterboard", "gib", "gyprock", "drywall", "gibboard", "aqualine", "noiseline", "braceline"], "Plasterboard", 0.95),
+    (["linoleum", "lino", "marmoleum", "vinyl flooring"], "Linoleum", 0.9),
+    (["cardboard", "carton"], "Cardboard", 0.9),
+    (["rebar", "reo", "reinforcing", "deformed", "hd10", "hd12", "hd16", "d10", "d12", "steel", "mesh", "colorsteel", "colour steel", "purlin", "roofing iron", "corrugate", "zincalume"], "Steel", 0.9),
+    (["nails", "screws", "bolts", "fixings", "brackets", "hinges", "joist hanger", "tek", "teks", "hardware", "galv"], "Metals (mixed) e.g. metal joinery, fittings", 0.8),
+    (["copper pipe", "copper tube", "copper"], "Copper (pure)", 0.9),
+    (["tps", "cable", "electrical cable", "flex"], "Cable (copper)", 0.85),
+    (["brass"], "Brass", 0.95),
+    (["aluminium", "aluminum", "alum", "alu"], "Aluminium", 0.9),
+    (["non ferrous", "zinc", "lead flashing"], "Non-Ferrous", 0.85),
+    (["glass", "glazing", "igu", "double glazed", "mirror"], "Glass", 0.9),
+    (["carpet tile", "carpet tiles"], "Carpet Tiles", 0.95),
+    (["carpet", "broadloom"], "Broadloom Carpet", 0.85),
+    (["underlay", "carpet underlay"], "Underlay", 0.85),
+    (["tile", "tiles", "tiling"], "Tiles", 0.8),
+    (["fibre cement", "fiber cement", "hardiflex", "harditex", "linea", "stria", "titan board", "james hardie", "villaboard"], "Fibre Cement (Cladding)", 0.9),
+    (["concrete block", "masonry block", "hebel", "aac", "blocks", "besser", "mortar"], "Concrete-based", 0.85),
+    (["brick", "bricks", "clay", "terracotta"], "Clay-based", 0.85),
+    (["ceramic", "porcelain"], "Ceramic", 0.85),
+    (["rubble", "hardfill", "aggregate", "gap20", "gap40", "gap 20", "gap 40", "scoria"], "Rubble", 0.85),
+    (["concrete", "readymix", "ready mix", "cement", "premix"], "Concrete", 0.85),
+    (["labour", "labor", "install", "installation", "freight", "delivery", "cartage", "hire", "charge", "fee", "discount", "subtotal", "gst"], "not applicable", 0.9),
+]
+
+
+# Tokens that also turn up in unrelated item names ("Flex duct", "RAD" for
+# radiator, "UT" as a unit, fly "mesh", "D10" as a size, "Framing inspection"
+# and other service lines). On their own they score AMBIGUOUS_KEYWORD_SCORE,
+# below LOCAL_CLASSIFIER_THRESHOLD, so the row goes to the model instead.
+AMBIGUOUS_KEYWORDS = {"flex", "ut", "kd", "rad", "h4", "d10", "mesh", "framing"}
+AMBIGUOUS_KEYWORD_SCORE = 0.6
+
+
+def normalize_item_text(text: str) -> str:
+    return " " + " ".join(re.sub(r"[^a-z0-9]+", " ", text.lower()).split()) + " "
+
+
+# Catalogue matches below this cosine similarity are not used as evidence
+CATALOGUE_CLASSIFY_CUTOFF = 0.75
+
+
+class MaterialClassifier:
+    def __init__(self, catalogue: Union[CatalogueIndex, None] = None):
+        self.catalogue = catalogue
+        self.keywords = [
+            (f" {' '.join(normalize_item_text(keyword).split())} ", sub_material, score)
+            for keywords, sub_material, score in MATERIAL_KEYWORDS
+            for keyword in keywords
+        ]
+        # Closest catalogue item per item text, filled a batch at a time by
+        # prepare() so that rows don't each search the index on their own
+        self.nearest: Dict[str, tuple] = {}
+
+    def prepare(self, texts: List[str]):
+        """Looks up the closest catalogue items for a batch of item texts."""
+        if self.catalogue is None:
+            return
+        missing = list({text for text in texts if text not in self.nearest})
+        if not missing:
+            return
+        if len(self.nearest) + len(missing) > 100000:
+            self.nearest.clear()
+        indices, scores = self.catalogue.search(missing, 1)
+        for text, idx, score in zip(missing, indices[:, 0], scores[:, 0]):
+            self.nearest[text] = (int(idx), float(score))
+
+    def classify(self, text: str):
+        """
+        Returns (classification, score), or (None, 0) when nothing matched. The
+        score is the classifier's confidence; for "not applicable" lines the
+        classification itself carries a confidence of 0, as the prompt asks.
+        """
+        normalized = normalize_item_text(text)
+        if not normalized.strip():
+            return None, 0.0
+
+        # Keyword evidence: the best score per sub-material, where longer
+        # phrases are slightly more specific than single words. An ambiguous
+        # keyword needs another keyword for the same material to back it.
+        hits = [
+            (keyword.strip(), sub_material, score)
+            for keyword, sub_material, score in self.keywords
+            if keyword in normalized
+        ]
+        keywords_per_material: Dict[str, int] = {}
+        for _, sub_material, _ in hits:
+            material = MATERIAL_PAIRS.get(sub_material, sub_material)
+            keywords_per_material[material] = keywords_per_material.get(material, 0) + 1
+        evidence: Dict[str, float] = {}
+        matched: Dict[str, str] = {}
+        for keyword, sub_material, score in hits:
+            if (
+                keyword in AMBIGUOUS_KEYWORDS
+                and keywords_per_material[MATERIAL_PAIRS.get(sub_material, sub_material)] < 2
+            ):
+                score = AMBIGUOUS_KEYWORD_SCORE
+            score = min(1.0, score + 0.01 * keyword.count(" "))
+            if score > evidence.get(sub_material, 0):
+                evidence[sub_material] = score
+                matched[sub_material] = keyword
+
+        best = None
+        if evidence:
+            ranked = sorted(evidence.items(), key=lambda item: item[1], reverse=True)
+            sub_material, score = ranked[0]
+            # Keywords inside the winning phrase ("tiles" in "carpet tiles")
+            # aren't independent evidence.
+            competitors = [
+                other
+                for other, _ in ranked[1:]
+                if f" {matched[other]} " not in f" {matched[sub_material]} "
+                and (
+                    MATERIAL_PAIRS.get(other) != MATERIAL_PAIRS.get(sub_material)
+                    or "not applicable" in (sub_material, other)
                 )
-                for vm in vol_mass_output.ordered_items
             ]
+            # Treated/untreated markers refine a generic timber match rather
+            # than competing with it.
+            if sub_material == "Timber" and {"Treated", "Untreated"} & set(evidence):
+                sub_material = max(("Treated", "Untreated"), key=lambda s: evidence.get(s, 0))
+                score = evidence[sub_material]
+            # Evidence for a different material lowers confidence.
+            score *= 0.75 ** len(competitors)
+            reasoning = f"Keyword '{matched[sub_material]}' indicates {sub_material}"
+            if competitors:
+                reasoning += f"; conflicting keywords for {', '.join(competitors)}"
+            best = (sub_material, score, reasoning)
 
-            # ---------------------------
-            # Step 3: Combine Extraction Results
-            # ---------------------------
-            try:
-                combined_items = [
-                    CombinedItem(
-                        raw_data=mat_item.raw_data,
-                        volume_mass_data=vol_item.volume_mass_data,
-                        material_classification=mat_item.material_classification,
-                    )
-                    for mat_item, vol_item in zip(
-                        materials_output.ordered_items, vol_mass_output.ordered_items
-                    )
-                ]
-            except (ValidationError, AttributeError, TypeError, IndexError) as e:
-                print(f"Error during combination: {e}")
-                return f"Error during combination: {e}"
-            except Exception as e:
-                print(f"Unexpected error: {e}")
-                return f"Unexpected error: {e}"
-
-            combo_extraction = ComboExtraction(ordered_items=combined_items)
-
-            # ---------------------------
-            # Step 4: Final Order Extraction
-            # ---------------------------
-            body["model"] = "gpt-4o"
-            body["messages"] = [
-                {"role": "system", "content": final_order_prompt},
-                {
-                    "role": "user",
-                    "content": "Here are the column names (associated with the 'raw_data' attribute): \n"
-                    + header_row
-                    + "\n\nHere is the data: \n"
-                    + combo_extraction.model_dump_json(indent=4),
-                },
+        if self.catalogue is not None:
+            self.prepare([text])
+            idx, similarity = self.nearest[text]
+            entry = self.catalogue.entries.iloc[idx]
+            if (
+                similarity >= CATALOGUE_CLASSIFY_CUTOFF
+                and isinstance(entry["sub_material"], str)
+                and (best is None or similarity > best[1])
+            ):
+                best = (
+                    entry["sub_material"],
+                    similarity,
+                    f"Closest catalogue item '{entry['item_name']}' "
+                    f"(similarity {similarity:.2f})",
+                )
+
+        if best is None:
+            return None, 0.0
+        sub_material, score, reasoning = best
+        return MaterialClassification(
+            material=MATERIAL_PAIRS.get(sub_material, "not applicable"),
+            sub_material=sub_material,
+            confidence=Confidence(
+                score=round(0 if sub_material == "not applicable" else score, 3),
+                reasoning=reasoning,
+                assumptions=["Classified locally without an LLM call"],
+            ),
+        ), score
+
+
+# Native dimensional analysis for volume/mass extraction.
+# Order lines usually carry their dimensions in a handful of well known shapes
+# ("100 X 50 (90X45) ... @ 6.000", "12X2400X1200MM", "Rebar HD10 6M",
+# "4000MM X 25M 100M2"), so the volume is computed here with the same rules the
+# volume/mass prompt describes. Rows the parser cannot resolve still go to the
+# LLM.
+
+LENGTH_TO_M = {"mm": 0.001, "cm": 0.01, "m": 1.0}
+WEIGHT_TO_KG = {"kg": 1.0, "kgs": 1.0, "t": 1000.0, "tonne": 1000.0, "tonnes": 1000.0}
+LINEAR_UNITS = {"m", "lm", "l m", "lin m", "mtr", "mtrs", "metre", "metres", "meter", "meters"}
+AREA_UNITS = {"m2", "sqm", "sq m", "m²"}
+VOLUME_UNITS = {"m3", "cum", "cu m", "m³"}
+
+# Industry standard thicknesses (m) used when only an area is known.
+ASSUMED_THICKNESS_M = {
+    "Plasterboard": 0.010,
+    "Fibre Cement (Cladding)": 0.0075,
+    "Building Wrap": 0.0005,
+    "Polyethene": 0.00025,
+    "LDPE": 0.00025,
+    "Polystyrene": 0.05,
+    "Linoleum": 0.0025,
+    "Broadloom Carpet": 0.010,
+    "Carpet Tiles": 0.007,
+    "Underlay": 0.010,
+    "Tiles": 0.010,
+    "Ceramic": 0.010,
+    "Glass": 0.006,
+    "Weatherboard": 0.018,
+}
+
+NUMBER = r"(\d+(?:\.\d+)?)"
+DIMENSIONS_RE = re.compile(
+    rf"(?<![\w.]){NUMBER}\s*(mm|cm|m)?\s*[x×*]\s*{NUMBER}\s*(mm|cm|m)?"
+    rf"(?:\s*[x×*]\s*{NUMBER}\s*(mm|cm|m)?)?(?![\w.])",
+    re.IGNORECASE,
+)
+AT_LENGTH_RE = re.compile(rf"@\s*{NUMBER}(?![\d.])")
+LENGTH_RE = re.compile(rf"(?<![\w.x×*]){NUMBER}\s*(m|mtr|metre|meter)(?![\w²³])", re.IGNORECASE)
+DIAMETER_RE = re.compile(
+    rf"(?:\b(?:h?d|dia\.?|diameter|ø)\s*{NUMBER}\s*(?:mm)?\b|\b{NUMBER}\s*mm\s*(?:dia|diameter)\b)",
+    re.IGNORECASE,
+)
+THICKNESS_RE = re.compile(rf"(?<![\w.x×*]){NUMBER}\s*(mu|micron|um|mm)(?![\w.]|\s*[x×*])", re.IGNORECASE)
+AREA_RE = re.compile(rf"(?<![\w.]){NUMBER}\s*(?:m2|m²|sqm|sq m)(?!\w)", re.IGNORECASE)
+# A bare "t" only counts as tonnes when it isn't part of "T&G" (tongue and groove)
+WEIGHT_RE = re.compile(rf"(?<![\w.]){NUMBER}\s*(kg|kgs|t|tonnes?)(?![\w&])", re.IGNORECASE)
+QUANTITY_RE = re.compile(r"^\s*([\d,]*\.?\d+)\s*([a-zA-Z²³/ ]*?)\s*$")
+
+
+def _fmt(value: float) -> str:
+    return f"{value:.6g}"
+
+
+def parse_quantity(quantity_text: str, unit_text: str):
+    """Returns (quantity, normalized unit) from the quantity and unit cells."""
+    match = QUANTITY_RE.match(quantity_text or "")
+    if not match:
+        return None, ""
+    quantity = float(match.group(1).replace(",", ""))
+    unit = (unit_text or match.group(2) or "").strip().lower().replace(".", "")
+    return quantity, unit
+
+
+def parse_volume_mass(
+    text: str, quantity_text: str, unit_text: str, sub_material: str = ""
+) -> Union[VolumeMassData, None]:
+    """
+    Computes VolumeMassData for an order line from its item text, quantity and
+    unit of measure. Returns None when the line can't be resolved confidently.
+    """
+    quantity, unit = parse_quantity(quantity_text, unit_text)
+    if quantity is None or quantity <= 0:
+        return None
+
+    steps = [f"Quantity {_fmt(quantity)} {unit or '(no unit)'}"]
+    assumptions = []
+    score = 0.9
+
+    # Direct weight: either ordered by weight or a weight per unit in the text.
+    purchase_weight = weight_per_unit = INSUFFICIENT_DATA
+    mass_method = "not available"
+    if unit in WEIGHT_TO_KG:
+        purchase_weight = quantity * WEIGHT_TO_KG[unit]
+        mass_method = "direct_weight"
+        steps.append(f"Ordered by weight: {_fmt(quantity)} {unit} = {_fmt(purchase_weight)} kg")
+    else:
+        # Numbers that are part of the dimensions ("3600 x 1200 T&G") aren't weights
+        weight_match = WEIGHT_RE.search(DIMENSIONS_RE.sub(" ", text))
+        if weight_match:
+            weight_per_unit = float(weight_match.group(1)) * WEIGHT_TO_KG[weight_match.group(2).lower()]
+            purchase_weight = weight_per_unit * quantity
+            mass_method = "direct_weight"
+            steps.append(
+                f"Weight per unit {weight_match.group(0).strip()} = {_fmt(weight_per_unit)} kg; "
+                f"{_fmt(weight_per_unit)} kg × {_fmt(quantity)} = {_fmt(purchase_weight)} kg"
+            )
+
+    volume = None
+    method = ""
+    linear = unit in LINEAR_UNITS
+    if unit in VOLUME_UNITS:
+        volume, method = quantity, "direct volume"
+        steps.append(f"Ordered by volume: {_fmt(quantity)} m³")
+        score = 0.95
+    else:
+        # Prefer the dimensions in parentheses ("100 X 50 (90X45)").
+        dims_match = None
+        for group in re.findall(r"\(([^)]*)\)", text):
+            dims_match = DIMENSIONS_RE.search(group)
+            if dims_match:
+                break
+        dims_match = dims_match or DIMENSIONS_RE.search(text)
+
+        dims = []
+        if dims_match:
+            raw = [
+                (float(dims_match.group(n)), (dims_match.group(n + 1) or "").lower())
+                for n in (1, 3, 5)
+                if dims_match.group(n)
             ]
-            final_order_output = await get_validated_response(
-                FinalOrderExtraction, "final order"
-            )
-            if not final_order_output:
-                print(f"Unsuccessfully processed batch {i}")
-                return f"Unsuccessfully processed batch {i}"
-
-            extended_final_order_output = ExtendedFinalOrderExtraction(
-                ordered_items=[
-                    ExtendedFinalOrder(
-                        **final_order.dict(),
-                        materials_metadata=materials_metadata[idx],
-                        vol_mass_metadata=vol_mass_metadata[idx],
+            # A trailing unit applies to the unitless numbers before it; with no
+            # unit at all, building dimensions are in millimetres.
+            trailing = next((u for _, u in reversed(raw) if u), "")
+            if not trailing:
+                assumptions.append("Dimensions without units are in millimetres")
+                score -= 0.05
+            for value, dim_unit in raw:
+                dim_unit = dim_unit or trailing or "mm"
+                dims.append(value * LENGTH_TO_M[dim_unit])
+                steps.append(f"{_fmt(value)}{dim_unit} = {_fmt(value * LENGTH_TO_M[dim_unit])} m")
+            text_rest = text[: dims_match.start()] + " " + text[dims_match.end() :]
+        else:
+            text_rest = text
+
+        # Piece length: "@ 6.000" or a standalone "6M".
+        length = None
+        at_match = AT_LENGTH_RE.search(text_rest)
+        length_match = LENGTH_RE.search(text_rest)
+        if at_match:
+            length = float(at_match.group(1))
+            steps.append(f"Length @ {at_match.group(1)} = {_fmt(length)} m")
+        elif length_match:
+            length = float(length_match.group(1))
+            steps.append(f"Length {length_match.group(0).strip()} = {_fmt(length)} m")
+
+        area_match = AREA_RE.search(text_rest)
+        is_area = bool(dims) and len(dims) == 2 and any(
+            (dims_match.group(n) or "").lower() == "m" for n in (2, 4)
+        )
+
+        if len(dims) == 3:
+            per_piece = dims[0] * dims[1] * dims[2]
+            if linear:
+                section = sorted(dims)[0] * sorted(dims)[1]
+                volume = section * quantity
+                steps.append(
+                    f"Cross-section {_fmt(sorted(dims)[0])} m × {_fmt(sorted(dims)[1])} m × {_fmt(quantity)} m = {_fmt(volume)} m³"
+                )
+            else:
+                volume = per_piece * quantity
+                steps.append(
+                    f"Volume per piece {' × '.join(_fmt(d) for d in dims)} = {_fmt(per_piece)} m³; "
+                    f"× {_fmt(quantity)} = {_fmt(volume)} m³"
+                )
+            method = "rectangular"
+        elif len(dims) == 2 and not is_area:
+            section = dims[0] * dims[1]
+            steps.append(f"Cross-section {_fmt(dims[0])} m × {_fmt(dims[1])} m = {_fmt(section)} m²")
+            if linear:
+                volume = section * quantity
+                steps.append(f"{_fmt(section)} m² × {_fmt(quantity)} m = {_fmt(volume)} m³")
+            elif length:
+                volume = section * length * quantity
+                steps.append(
+                    f"{_fmt(section)} m² × {_fmt(length)} m × {_fmt(quantity)} = {_fmt(volume)} m³"
+                )
+            if volume is not None:
+                method = "rectangular"
+        elif is_area or area_match or unit in AREA_UNITS:
+            if unit in AREA_UNITS:
+                area = quantity
+                pieces = 1
+            elif linear and dims:
+                # Rolls ordered by the metre: the narrower dimension is the width.
+                area = min(dims) * quantity
+                pieces = 1
+                steps.append(f"Width {_fmt(min(dims))} m × {_fmt(quantity)} m")
+            elif area_match:
+                area = float(area_match.group(1))
+                pieces = quantity
+            else:
+                area = dims[0] * dims[1]
+                pieces = quantity
+            steps.append(f"Area {_fmt(area)} m²")
+            thickness_match = THICKNESS_RE.search(text_rest)
+            if thickness_match:
+                factor = 0.001 if thickness_match.group(2).lower() == "mm" else 0.000001
+                thickness = float(thickness_match.group(1)) * factor
+                steps.append(f"Thickness {thickness_match.group(0).strip()} = {_fmt(thickness)} m")
+            elif sub_material in ASSUMED_THICKNESS_M:
+                thickness = ASSUMED_THICKNESS_M[sub_material]
+                assumptions.append(
+                    f"Assumed a standard {sub_material} thickness of {_fmt(thickness)} m"
+                )
+                steps.append(f"Assumed thickness {_fmt(thickness)} m")
+                score = 0.6
+            else:
+                thickness = None
+            if thickness:
+                volume = area * thickness * pieces
+                steps.append(
+                    f"{_fmt(area)} m² × {_fmt(thickness)} m × {_fmt(pieces)} = {_fmt(volume)} m³"
+                )
+                method = "area with assumed thickness" if score == 0.6 else "area × thickness"
+        else:
+            diameter_match = DIAMETER_RE.search(text_rest)
+            if diameter_match:
+                diameter = float(diameter_match.group(1) or diameter_match.group(2)) * 0.001
+                section = math.pi * (diameter / 2) ** 2
+                steps.append(
+                    f"Diameter {_fmt(diameter)} m; π × ({_fmt(diameter)} m / 2)² = {_fmt(section)} m²"
+                )
+                if linear:
+                    volume = section * quantity
+                    steps.append(f"{_fmt(section)} m² × {_fmt(quantity)} m = {_fmt(volume)} m³")
+                elif length:
+                    volume = section * length * quantity
+                    steps.append(
+                        f"{_fmt(section)} m² × {_fmt(length)} m × {_fmt(quantity)} = {_fmt(volume)} m³"
                     )
-                    for idx, final_order in enumerate(final_order_output.ordered_items)
-                ]
-            )
-            # Append the extracted final order items to the complete list.
-            all_extracted_final_items.extend(extended_final_order_output.ordered_items)
+                if volume is not None:
+                    method = "cylindrical"
+
+    if volume is None and mass_method == "not available":
+        return None
+    return VolumeMassData(
+        total_volume_m3=round(volume, 6) if volume is not None else INSUFFICIENT_DATA,
+        purchase_weight_kg=purchase_weight,
+        weight_per_unit=weight_per_unit,
+        calculation_method=method or "not available",
+        mass_calculation_method=mass_method,
+        conversion_steps=steps,
+        confidence=Confidence(
+            score=round(score, 2),
+            reasoning="Computed locally from the dimensions, quantity and unit in the row",
+            assumptions=assumptions,
+        ),
+    )
+
+
+# Density and weight post-processing.
+# The vol/mass prompt may not infer weights, so most rows come back without
+# one. Once a document's final orders are assembled, every row is joined to its
+# sub-material density and to its closest catalogue item in a single pandas
+# pass. Total weight is the catalogue item's unit weight times the quantity
+# or, failing that, the volume times the density; waste weight applies the
+# row's excess percentage, or the catalogue item's default_excess_pct. Only
+# fields that are still "Insufficient Data" are filled in.
+
+# l_submaterials.density_kg_per_m3, as in Data/Archive/Clean densities.csv
+DEFAULT_DENSITIES_KG_M3 = {
+    "MDF": 700,
+    "Timber": 500,
+    "Treated": 420,
+    "Untreated": 500,
+    "Weatherboard": 480,
+    "Polystyrene": 32,
+    "Plastic - Hard": 1380,
+    "Shrink Wrap (Pallets)": 920,
+    "Building Wrap": 930,
+    "HDPE": 950,
+    "Polyethene": 918,
+    "LDPE": 925,
+    "Plasterboard": 800,
+    "Linoleum": 550,
+    "Cardboard": 690,
+    "Non-Ferrous": 1750,
+    "Steel": 7850,
+    "Metals (mixed) e.g. metal joinery, fittings": 7700,
+    "Copper (pure)": 8960,
+    "Cable (copper)": 8960,
+    "Brass": 8730,
+    "Aluminium": 2700,
+    "Glass": 2500,
+    "Broadloom Carpet": 90,
+    "Carpet Tiles": 450,
+    "Underlay": 100,
+    "Tiles": 2410,
+    "Fibre Cement (Cladding)": 1650,
+    "Concrete-based": 2400,
+    "Clay-based": 1810,
+    "Ceramic": 4000,
+    "Rubble": 1675,
+    "Concrete": 2400,
+}
+
+
+def load_densities(path: str = "") -> pd.DataFrame:
+    """
+    Returns a sub_material -> density_kg_per_m3 frame. A CSV export of
+    l_submaterials (submaterial_name, density_kg_per_m3) or a sheet shaped like
+    Clean densities.csv (Sub-Material, Density) overrides the defaults.
+    """
+    densities = pd.DataFrame(
+        list(DEFAULT_DENSITIES_KG_M3.items()),
+        columns=["sub_material", "density_kg_per_m3"],
+    )
+    if path and os.path.exists(path):
+        loaded = pd.read_csv(path).rename(
+            columns={
+                "submaterial_name": "sub_material",
+                "Sub-Material": "sub_material",
+                "Density": "density_kg_per_m3",
+            }
+        )
+        loaded = loaded[["sub_material", "density_kg_per_m3"]].dropna()
+        loaded["sub_material"] = loaded["sub_material"].astype(str).str.strip()
+        loaded["density_kg_per_m3"] = pd.to_numeric(
+            loaded["density_kg_per_m3"], errors="coerce"
+        )
+        densities = pd.concat([loaded.dropna(), densities]).drop_duplicates(
+            "sub_material"
+        )
+    return densities.reset_index(drop=True)
+
+
+def apply_densities(
+    orders: list,
+    densities: pd.DataFrame,
+    catalogue: Union[CatalogueIndex, None] = None,
+    match_threshold: float = 0.8,
+) -> list:
+    """
+    Fills density, weights and waste weight for a list of FinalOrder models.
+    Catalogue items are only used from match_threshold cosine similarity.
+    """
+    if not orders:
+        return orders
+    frame = pd.DataFrame(
+        {
+            "sub_material": [order.sub_material for order in orders],
+            "density": [order.density for order in orders],
+            "cubic_m3": [order.cubic_m3 for order in orders],
+            "total_material_weight": [order.total_material_weight for order in orders],
+            "weight_per_unit": [order.weight_per_unit for order in orders],
+            "waste_weight": [order.waste_weight for order in orders],
+            "excess_percentage": [order.excess_percentage for order in orders],
+            "unit_quantities": [order.unit_quantities for order in orders],
+        }
+    )
+    numeric = {
+        column: pd.to_numeric(frame[column], errors="coerce")
+        for column in (
+            "density",
+            "cubic_m3",
+            "total_material_weight",
+            "weight_per_unit",
+            "waste_weight",
+            "excess_percentage",
+        )
+    }
+    # Quantities are parsed like the dimension parser reads them ("1,200",
+    # "24 lengths"), once per distinct value
+    quantities = frame["unit_quantities"].astype(str)
+    quantity = pd.to_numeric(
+        quantities.map(
+            {value: parse_quantity(value, "")[0] for value in quantities.unique()}
+        ),
+        errors="coerce",
+    )
+
+    density = numeric["density"].fillna(
+        frame[["sub_material"]]
+        .merge(densities, on="sub_material", how="left")["density_kg_per_m3"]
+    )
+    unit_weight = numeric["weight_per_unit"]
+    excess = numeric["excess_percentage"]
+    if catalogue is not None:
+        matched = catalogue.match([order.item_name for order in orders], match_threshold)
+        unit_weight = unit_weight.fillna(matched["weight_kg"])
+    weight = (
+        numeric["total_material_weight"]
+        .fillna(unit_weight * quantity)
+        .fillna(numeric["cubic_m3"] * density)
+    )
+    weight_per_unit = unit_weight.fillna(weight / quantity.where(quantity > 0))
+
+    # Excess: the row's own percentage, then the matched catalogue item's
+    # default, then the median default for the sub-material.
+    if catalogue is not None:
+        excess = excess.fillna(matched["default_excess_pct"]).fillna(
+            frame["sub_material"].map(catalogue.excess_by_sub_material)
+        )
+    waste_weight = numeric["waste_weight"].fillna(weight * excess / 100)
+
+    updates = pd.DataFrame(
+        {
+            "density": density,
+            "total_material_weight": weight.round(3),
+            "weight_per_unit": weight_per_unit.round(3),
+            "waste_weight": waste_weight.round(3),
+        }
+    )
+    updates = updates.astype(object).where(updates.notna(), INSUFFICIENT_DATA)
+    return [
+        order.model_copy(update=update)
+        for order, update in zip(orders, updates.to_dict("records"))
+    ]
+
+
+# Embodied carbon and logistics emissions.
+# Computed for whole batches of final orders in one pandas pass: carbon factors
+# and densities are joined per sub-material, supplier distances per trade
+# provider, and every r_embodied_carbon / r_logistics_emissions figure is
+# column arithmetic on the joined frame.
+#
+#   material carbon  total weight x carbon factor
+#   waste carbon     waste weight x carbon factor (the excess was made too)
+#   delivery CO2     total weight (t) x delivery km x freight factor
+#   removal CO2      waste weight (t) x removal km x freight factor
+#   logistics carbon delivery CO2 + removal CO2
+
+# Cradle-to-gate (A1-A3) kg CO2e per kg, close to the ICE database's general
+# values for each sub-material
+DEFAULT_CARBON_FACTORS_KG_CO2E_KG = {
+    "MDF": 0.39,
+    "Timber": 0.26,
+    "Treated": 0.26,
+    "Untreated": 0.26,
+    "Weatherboard": 0.26,
+    "Polystyrene": 3.29,
+    "Plastic - Hard": 3.1,
+    "Shrink Wrap (Pallets)": 2.08,
+    "Building Wrap": 2.5,
+    "HDPE": 1.93,
+    "Polyethene": 2.04,
+    "LDPE": 2.08,
+    "Plasterboard": 0.39,
+    "Linoleum": 1.21,
+    "Cardboard": 0.94,
+    "Non-Ferrous": 5.0,
+    "Steel": 1.55,
+    "Metals (mixed) e.g. metal joinery, fittings": 1.9,
+    "Copper (pure)": 2.71,
+    "Cable (copper)": 2.71,
+    "Brass": 2.46,
+    "Aluminium": 13.1,
+    "Glass": 1.44,
+    "Broadloom Carpet": 5.43,
+    "Carpet Tiles": 9.25,
+    "Underlay": 3.0,
+    "Tiles": 0.78,
+    "Fibre Cement (Cladding)": 0.98,
+    "Concrete-based": 0.13,
+    "Clay-based": 0.24,
+    "Ceramic": 0.7,
+    "Rubble": 0.0052,
+    "Concrete": 0.13,
+}
+# "All trucks" freight factor from the Waste and Carbon data report template
+FREIGHT_KG_CO2E_PER_TKM = 0.135
+EMISSION_COLUMNS = [
+    "material",
+    "sub_material",
+    "supplier",
+    "total_material_weight_kg",
+    "waste_weight_kg",
+    "carbon_factor",
+    "material_carbon",
+    "waste_carbon",
+    "delivery_distance_km",
+    "removal_distance_km",
+    "delivery_emissions_co2",
+    "removal_emissions_co2",
+    "logistics_carbon",
+    "total_embodied_carbon",
+]
+
+
+def load_carbon_factors(path: str = "") -> pd.Series:
+    """
+    Returns kg CO2e per kg indexed by sub-material. A CSV with sub_material
+    (or Sub-Material) and carbon_factor columns overrides the defaults.
+    """
+    factors = pd.Series(DEFAULT_CARBON_FACTORS_KG_CO2E_KG, dtype=float)
+    if path and os.path.exists(path):
+        loaded = pd.read_csv(path).rename(columns={"Sub-Material": "sub_material"})
+        loaded = loaded[["sub_material", "carbon_factor"]]
+        loaded["sub_material"] = loaded["sub_material"].astype(str).str.strip()
+        loaded["carbon_factor"] = pd.to_numeric(loaded["carbon_factor"], errors="coerce")
+        loaded = loaded.dropna().set_index("sub_material")["carbon_factor"]
+        factors = pd.concat([loaded, factors])
+        factors = factors[~factors.index.duplicated()]
+    return factors
+
+
+def load_supplier_distances(path: str = "") -> pd.Series:
+    """
+    Returns delivery distances in km indexed by canonical supplier name, from a
+    CSV with supplier_name and delivery_distance_km columns (empty if not
+    configured).
+    """
+    if not path or not os.path.exists(path):
+        return pd.Series(dtype=float)
+    loaded = pd.read_csv(path)
+    distances = pd.to_numeric(loaded["delivery_distance_km"], errors="coerce")
+    distances.index = loaded["supplier_name"].map(canonical_supplier)
+    return distances.dropna()[lambda series: ~series.index.duplicated()]
+
+
+def numeric_column(values: pd.Series) -> pd.Series:
+    # parse_number for a whole column. Plain numbers convert in one call; only
+    # the distinct strings that fail ("$1,234.50", "25%", "12 NZD") go through
+    # the regex.
+    values = values.where(values != INSUFFICIENT_DATA)
+    parsed = pd.to_numeric(values, errors="coerce").astype(float)
+    retry = parsed.isna() & values.notna()
+    if retry.any():
+        failed = values[retry]
+        distinct = pd.Series(failed.unique())
+        cleaned = distinct.astype(str).str.replace(
+            r"[$,%\s]|NZD", "", regex=True, flags=re.IGNORECASE
+        )
+        parsed[retry] = failed.map(
+            dict(zip(distinct, pd.to_numeric(cleaned, errors="coerce")))
+        ).astype(float)
+    return parsed
+
+
+def compute_emissions(
+    orders: list,
+    densities: pd.DataFrame = None,
+    carbon_factors: pd.Series = None,
+    supplier_distances: pd.Series = None,
+    delivery_distance_km: float = 30.0,
+    removal_distance_km: float = 25.0,
+    freight_factor: float = FREIGHT_KG_CO2E_PER_TKM,
+) -> pd.DataFrame:
+    """
+    Returns one row of EMISSION_COLUMNS per final order. orders is a list of
+    FinalOrder models or a frame with the same field names. Weights missing from
+    an order are derived from its volume and sub-material density, as in
+    apply_densities. Without a weight or carbon factor the carbon figures and
+    total are NaN; a missing waste weight counts as no waste.
+    """
+    if densities is None:
+        densities = load_densities()
+    if carbon_factors is None:
+        carbon_factors = load_carbon_factors()
+    if supplier_distances is None:
+        supplier_distances = pd.Series(dtype=float)
+    fields = [
+        "material",
+        "sub_material",
+        "trade_provider",
+        "density",
+        "cubic_m3",
+        "total_material_weight",
+        "waste_weight",
+        "excess_percentage",
+    ]
+    if isinstance(orders, pd.DataFrame):
+        frame = orders[fields].reset_index(drop=True)
+    else:
+        # Model fields live in each instance's __dict__; letting pandas pick
+        # the columns out of those is about twice as fast as getattr per field.
+        frame = pd.DataFrame([vars(order) for order in orders], columns=fields)
+    numeric = {name: numeric_column(frame[name]) for name in fields[3:]}
+    density_by_sub = densities.set_index("sub_material")["density_kg_per_m3"]
+    density_by_sub = density_by_sub[~density_by_sub.index.duplicated()]
+    density = numeric["density"].fillna(frame["sub_material"].map(density_by_sub))
+    weight = numeric["total_material_weight"].fillna(numeric["cubic_m3"] * density)
+    waste = numeric["waste_weight"].fillna(weight * numeric["excess_percentage"] / 100)
+    factor = frame["sub_material"].map(carbon_factors).astype(float)
+
+    supplier = frame["trade_provider"].where(frame["trade_provider"] != INSUFFICIENT_DATA)
+    supplier_keys = supplier.map({name: canonical_supplier(name) for name in supplier.dropna().unique()})
+    delivery_km = supplier_keys.map(supplier_distances).astype(float).fillna(delivery_distance_km)
+    removal_km = pd.Series(float(removal_distance_km), index=frame.index)
+
+    material_carbon = weight * factor
+    waste_carbon = waste * factor
+    delivery_co2 = weight / 1000 * delivery_km * freight_factor
+    removal_co2 = waste / 1000 * removal_km * freight_factor
+    logistics = delivery_co2 + removal_co2.fillna(0)
+    total = material_carbon + waste_carbon.fillna(0) + logistics.fillna(0)
+    return pd.DataFrame(
+        {
+            "material": frame["material"],
+            "sub_material": frame["sub_material"],
+            "supplier": supplier,
+            "total_material_weight_kg": weight,
+            "waste_weight_kg": waste,
+            "carbon_factor": factor,
+            "material_carbon": material_carbon,
+            "waste_carbon": waste_carbon,
+            "delivery_distance_km": delivery_km,
+            "removal_distance_km": removal_km,
+            "delivery_emissions_co2": delivery_co2,
+            "removal_emissions_co2": removal_co2,
+            "logistics_carbon": logistics,
+            "total_embodied_carbon": total,
+        },
+        columns=EMISSION_COLUMNS,
+    )
+
+
+def summarize_embodied_carbon(emissions: pd.DataFrame) -> pd.DataFrame:
+    """Groups compute_emissions output into r_embodied_carbon rows per
+    material and sub-material."""
+    sums = [
+        "total_material_weight_kg",
+        "waste_weight_kg",
+        "material_carbon",
+        "waste_carbon",
+        "logistics_carbon",
+        "total_embodied_carbon",
+    ]
+    grouped = emissions.groupby(["material", "sub_material"], sort=True, dropna=False)
+    summary = grouped[sums].sum(min_count=1)
+    summary.insert(2, "carbon_factor", grouped["carbon_factor"].first())
+    return summary.round(2).reset_index()
+
+
+def summarize_logistics_emissions(emissions: pd.DataFrame) -> pd.DataFrame:
+    """Groups compute_emissions output into r_logistics_emissions rows per
+    material, sub-material and supplier, with weight-averaged distances."""
+    frame = emissions.assign(
+        delivery_tkm=emissions["total_material_weight_kg"] * emissions["delivery_distance_km"],
+        removal_tkm=emissions["waste_weight_kg"] * emissions["removal_distance_km"],
+    )
+    grouped = frame.groupby(["material", "sub_material", "supplier"], sort=True, dropna=False)
+    summary = grouped[
+        [
+            "total_material_weight_kg",
+            "waste_weight_kg",
+            "delivery_tkm",
+            "removal_tkm",
+            "delivery_emissions_co2",
+            "removal_emissions_co2",
+        ]
+    ].sum(min_count=1)
+    summary["delivery_distance_km"] = (
+        (summary.pop("delivery_tkm") / summary["total_material_weight_kg"]).round()
+    )
+    summary["removal_distance_km"] = (
+        (summary.pop("removal_tkm") / summary["waste_weight_kg"]).round()
+    )
+    summary["total_emissions_co2"] = summary["delivery_emissions_co2"].add(
+        summary["removal_emissions_co2"], fill_value=0
+    )
+    columns = [
+        "total_material_weight_kg",
+        "waste_weight_kg",
+        "delivery_distance_km",
+        "removal_distance_km",
+        "delivery_emissions_co2",
+        "removal_emissions_co2",
+        "total_emissions_co2",
+    ]
+    return summary[columns].round(2).reset_index()
+
+
+# Persistent cache of per-row extraction results.
+# Suppliers resend the same catalogue lines on every invoice, so the materials
+# and vol/mass results for a row are cached in SQLite. Keys are a hash of the
+# stage, model, prompt text, normalized header and the normalized parts of the
+# row that the stage depends on; editing a prompt therefore invalidates its
+# entries automatically. Entries expire after a TTL and the least recently used
+# ones are evicted once the cache grows past its size cap.
+
+# Columns that don't affect a stage's result are left out of its cache key so
+# that the same item on a different date or at a different price still hits.
+CACHE_IGNORED_COLUMNS = {
+    "materials": None,  # only the item column is used when it can be found
+    "vol_mass": [
+        "delivery_date",
+        "trade_provider",
+        "price_per_unit",
+        "purchase_cost_total",
+        "excess_percentage",
+        "project_id",
+        "stage",
+        "estimated_destination",
+    ],
+}
+
+
+def normalize_cache_text(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+def cache_row_text(
+    stage: str, row: str, column_map: Dict[str, int], classification=None
+) -> str:
+    # The vol/mass result depends on the row's classification as well as its
+    # text (an assumed sheet thickness, a density), so it is part of the key
+    values = parse_csv_row(row)
+    if stage == "materials" and column_map.get("item_name", len(values)) < len(values):
+        values = [values[column_map["item_name"]]]
+    elif CACHE_IGNORED_COLUMNS.get(stage):
+        ignored = {
+            column_map[field]
+            for field in CACHE_IGNORED_COLUMNS[stage]
+            if field in column_map
+        }
+        values = [value for idx, value in enumerate(values) if idx not in ignored]
+    if classification is not None:
+        values += [classification.material, classification.sub_material]
+    return "|".join(normalize_cache_text(value) for value in values)
+
+
+class ExtractionCache:
+    def __init__(self, path: str, ttl_seconds: float, max_entries: int):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = {}
+        self.misses = {}
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS extraction_cache (
+                key TEXT PRIMARY KEY,
+                stage TEXT NOT NULL,
+                value TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_extraction_cache_last_access "
+            "ON extraction_cache (last_access)"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(stage: str, model: str, prompt: str, header: str, row_text: str) -> str:
+        prompt_version = hashlib.sha256(prompt.encode()).hexdigest()[:16]
+        parts = [stage, model, prompt_version, normalize_cache_text(header), row_text]
+        return hashlib.sha256("\x1f".join(parts).encode()).hexdigest()
+
+    def get_many(self, stage: str, keys: List[str]) -> Dict[str, str]:
+        """Returns key -> cached JSON for the keys that are present and fresh."""
+        if not keys:
+            return {}
+        now = time.time()
+        placeholders = ",".join("?" * len(keys))
+        rows = self._conn.execute(
+            f"SELECT key, value FROM extraction_cache WHERE key IN ({placeholders}) "
+            "AND created_at >= ?",
+            [*keys, now - self.ttl_seconds],
+        ).fetchall()
+        found = dict(rows)
+        if found:
+            self._conn.executemany(
+                "UPDATE extraction_cache SET last_access = ? WHERE key = ?",
+                [(now, key) for key in found],
+            )
+            self._conn.commit()
+        hits = sum(1 for key in keys if key in found)
+        self.hits[stage] = self.hits.get(stage, 0) + hits
+        self.misses[stage] = self.misses.get(stage, 0) + len(keys) - hits
+        return found
+
+    def put_many(self, stage: str, entries: Dict[str, str]):
+        if not entries:
+            return
+        now = time.time()
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO extraction_cache "
+            "(key, stage, value, created_at, last_access) VALUES (?, ?, ?, ?, ?)",
+            [(key, stage, value, now, now) for key, value in entries.items()],
+        )
+        self._evict(now)
+        self._conn.commit()
+
+    def _evict(self, now: float):
+        self._conn.execute(
+            "DELETE FROM extraction_cache WHERE created_at < ?",
+            (now - self.ttl_seconds,),
+        )
+        (count,) = self._conn.execute("SELECT COUNT(*) FROM extraction_cache").fetchone()
+        if count > self.max_entries:
+            self._conn.execute(
+                "DELETE FROM extraction_cache WHERE key IN ("
+                "SELECT key FROM extraction_cache ORDER BY last_access LIMIT ?)",
+                (count - self.max_entries,),
+            )
+
+    def stats(self) -> dict:
+        return {
+            stage: {
+                "hits": self.hits.get(stage, 0),
+                "misses": self.misses.get(stage, 0),
+            }
+            for stage in sorted(set(self.hits) | set(self.misses))
+        }
+
+
+# Single-flight extraction.
+# The cache only helps once a row's result has been stored. While a row is
+# still being extracted, an identical row (later in the same batch, in another
+# batch, or in a concurrent upload of the same docket) waits for that
+# extraction and reuses its result instead of sending its own request. Flights
+# are keyed by stage and cache key, so rows match on the same normalized text
+# the cache uses. The owner of a flight always resolves it, with None when its
+# request failed, and the rows waiting on it are then requested after all.
+
+
+class SingleFlight:
+    def __init__(self):
+        self.pending: Dict[tuple, asyncio.Future] = {}
+
+    def claim(self, key: tuple):
+        # Returns (future, True) when the caller now owns the flight for key,
+        # or (future, False) when another request is already extracting it.
+        loop = asyncio.get_running_loop()
+        future = self.pending.get(key)
+        if future is not None and not future.done() and future.get_loop() is loop:
+            return future, False
+        future = loop.create_future()
+        self.pending[key] = future
+        return future, True
+
+    def resolve(self, key: tuple, future: asyncio.Future, value):
+        if self.pending.get(key) is future:
+            del self.pending[key]
+        if not future.done():
+            future.set_result(value)
+
+
+# Duplicate and near-duplicate documents.
+# The same docket is often uploaded twice, or again later with a few lines
+# changed. Each extracted document is recorded under the sha256 of the uploaded
+# file, along with a MinHash signature over its normalized data rows and its
+# extracted items keyed by row. The hash also covers the site the upload is
+# for (or the uploading user without one). If an upload's hash is already
+# recorded, the stored extraction is returned before any model is called. Otherwise, once the
+# rows are ingested, the signature is matched against earlier documents
+# through LSH bands. When an earlier document's estimated row overlap (Jaccard
+# similarity) reaches NEAR_DUPLICATE_THRESHOLD, rows found in it verbatim get
+# their stored item back and only the other rows go through the extraction
+# steps. Hashes and row keys include the prompt texts, so editing a prompt
+# retires old records, as it does cache entries. Records are kept in the
+# cache's SQLite file for CACHE_TTL_DAYS.
+
+EXTRACTION_PROMPTS_VERSION = hashlib.sha256(
+    "\x1f".join(
+        [
+            CSV_CLEANING_PROMPT,
+            IMAGE_EXTRACTION_PROMPT,
+            MATERIALS_PROMPT,
+            VOLUME_MASS_PROMPT,
+            FINAL_ORDER_PROMPT,
+        ]
+    ).encode()
+).hexdigest()[:16]
+
+# 64 hash functions in 16 bands of 4: two documents sharing 50% of their rows
+# land in a common band about 64% of the time, at 80% over 99.9%
+MINHASH_PERMUTATIONS = 64
+MINHASH_BANDS = 16
+MINHASH_PRIME = (1 << 31) - 1
+MINHASH_A, MINHASH_B = np.random.default_rng(0x3A57E).integers(
+    1, MINHASH_PRIME, size=(2, MINHASH_PERMUTATIONS), dtype=np.uint64
+)
+
+
+def document_fingerprint(file_type: str, content, scope: str) -> str:
+    # content is the CSV text, or the list of page images for images and PDFs.
+    # scope is the site the rows are persisted against (or the user), so an
+    # upload only ever matches earlier uploads for the same site.
+    if not isinstance(content, str):
+        content = json.dumps(content, sort_keys=True)
+    parts = [EXTRACTION_PROMPTS_VERSION, scope, file_type, content]
+    return hashlib.sha256("\x1f".join(parts).encode()).hexdigest()
+
+
+def document_row_key(header: str, row: str) -> str:
+    parts = [EXTRACTION_PROMPTS_VERSION, normalize_cache_text(header), normalize_cache_text(row)]
+    return hashlib.sha256("\x1f".join(parts).encode()).hexdigest()
+
+
+def minhash_signature(row_keys: List[str]) -> np.ndarray:
+    # Row keys are already uniform hashes; each permutation is a*x + b mod p
+    # over their first 32 bits, which fits uint64 arithmetic without overflow
+    if not row_keys:
+        return np.full(MINHASH_PERMUTATIONS, MINHASH_PRIME, dtype=np.uint64)
+    values = np.array([int(key[:8], 16) for key in set(row_keys)], dtype=np.uint64)
+    values %= np.uint64(MINHASH_PRIME)
+    hashed = (MINHASH_A[:, None] * values[None, :] + MINHASH_B[:, None]) % np.uint64(
+        MINHASH_PRIME
+    )
+    return hashed.min(axis=1)
+
+
+def minhash_bands(signature: np.ndarray) -> List[tuple]:
+    rows = MINHASH_PERMUTATIONS // MINHASH_BANDS
+    buckets = []
+    for band in range(MINHASH_BANDS):
+        values = signature[band * rows : (band + 1) * rows].tobytes()
+        buckets.append((band, hashlib.sha256(values).hexdigest()[:16]))
+    return buckets
+
+
+class DocumentIndex:
+    def __init__(self, path: str, ttl_seconds: float):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS extracted_documents (
+                doc_hash TEXT PRIMARY KEY,
+                signature BLOB NOT NULL,
+                output TEXT,
+                created_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS extracted_document_rows (
+                doc_hash TEXT NOT NULL,
+                row_key TEXT NOT NULL,
+                item TEXT NOT NULL,
+                PRIMARY KEY (doc_hash, row_key)
+            );
+            CREATE TABLE IF NOT EXISTS extracted_document_bands (
+                band INTEGER NOT NULL,
+                bucket TEXT NOT NULL,
+                doc_hash TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_extracted_document_bands_bucket
+                ON extracted_document_bands (band, bucket);
+            CREATE INDEX IF NOT EXISTS idx_extracted_document_bands_doc_hash
+                ON extracted_document_bands (doc_hash);
+            CREATE INDEX IF NOT EXISTS idx_extracted_documents_created_at
+                ON extracted_documents (created_at);
+            """
+        )
+        self._conn.commit()
+
+    def get_output(self, doc_hash: str) -> Union[str, None]:
+        """Returns the stored extraction JSON of an identical upload, if any."""
+        found = self._conn.execute(
+            "SELECT output FROM extracted_documents WHERE doc_hash = ? AND created_at >= ?",
+            (doc_hash, time.time() - self.ttl_seconds),
+        ).fetchone()
+        return found[0] if found else None
+
+    def find_similar(self, signature: np.ndarray, threshold: float):
+        """Returns (doc_hash, estimated similarity) of the closest earlier
+        document at or above threshold, or None."""
+        bands = minhash_bands(signature)
+        clauses = " OR ".join(["(b.band = ? AND b.bucket = ?)"] * len(bands))
+        candidates = self._conn.execute(
+            "SELECT DISTINCT d.doc_hash, d.signature FROM extracted_document_bands b "
+            "JOIN extracted_documents d ON d.doc_hash = b.doc_hash "
+            f"WHERE ({clauses}) AND d.created_at >= ?",
+            [value for band in bands for value in band] + [time.time() - self.ttl_seconds],
+        ).fetchall()
+        best = None
+        for doc_hash, stored in candidates:
+            similarity = float(np.mean(np.frombuffer(stored, dtype=np.uint64) == signature))
+            if similarity >= threshold and (best is None or similarity > best[1]):
+                best = (doc_hash, similarity)
+        return best
+
+    def get_items(self, doc_hash: str, row_keys: List[str]) -> Dict[str, str]:
+        """Returns row key -> stored item JSON for the rows doc_hash also had."""
+        wanted = sorted(set(row_keys))
+        found = {}
+        # Chunked to stay under SQLite's bound parameter limit
+        for start in range(0, len(wanted), 500):
+            chunk = wanted[start : start + 500]
+            found.update(
+                self._conn.execute(
+                    "SELECT row_key, item FROM extracted_document_rows WHERE doc_hash = ? "
+                    f"AND row_key IN ({','.join('?' * len(chunk))})",
+                    [doc_hash, *chunk],
+                ).fetchall()
+            )
+        return found
+
+    def put(
+        self,
+        doc_hash: str,
+        signature: np.ndarray,
+        items: Dict[str, str],
+        output: Union[str, None],
+    ):
+        # output is None when some rows failed: the upload is then extracted
+        # again next time, reusing the rows that did succeed
+        now = time.time()
+        self._delete("doc_hash = ?", [doc_hash])
+        self._conn.execute(
+            "INSERT INTO extracted_documents (doc_hash, signature, output, created_at) "
+            "VALUES (?, ?, ?, ?)",
+            (doc_hash, signature.astype(np.uint64).tobytes(), output, now),
+        )
+        self._conn.executemany(
+            "INSERT INTO extracted_document_rows (doc_hash, row_key, item) VALUES (?, ?, ?)",
+            [(doc_hash, key, item) for key, item in items.items()],
+        )
+        self._conn.executemany(
+            "INSERT INTO extracted_document_bands (band, bucket, doc_hash) VALUES (?, ?, ?)",
+            [(band, bucket, doc_hash) for band, bucket in minhash_bands(signature)],
+        )
+        self._delete("created_at < ?", [now - self.ttl_seconds])
+        self._conn.commit()
+
+    def _delete(self, where: str, params: list):
+        selected = f"SELECT doc_hash FROM extracted_documents WHERE {where}"
+        for table in ("extracted_document_rows", "extracted_document_bands"):
+            self._conn.execute(f"DELETE FROM {table} WHERE doc_hash IN ({selected})", params)
+        self._conn.execute(f"DELETE FROM extracted_documents WHERE {where}", params)
+
+
+# Repair of responses that fail schema validation.
+# A response that doesn't validate is usually almost right: wrapped in a
+# markdown code fence, a trailing comma, cut off after the last complete row,
+# or one row whose material isn't spelled quite like one of the allowed values.
+# Instead of paying for the whole batch again, the response is repaired locally
+# and every row that validates is kept; only the rows that can't be recovered
+# are sent back to the model.
+
+CODE_FENCE_RE = re.compile(r"^\s*```[\w-]*[ \t]*\n?|\n?[ \t]*```\s*$")
+TRAILING_COMMA_RE = re.compile(r",\s*([}\]])")
+ORDERED_ITEMS_RE = re.compile(r'"ordered_items"\s*:\s*\[')
+
+
+def parse_json_leniently(text: str):
+    # Tolerates code fences, prose around the JSON object and trailing commas.
+    text = CODE_FENCE_RE.sub("", text.strip())
+    candidates = [text]
+    start, end = text.find("{"), text.rfind("}")
+    if start != -1 and end > start:
+        candidates.append(text[start : end + 1])
+    for candidate in candidates:
+        for attempt in (candidate, TRAILING_COMMA_RE.sub(r"\1", candidate)):
+            try:
+                return json.loads(attempt)
+            except json.JSONDecodeError:
+                continue
+    return None
+
+
+def salvage_json_items(text: str) -> list:
+    # Decodes the ordered_items array one element at a time, keeping every item
+    # up to the first one that doesn't parse (e.g. a truncated response).
+    match = ORDERED_ITEMS_RE.search(text)
+    if not match:
+        return []
+    decoder = json.JSONDecoder()
+    items, pos = [], match.end()
+    while pos < len(text):
+        while pos < len(text) and text[pos] in " \t\r\n,":
+            pos += 1
+        if pos >= len(text) or text[pos] == "]":
+            break
+        try:
+            item, pos = decoder.raw_decode(text, pos)
+        except json.JSONDecodeError:
+            break
+        items.append(item)
+    return items
+
+
+def literal_values(model, loc) -> tuple:
+    # Allowed values of the Literal field at loc, e.g.
+    # ("material_classification", "material") on OrderedItem.
+    annotation = None
+    for name in loc:
+        if not (isinstance(model, type) and issubclass(model, BaseModel)):
+            return ()
+        field = model.model_fields.get(name)
+        if field is None:
+            return ()
+        annotation = model = field.annotation
+    if get_origin(annotation) is not Literal:
+        return ()
+    return get_args(annotation)
+
+
+def snap_literal(value, allowed) -> Union[str, None]:
+    if not isinstance(value, str) or not allowed:
+        return None
+    by_text = {normalize_item_text(option): option for option in allowed}
+    text = normalize_item_text(value)
+    if text in by_text:
+        return by_text[text]
+    matches = difflib.get_close_matches(text, list(by_text), n=1, cutoff=0.75)
+    return by_text[matches[0]] if matches else None
+
+
+def repair_item(item_model, data):
+    # Validates one response item, snapping enum values to the closest allowed
+    # value. Anything other than a bad enum value can't be repaired locally.
+    for _ in range(2):
+        try:
+            return item_model.model_validate(data)
+        except ValidationError as e:
+            errors = e.errors()
+        if not isinstance(data, dict):
+            return None
+        for error in errors:
+            if error["type"] != "literal_error":
+                return None
+            *path, field = error["loc"]
+            parent = data
+            for key in path:
+                parent = parent[key]
+            snapped = snap_literal(error["input"], literal_values(item_model, error["loc"]))
+            if snapped is None:
+                return None
+            parent[field] = snapped
+    return None
+
+
+def repair_response(schema_model, content: str) -> list:
+    # Returns one entry per item found in the response: the validated item, or
+    # None when that item couldn't be recovered.
+    item_model = get_args(schema_model.model_fields["ordered_items"].annotation)[0]
+    data = parse_json_leniently(content)
+    if isinstance(data, dict) and isinstance(data.get("ordered_items"), list):
+        raw_items = data["ordered_items"]
+    elif isinstance(data, list):
+        raw_items = data
+    else:
+        raw_items = salvage_json_items(content)
+    return [repair_item(item_model, raw_item) for raw_item in raw_items]
+
+
+def match_response_items(
+    items: list, row_ids: List[int], row_keys: List[str]
+) -> Dict[int, object]:
+    # Lines response items up with the rows they were requested for: by row_id,
+    # or if the model didn't echo the ids, positionally when the response has
+    # one item per row and otherwise on raw_data.
+    matched = {}
+    positions_by_id = {row_id: pos for pos, row_id in enumerate(row_ids)}
+    for item in items:
+        pos = positions_by_id.get(getattr(item, "row_id", None))
+        if pos is not None and pos not in matched:
+            matched[pos] = item
+    if matched:
+        return matched
+    if len(items) == len(row_keys):
+        return {pos: item for pos, item in enumerate(items) if item is not None}
+    open_rows: Dict[str, List[int]] = {}
+    for pos, key in enumerate(row_keys):
+        open_rows.setdefault(key.strip(), []).append(pos)
+    for item in items:
+        if item is None:
+            continue
+        positions = open_rows.get(str(getattr(item, "raw_data", "")).strip())
+        if positions:
+            matched[positions.pop(0)] = item
+    return matched
+
+
+# CSV ingestion.
+# Uploaded CSVs and the CSV text that comes back from the cleaning prompt or
+# Gemini are read with the csv module (so quoted values can contain commas and
+# newlines) rather than split on line breaks. The delimiter is sniffed, the
+# header is the early row that looks most like column names (anything above it
+# is preamble), and header rows repeated further down (page breaks, stacked
+# tables) start a new section. Sections are merged under one header: the union
+# of their columns, matched by normalized name, in order of first appearance.
+# Gemini extracts images and PDFs one page at a time and its page CSVs are
+# merged the same way; a page whose first row isn't a header (a table continued
+# from the previous page) reuses the previous page's columns.
+
+HEADER_SCAN_ROWS = 15  # rows searched for the header
+CLEAN_CSV_MAX_IRREGULAR = 0.05  # share of ragged/fragment rows a clean CSV may have
+
+
+def read_csv_records(text: str, dialect=csv.excel) -> List[List[str]]:
+    return [
+        record
+        for record in csv.reader(io.StringIO(text), dialect)
+        if any(cell.strip() for cell in record)
+    ]
+
+
+def format_csv_row(values) -> str:
+    # One CSV line per record, so embedded line breaks are collapsed.
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator="").writerow(
+        [" ".join(str(value).split()) for value in values]
+    )
+    return buffer.getvalue()
+
+
+def header_score(record: List[str]) -> float:
+    # Column names are short distinct text cells, ideally ones the final order
+    # mapping recognises; data rows are mostly numbers, dates and repeats.
+    filled = [cell.strip() for cell in record if cell.strip()]
+    if len(filled) < 2:
+        return 0.0
+    text_cells = sum(
+        parse_number(cell) is None and parse_date(cell) is None and len(cell) <= 40
+        for cell in filled
+    )
+    distinct = len({normalize_header(cell) for cell in filled}) / len(filled)
+    known = len(map_header_columns(format_csv_row(record)))
+    return text_cells / len(filled) * distinct + known
+
+
+def merge_tables(tables: List[List[List[str]]]) -> List[List[str]]:
+    columns: List[str] = []
+    column_index: Dict[str, int] = {}
+    merged_rows: List[Dict[int, str]] = []
+    table_map: List[int] = []
+    for rows in tables:
+        if not rows:
+            continue
+        first = rows[0]
+        keys = [normalize_header(cell) or f"#{pos}" for pos, cell in enumerate(first)]
+        is_header = (
+            not columns
+            or any(key in column_index for key in keys)
+            or all(parse_number(cell) is None for cell in first)
+        )
+        if is_header:
+            table_map = []
+            for key, cell in zip(keys, first):
+                if key not in column_index:
+                    column_index[key] = len(columns)
+                    columns.append(cell.strip())
+                table_map.append(column_index[key])
+            rows = rows[1:]
+        for row in rows:
+            merged = {}
+            for pos, cell in enumerate(row):
+                if pos >= len(table_map):
+                    table_map.append(len(columns))
+                    columns.append("")
+                merged[table_map[pos]] = cell
+            merged_rows.append(merged)
+    return [columns] + [
+        [merged.get(pos, "") for pos in range(len(columns))] for merged in merged_rows
+    ]
+
+
+class IngestionError(Exception):
+    """The file could not be read into CSV (Gemini unavailable or failing)."""
+
+
+def merge_page_csvs(pages: List[str]) -> str:
+    records = merge_tables(
+        [read_csv_records(CODE_FENCE_RE.sub("", page.strip())) for page in pages]
+    )
+    return "\n".join(format_csv_row(record) for record in records)
+
+
+def ingest_csv(text: str):
+    """Returns (header_row, data_rows, report) for CSV text.
+
+    report["clean"] is True when the input needs no cleaning: the header is the
+    first row, there is a single header, the item column can be identified and
+    nearly every row has the header's width.
+    """
+    text = CODE_FENCE_RE.sub("", text.strip().lstrip("﻿"))
+    try:
+        dialect = csv.Sniffer().sniff(text[:8192], delimiters=",;\t|")
+    except csv.Error:
+        dialect = csv.excel
+    records = read_csv_records(text, dialect)
+    report = {
+        "delimiter": dialect.delimiter,
+        "records": len(records),
+        "preamble_rows": 0,
+        "header_sections": 0,
+        "irregular_rows": 0,
+        "clean": False,
+    }
+    if not records:
+        return "", [], report
+
+    scores = [header_score(record) for record in records[:HEADER_SCAN_ROWS]]
+    header_idx = max(range(len(scores)), key=lambda idx: (scores[idx], -idx))
+    header = records[header_idx]
+    header_cells = [cell.strip().lower() for cell in header]
+    header_known = len(map_header_columns(format_csv_row(header)))
+
+    # Split into sections wherever the header (or another header as
+    # recognisable as it) shows up again.
+    sections = [[header]]
+    for record in records[header_idx + 1 :]:
+        repeated = [cell.strip().lower() for cell in record] == header_cells or (
+            header_known >= 2
+            and sum(bool(cell.strip()) for cell in record) >= header_known
+            and all(parse_number(cell) is None for cell in record if cell.strip())
+            and all(parse_date(cell) is None for cell in record if cell.strip())
+            and len(map_header_columns(format_csv_row(record))) >= header_known
+        )
+        if repeated:
+            sections.append([record])
+        else:
+            sections[-1].append(record)
+    merged = merge_tables(sections)
+    header_row = format_csv_row(merged[0])
+    data_rows = [format_csv_row(record) for record in merged[1:]]
+
+    irregular = sum(
+        len(record) != len(header) or sum(bool(cell.strip()) for cell in record) < 2
+        for section in sections
+        for record in section[1:]
+    )
+    report.update(
+        {
+            "preamble_rows": header_idx,
+            "header_sections": len(sections),
+            "irregular_rows": irregular,
+            "clean": header_idx == 0
+            and len(sections) == 1
+            and "item_name" in map_header_columns(header_row)
+            and bool(data_rows)
+            and irregular <= CLEAN_CSV_MAX_IRREGULAR * len(data_rows),
+        }
+    )
+    return header_row, data_rows, report
+
+
+# Image pre-processing before vision extraction.
+# Photos and rendered PDF pages arrive as full-size base64 images, and both
+# upload time and Gemini's image tokens grow with pixel count. Each page is
+# decoded once, straightened, cropped to the region that has content on it,
+# downsampled to IMAGE_TARGET_DPI and re-encoded as grayscale PNG or JPEG,
+# whichever is smaller. The original is sent unchanged when Pillow isn't
+# available, when decoding fails or when the result wouldn't be smaller.
+
+DESKEW_MAX_ANGLE = 5.0  # degrees
+INK_THRESHOLD = 200  # grayscale values below this count as content
+ASSUMED_SOURCE_DPI = 300  # for images that don't record their resolution
+
+
+def deskew_angle(gray) -> float:
+    # Text rows and table rules produce the sharpest horizontal projection
+    # profile when the page is level, so the angle whose row sums vary the most
+    # wins. A coarse pass is refined around the best coarse angle.
+    thumb = gray.copy()
+    thumb.thumbnail((800, 800))
+
+    def score(angle: float) -> float:
+        rotated = thumb.rotate(angle, resample=Image.BILINEAR, fillcolor=255)
+        ink = np.asarray(rotated) < INK_THRESHOLD
+        return float(ink.sum(axis=1).var())
+
+    best = max(np.arange(-DESKEW_MAX_ANGLE, DESKEW_MAX_ANGLE + 0.01, 1.0), key=score)
+    best = max(np.arange(best - 0.75, best + 0.76, 0.25), key=score)
+    return float(best)
+
+
+def content_bbox(gray, margin: float = 0.01):
+    # Bounding box of the rows and columns that have content, ignoring specks.
+    ink = np.asarray(gray) < INK_THRESHOLD
+    height, width = ink.shape
+    rows = np.flatnonzero(ink.sum(axis=1) > max(1, width * 0.002))
+    cols = np.flatnonzero(ink.sum(axis=0) > max(1, height * 0.002))
+    if not len(rows) or not len(cols):
+        return None
+    pad_x, pad_y = int(width * margin), int(height * margin)
+    return (
+        max(0, cols[0] - pad_x),
+        max(0, rows[0] - pad_y),
+        min(width, cols[-1] + 1 + pad_x),
+        min(height, rows[-1] + 1 + pad_y),
+    )
+
+
+def preprocess_image(
+    data: str, target_dpi: int = 150, max_dimension: int = 2000, jpeg_quality: int = 80
+):
+    """Returns (base64 data, mime type, stats) for one page image."""
+    started = time.perf_counter()
+    raw = base64.b64decode(data)
+    image = ImageOps.exif_transpose(Image.open(io.BytesIO(raw)))
+    source_dpi = image.info.get("dpi", (ASSUMED_SOURCE_DPI,))[0] or ASSUMED_SOURCE_DPI
+    stats = {"original_bytes": len(raw), "original_size": image.size}
+
+    # Flatten transparency onto white before dropping to grayscale
+    if image.mode in ("RGBA", "LA", "P"):
+        image = image.convert("RGBA")
+        background = Image.new("RGBA", image.size, (255, 255, 255, 255))
+        image = Image.alpha_composite(background, image)
+    gray = image.convert("L")
+
+    angle = deskew_angle(gray)
+    if abs(angle) >= 0.25:
+        gray = gray.rotate(angle, resample=Image.BICUBIC, expand=True, fillcolor=255)
+    bbox = content_bbox(gray)
+    if bbox:
+        gray = gray.crop(bbox)
+
+    scale = min(1.0, target_dpi / float(source_dpi), max_dimension / max(gray.size))
+    if scale < 1.0:
+        gray = gray.resize(
+            (max(1, round(gray.width * scale)), max(1, round(gray.height * scale))),
+            Image.LANCZOS,
+        )
+
+    encoded = []
+    for mime_type, options in (
+        ("image/png", {"format": "PNG", "optimize": True}),
+        ("image/jpeg", {"format": "JPEG", "quality": jpeg_quality, "optimize": True}),
+    ):
+        buffer = io.BytesIO()
+        gray.save(buffer, **options)
+        encoded.append((buffer.getvalue(), mime_type))
+    output, mime_type = min(encoded, key=lambda item: len(item[0]))
+
+    stats.update(
+        {
+            "bytes": len(output),
+            "size": gray.size,
+            "angle": angle,
+            "seconds": time.perf_counter() - started,
+        }
+    )
+    if len(output) >= len(raw):
+        stats["bytes"] = len(raw)
+        return data, None, stats
+    return base64.b64encode(output).decode("ascii"), mime_type, stats
+
+
+# Rate limiting for chat completion calls.
+# Batches run concurrently, so calls are spaced out per model to stay under the
+# provider's requests-per-minute limit for that model.
+
+
+class ModelRateLimiter:
+    def __init__(self, spec: str):
+        # spec is a comma separated list of "model:requests_per_minute" pairs,
+        # e.g. "gpt-4o:60,o3-mini:30". Models not listed are not limited.
+        self.spec = spec
+        self.limits: Dict[str, float] = {}
+        self.invalid_entries: List[str] = []  # recorded on each document's trace
+        for entry in spec.split(","):
+            if ":" not in entry:
+                continue
+            model, rpm = entry.rsplit(":", 1)
+            try:
+                if float(rpm) > 0:
+                    self.limits[model.strip()] = float(rpm)
+            except ValueError:
+                self.invalid_entries.append(entry)
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._next_slot: Dict[str, float] = {}
+
+    async def acquire(self, model: str):
+        rpm = self.limits.get(model)
+        if not rpm:
+            return
+        lock = self._locks.setdefault(model, asyncio.Lock())
+        async with lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot.get(model, now))
+            self._next_slot[model] = slot + 60.0 / rpm
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+# Compact payloads between stages.
+# The vol/mass and final order prompts get the previous stages' output as
+# JSON. Only the fields each prompt reads are sent, as minified JSON: the
+# confidence reasoning, assumptions and conversion steps stay local and are
+# re-attached to the rows after the final order step.
+
+STAGE_INPUT_FIELDS = {
+    "vol/mass": {
+        "row_id": True,
+        "raw_data": True,
+        "material_classification": {"material", "sub_material"},
+    },
+    "final order": {
+        "row_id": True,
+        "raw_data": True,
+        "material_classification": {"material", "sub_material"},
+        "volume_mass_data": {"total_volume_m3", "purchase_weight_kg", "weight_per_unit"},
+    },
+}
+
+
+def encode_stage_payload(stage: str, items: list) -> str:
+    include = STAGE_INPUT_FIELDS[stage]
+    return json.dumps(
+        {"ordered_items": [item.model_dump(include=include) for item in items]},
+        separators=(",", ":"),
+        ensure_ascii=False,
+    )
+
+
+# Token-aware batch sizing.
+# Rows are packed into batches by estimated token count rather than a fixed
+# row count, so short rows share one request and long rows don't overflow the
+# context or get their JSON truncated. Each stage has a per-row token cost on
+# top of the row text (prompt payload plus the structured output it produces)
+# and a token budget for its model. Rows the cache, the local classifier or the
+# dimension parser resolve never reach the model, so each stage's cost is
+# weighted by the share of rows it actually sends. With model routing on, any
+# row of a batch may go to either tier, so a stage's budget is the smaller of
+# its model's and the cheap model's. A stage's budget shrinks when its calls
+# fail or run slower than the target latency, and grows back while they
+# succeed quickly.
+
+# stage -> (model, estimated tokens per row on top of the row text)
+STAGE_TOKEN_COSTS = {
+    "materials": ("gpt-4o", 120),
+    "vol/mass": ("o3-mini", 450),
+    "final order": ("gpt-4o", 550),
+}
+DEFAULT_TOKEN_BUDGET = 10000
+MIN_BUDGET_SCALE = 0.2
+MAX_BUDGET_SCALE = 2.0
+MIN_LLM_SHARE = 0.05
+
+
+def estimate_tokens(text: str) -> int:
+    # Roughly four characters per token for English text and CSV.
+    return len(text) // 4 + 1
+
+
+class AdaptiveBatcher:
+    def __init__(self, spec: str, max_rows: int):
+        # spec is a comma separated list of "model:token_budget" pairs, e.g.
+        # "gpt-4o:12000,o3-mini:10000".
+        self.spec = spec
+        self.max_rows = max(1, max_rows)
+        self.target_seconds = 0.0
+        self.routed_model = ""  # the cheap model, while routing is on
+        self.budgets: Dict[str, int] = {}
+        self.invalid_entries: List[str] = []  # recorded on each document's trace
+        for entry in spec.split(","):
+            if ":" not in entry:
+                continue
+            model, budget = entry.rsplit(":", 1)
+            try:
+                self.budgets[model.strip()] = int(budget)
+            except ValueError:
+                self.invalid_entries.append(entry)
+        self.scale = {stage: 1.0 for stage in STAGE_TOKEN_COSTS}
+        self.llm_share = {stage: 1.0 for stage in STAGE_TOKEN_COSTS}
+        self.calls = {stage: 0 for stage in STAGE_TOKEN_COSTS}
+        self.failures = {stage: 0 for stage in STAGE_TOKEN_COSTS}
+
+    def budget(self, stage: str) -> float:
+        model, _ = STAGE_TOKEN_COSTS[stage]
+        models = [model, self.routed_model] if self.routed_model else [model]
+        return min(
+            self.budgets.get(tier, DEFAULT_TOKEN_BUDGET) for tier in models
+        ) * self.scale[stage]
+
+    def pack(self, row_tokens: List[int], start: int):
+        # Returns (end, binding stage) for the batch of rows starting at start.
+        used = {stage: 0.0 for stage in STAGE_TOKEN_COSTS}
+        end, binding = start, None
+        while end < len(row_tokens) and end - start < self.max_rows:
+            costs = {
+                stage: (row_tokens[end] + overhead) * self.llm_share[stage]
+                for stage, (_, overhead) in STAGE_TOKEN_COSTS.items()
+            }
+            over = [
+                stage
+                for stage in STAGE_TOKEN_COSTS
+                if used[stage] + costs[stage] > self.budget(stage)
+            ]
+            if over and end > start:
+                binding = over[0]
+                break
+            for stage in STAGE_TOKEN_COSTS:
+                used[stage] += costs[stage]
+            end += 1
+        return end, binding or ("max rows" if end - start >= self.max_rows else None)
+
+    def observe(self, stage: str, seconds: float, ok: bool):
+        # Multiplicative decrease on failures and slow calls, slow increase
+        # while calls succeed within the target latency.
+        if stage not in self.scale:
+            return
+        self.calls[stage] += 1
+        if not ok:
+            self.failures[stage] += 1
+            factor = 0.7
+        elif self.target_seconds and seconds > self.target_seconds:
+            factor = 0.85
+        else:
+            factor = 1.05
+        self.scale[stage] = min(
+            MAX_BUDGET_SCALE, max(MIN_BUDGET_SCALE, self.scale[stage] * factor)
+        )
+
+    def observe_share(self, stage: str, sent: int, total: int):
+        if stage in self.llm_share and total:
+            share = 0.7 * self.llm_share[stage] + 0.3 * sent / total
+            self.llm_share[stage] = max(MIN_LLM_SHARE, share)
+
+    def summary(self) -> dict:
+        return {
+            stage: {
+                "budget_tokens": round(self.budget(stage)),
+                "llm_share": round(self.llm_share[stage], 2),
+                "calls": self.calls[stage],
+                "failures": self.failures[stage],
+            }
+            for stage in STAGE_TOKEN_COSTS
+        }
+
+
+# Model routing.
+# Rows that still need a model call are scored for difficulty: how unsure the
+# local classifier is about the line, whether it has dimensions to work from,
+# and how long it is. Rows scoring below ROUTER_DIFFICULTY_THRESHOLD go to the
+# cheaper ROUTER_CHEAP_MODEL and the rest to the step's usual model. A cheap
+# result with a Confidence.score below ROUTER_ESCALATION_CONFIDENCE, or a
+# cheap call that fails outright, is requested again from the strong model.
+
+DIFFICULTY_WEIGHTS = {"classifier": 0.5, "dimensions": 0.3, "length": 0.2}
+DIFFICULTY_LENGTH_TOKENS = 60  # rows at least this long get the full length weight
+
+
+def row_difficulty(text: str, classifier_score: float) -> float:
+    # 0 for short lines the classifier is sure about and that have
+    # dimensions, up to 1 for long lines with neither.
+    has_dimensions = any(
+        regex.search(text) for regex in (DIMENSIONS_RE, LENGTH_RE, AREA_RE, DIAMETER_RE)
+    )
+    return (
+        DIFFICULTY_WEIGHTS["classifier"] * (1 - min(1.0, max(0.0, classifier_score)))
+        + DIFFICULTY_WEIGHTS["dimensions"] * (0.0 if has_dimensions else 1.0)
+        + DIFFICULTY_WEIGHTS["length"]
+        * min(1.0, estimate_tokens(text) / DIFFICULTY_LENGTH_TOKENS)
+    )
+
+
+def result_confidence(item) -> Union[float, None]:
+    # Final orders carry no confidence, so they are never escalated. Neither
+    # are "not applicable" lines, which the prompt has scored 0 by design.
+    classification = getattr(item, "material_classification", None)
+    if classification is not None:
+        if classification.material == "not applicable":
+            return None
+        return classification.confidence.score
+    volume_mass = getattr(item, "volume_mass_data", None)
+    if volume_mass is not None:
+        return volume_mass.confidence.score
+    return None
+
+
+def parse_model_prices(spec: str, invalid_entries: List[str] = None) -> Dict[str, tuple]:
+    # spec is a comma separated list of "model:input/output" USD prices per
+    # million tokens, e.g. "gpt-4o:2.5/10,gpt-4o-mini:0.15/0.6". Entries that
+    # don't parse are skipped and added to invalid_entries.
+    prices = {}
+    for entry in spec.split(","):
+        if ":" not in entry:
+            continue
+        model, price = entry.rsplit(":", 1)
+        try:
+            input_price, output_price = (float(value) for value in price.split("/"))
+            prices[model.strip()] = (input_price, output_price)
+        except ValueError:
+            if invalid_entries is not None:
+                invalid_entries.append(entry)
+    return prices
+
+
+class RoutingStats:
+    def __init__(self):
+        self.calls: Dict[tuple, dict] = {}  # (stage, model) -> call stats
+        self.escalated: Dict[str, int] = {}  # stage -> rows sent to the strong model
+
+    def record_call(
+        self, stage: str, model: str, rows: int, seconds: float, input_tokens: int, output_tokens: int
+    ):
+        stats = self.calls.setdefault(
+            (stage, model),
+            {"calls": 0, "rows": 0, "seconds": [], "input_tokens": 0, "output_tokens": 0},
+        )
+        stats["calls"] += 1
+        stats["rows"] += rows
+        stats["seconds"].append(seconds)
+        stats["input_tokens"] += input_tokens
+        stats["output_tokens"] += output_tokens
+
+    def record_escalation(self, stage: str, rows: int):
+        self.escalated[stage] = self.escalated.get(stage, 0) + rows
+
+    def summary(self, cheap_model: str, prices: Dict[str, tuple]) -> dict:
+        report = {}
+        for (stage, model), stats in sorted(self.calls.items()):
+            input_price, output_price = prices.get(model, (0.0, 0.0))
+            report.setdefault(stage, {})["cheap" if model == cheap_model else "strong"] = {
+                "model": model,
+                "calls": stats["calls"],
+                "rows": stats["rows"],
+                "p50_seconds": round(float(np.percentile(stats["seconds"], 50)), 3),
+                "p95_seconds": round(float(np.percentile(stats["seconds"], 95)), 3),
+                "input_tokens": stats["input_tokens"],
+                "output_tokens": stats["output_tokens"],
+                "cost_usd": round(
+                    (stats["input_tokens"] * input_price + stats["output_tokens"] * output_price)
+                    / 1e6,
+                    4,
+                ),
+            }
+        for stage, rows in self.escalated.items():
+            report.setdefault(stage, {})["escalated_rows"] = rows
+        return report
+
+
+# Persistence to i_materials.
+# Extracted rows can be written straight to i_materials. The foreign keys are
+# resolved in memory: l_submaterials (joined to l_materials), l_units and
+# l_suppliers are read into dicts keyed by normalized name, reused for
+# LOOKUP_CACHE_SECONDS, and every row of the document is resolved against
+# them. The rows are then inserted with one batched statement in a single
+# transaction. PERSIST_DATABASE_URL takes "postgresql://..." (psycopg2) or
+# "sqlite:///path/to/file.db" for a local stand-in with the same tables.
+
+EACH_UNITS = {"ea", "each", "no", "nos", "pc", "pcs", "item", "items", "unit", "units"}
+COMPANY_SUFFIXES = {"ltd", "limited", "inc", "llc", "pty", "co", "company"}
+# Disposal methods are grouped into the r_waste weight columns by name
+DISPOSAL_BUCKETS = [
+    ("cleanfill", ("cleanfill", "clean fill")),
+    ("landfill", ("landfill", "land fill")),
+    ("recycle", ("recycl",)),
+    ("reuse", ("reuse", "re use", "salvage", "repurpos")),
+]
+I_MATERIALS_COLUMNS = [
+    "material_entry_id",
+    "site_id",
+    "submaterial_id",
+    "quantity",
+    "unit_id",
+    "weight_kg",
+    "volume_m3",
+    "cost_per_unit",
+    "total_cost",
+    "supplier_id",
+    "delivery_date",
+    "notes",
+    "arrival_doc_item_name",
+    "arrival_doc_id",
+    "default_waste_pct",
+]
+
+
+def normalize_lookup_name(name) -> str:
+    return " ".join(re.sub(r"[^a-z0-9]+", " ", str(name or "").lower()).split())
+
+
+def canonical_unit(unit) -> str:
+    # "lm", "mtrs" and "metres" all resolve to the same l_units row as "m"
+    unit = str(unit or "").strip().lower().replace(".", "")
+    if unit in LINEAR_UNITS:
+        return "m"
+    if unit in AREA_UNITS:
+        return "m2"
+    if unit in VOLUME_UNITS:
+        return "m3"
+    if unit in EACH_UNITS:
+        return "ea"
+    if unit in WEIGHT_TO_KG:
+        return "kg" if WEIGHT_TO_KG[unit] == 1.0 else "t"
+    return normalize_lookup_name(unit)
+
+
+def canonical_supplier(name) -> str:
+    words = normalize_lookup_name(name).split()
+    while len(words) > 1 and words[-1] in COMPANY_SUFFIXES:
+        words.pop()
+    return " ".join(words)
+
+
+def disposal_bucket(method_name) -> Union[str, None]:
+    name = normalize_lookup_name(method_name)
+    for bucket, keywords in DISPOSAL_BUCKETS:
+        if any(keyword in name for keyword in keywords):
+            return bucket
+    return None
+
+
+def connect_database(url: str):
+    """Returns (connection, parameter placeholder) for a database URL."""
+    if url.startswith("sqlite:///"):
+        return sqlite3.connect(url[len("sqlite:///") :]), "?"
+    if url.startswith(("postgres://", "postgresql://")):
+        if psycopg2 is None:
+            raise RuntimeError("psycopg2 is required to write to PostgreSQL")
+        return psycopg2.connect(url), "%s"
+    raise ValueError(f"Unsupported database URL: {url}")
+
+
+class LookupTables:
+    def __init__(self, url: str):
+        self.url = url
+        self.loaded_at = time.monotonic()
+        self.submaterials: Dict[tuple, str] = {}  # (material, sub-material) -> id
+        self.submaterials_by_name: Dict[str, set] = {}  # sub-material -> ids
+        self.material_of: Dict[str, str] = {}  # sub-material id -> material id
+        self.units: Dict[str, str] = {}
+        self.suppliers: Dict[str, str] = {}
+        self.disposal_buckets: Dict[str, str] = {}  # disposal method id -> bucket
+
+    @classmethod
+    def load(cls, connection, url: str):
+        tables = cls(url)
+        cursor = connection.cursor()
+        cursor.execute(
+            "SELECT m.material_name, s.submaterial_name, s.submaterial_id, s.material_id "
+            "FROM l_submaterials s JOIN l_materials m ON m.material_id = s.material_id"
+        )
+        for material, sub_material, submaterial_id, material_id in cursor.fetchall():
+            tables.material_of[str(submaterial_id)] = str(material_id)
+            sub_material = normalize_lookup_name(sub_material)
+            tables.submaterials[(normalize_lookup_name(material), sub_material)] = str(
+                submaterial_id
+            )
+            tables.submaterials_by_name.setdefault(sub_material, set()).add(
+                str(submaterial_id)
+            )
+        cursor.execute("SELECT unit_name, unit_id FROM l_units")
+        for name, unit_id in cursor.fetchall():
+            tables.units.setdefault(canonical_unit(name), str(unit_id))
+        cursor.execute("SELECT supplier_name, supplier_id FROM l_suppliers")
+        for name, supplier_id in cursor.fetchall():
+            tables.suppliers.setdefault(canonical_supplier(name), str(supplier_id))
+        cursor.execute("SELECT disposal_method_name, disposal_method_id FROM l_disposal_methods")
+        for name, disposal_method_id in cursor.fetchall():
+            bucket = disposal_bucket(name)
+            if bucket:
+                tables.disposal_buckets[str(disposal_method_id)] = bucket
+        return tables
+
+    def submaterial_id(self, material: str, sub_material: str) -> Union[str, None]:
+        sub_material = normalize_lookup_name(sub_material)
+        found = self.submaterials.get((normalize_lookup_name(material), sub_material))
+        if found is None:
+            # A sub-material name that is unique across materials is enough
+            ids = self.submaterials_by_name.get(sub_material, ())
+            found = next(iter(ids)) if len(ids) == 1 else None
+        return found
+
+    def unit_id(self, unit: str) -> Union[str, None]:
+        return self.units.get(canonical_unit(unit))
+
+    def supplier_id(self, name: str) -> Union[str, None]:
+        return self.suppliers.get(canonical_supplier(name))
+
+
+def build_material_rows(
+    orders: List[FinalOrder], lookups: LookupTables, site_id: str, arrival_doc_id: str = None
+):
+    """
+    Resolves final orders to i_materials rows (in I_MATERIALS_COLUMNS order).
+    Returns the rows and the number of unresolved values per lookup. Rows go in
+    with is_valid left false, so anything unresolved is listed in notes for
+    review rather than holding the document back.
+    """
+    # Documents repeat the same suppliers, units and sub-materials on most
+    # lines, so each distinct value is resolved once.
+    resolved: Dict[tuple, Union[str, None]] = {}
+
+    def resolve(kind: str, *values):
+        key = (kind,) + values
+        if key not in resolved:
+            if kind == "sub-material":
+                resolved[key] = lookups.submaterial_id(*values)
+            elif kind == "unit":
+                resolved[key] = lookups.unit_id(*values)
+            else:
+                resolved[key] = lookups.supplier_id(*values)
+        return resolved[key]
+
+    def numeric(value):
+        number = parse_number(value)
+        return round(number, 2) if number is not None and math.isfinite(number) else None
+
+    def known(value) -> bool:
+        return bool(value) and value not in (INSUFFICIENT_DATA, "not applicable")
+
+    def quantity_of(value):
+        # Read the way apply_densities reads it ("1,200", "24 lengths"), so the
+        # stored quantity is the one the weights were computed from
+        number = parse_quantity(str(value), "")[0]
+        return round(number, 2) if number is not None else numeric(value)
+
+    rows = []
+    unresolved = {"sub-material": 0, "unit": 0, "supplier": 0, "quantity": 0}
+    for order in orders:
+        notes = []
+        lookups_for_row = {
+            "sub-material": (order.material, order.sub_material),
+            "unit": (order.unit_measure,),
+            "supplier": (order.trade_provider,),
+        }
+        ids = {}
+        for kind, values in lookups_for_row.items():
+            ids[kind] = resolve(kind, *values) if known(values[-1]) else None
+            if ids[kind] is None and known(values[-1]):
+                unresolved[kind] += 1
+                notes.append(f"{kind} {values[-1]!r} not found")
+        quantity = quantity_of(order.unit_quantities)
+        if quantity is None:
+            unresolved["quantity"] += 1
+            notes.append(f"quantity {order.unit_quantities!r} not numeric")
+        delivery_date = (
+            parse_date(order.delivery_date) if known(order.delivery_date) else None
+        )
+        rows.append(
+            (
+                str(uuid.uuid4()),
+                site_id,
+                ids["sub-material"],
+                quantity if quantity is not None else 0,
+                ids["unit"],
+                numeric(order.total_material_weight),
+                numeric(order.cubic_m3),
+                numeric(order.price_per_unit),
+                numeric(order.purchase_cost_total),
+                ids["supplier"],
+                delivery_date,
+                "; ".join(notes) or None,
+                order.item_name if known(order.item_name) else None,
+                arrival_doc_id,
+                numeric(order.excess_percentage),
+            )
+        )
+    return rows, unresolved
+
+
+def insert_material_rows(connection, placeholder: str, rows: List[tuple]):
+    # One statement for the whole document. The caller owns the transaction.
+    columns = ", ".join(I_MATERIALS_COLUMNS)
+    cursor = connection.cursor()
+    if placeholder == "%s":
+        execute_values(
+            cursor, f"INSERT INTO i_materials ({columns}) VALUES %s", rows, page_size=1000
+        )
+    else:
+        values = ", ".join([placeholder] * len(I_MATERIALS_COLUMNS))
+        cursor.executemany(f"INSERT INTO i_materials ({columns}) VALUES ({values})", rows)
+
+
+# Report aggregation.
+# The r_* report tables are derived from running totals in r_aggregate_totals,
+# keyed by site, sub-material and month. A new document only adds its own rows
+# to those totals; the report rows of the sites and months it touched are then
+# rewritten from the totals, which costs the same however much history a site
+# has. rebuild_reports recomputes everything from i_materials and
+# i_resource_removal, for backfills or after rows are edited or deleted.
+#
+# Undated rows are totalled under year 0. Each site and sub-material also has
+# an all-time row under ALL_TIME, so a site refresh reads one row per
+# sub-material instead of its whole monthly history.
+#
+# On PostgreSQL, documents for the same site are applied one at a time: the
+# refresh deletes and rewrites a site's report rows from its totals, and two
+# transactions doing so concurrently would each miss the other's uncommitted
+# totals. apply takes a transaction-level advisory lock per site and per month
+# it refreshes, in sorted order; rebuild_reports locks r_aggregate_totals
+# against concurrent applies. SQLite serializes writers by itself. The tables
+# come from report_aggregates_migration.sql.
+
+AGGREGATE_KEY = ["site_id", "submaterial_id", "year_num", "month_num"]
+AGGREGATE_SUMS = [
+    "material_rows",
+    "weight_kg",
+    "volume_m3",
+    "total_cost",
+    "excess_pct_sum",
+    "excess_pct_rows",
+    "removal_rows",
+    "waste_weight_kg",
+    "waste_volume_m3",
+    "waste_value",
+    "removal_cost",
+    "landfill_weight",
+    "cleanfill_weight",
+    "recycle_weight",
+    "reuse_weight",
+]
+# Columns read from each source table, in the order add_materials and
+# add_removals expect them
+MATERIAL_AGGREGATE_COLUMNS = [
+    "site_id",
+    "submaterial_id",
+    "delivery_date",
+    "weight_kg",
+    "volume_m3",
+    "total_cost",
+    "default_waste_pct",
+]
+REMOVAL_AGGREGATE_COLUMNS = [
+    "site_id",
+    "submaterial_id",
+    "removal_date",
+    "waste_weight_kg",
+    "waste_volume_m3",
+    "appx_resource_value",
+    "removal_cost",
+    "disposal_method_id",
+]
+ALL_TIME = (-1, 0)  # (year_num, month_num) of the all-time totals
+DIVERTED_BUCKETS = ("recycle", "reuse")  # cleanfill counts as disposal
+REPORT_TABLES = [
+    "r_aggregate_totals",
+    "r_materials",
+    "r_waste",
+    "r_waste_summary",
+    "r_embodied_carbon",
+    "r_diversion_pct_by_month",
+    "r_removal_by_month_and_method",
+]
+
+
+def require_report_tables(connection, placeholder: str):
+    # Fails before anything is written when the migration hasn't been applied
+    cursor = connection.cursor()
+    if placeholder == "%s":
+        cursor.execute("SELECT to_regclass('r_aggregate_totals')")
+    else:
+        cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'r_aggregate_totals'"
+        )
+    row = cursor.fetchone()
+    if row is None or row[0] is None:
+        raise RuntimeError(
+            "r_aggregate_totals is missing: apply report_aggregates_migration.sql and run "
+            "rebuild_reports, or turn REPORTS_ENABLED off"
+        )
+
+
+def month_of(value) -> tuple:
+    # (year, month) of a date, date string or None; undated rows go to (0, 0)
+    if value is None:
+        return 0, 0
+    if hasattr(value, "year"):
+        return value.year, value.month
+    try:
+        return int(str(value)[:4]), int(str(value)[5:7])
+    except ValueError:
+        return 0, 0
+
+
+def as_float(value) -> float:
+    return float(value) if value is not None else 0.0
+
+
+def percentage(part: float, whole: float) -> Union[float, None]:
+    return round(100 * part / whole, 2) if whole else None
+
+
+class ReportAggregator:
+    """
+    Collects the totals of new i_materials / i_resource_removal rows and applies
+    them to the report tables. carbon_factors maps sub-material ids to kg CO2e
+    per kg (see carbon_factors_by_id); sub-materials without one get
+    r_embodied_carbon rows with weights only.
+
+    Logistics emissions need delivery distances, which i_materials does not
+    record, so they are added from compute_emissions output (add_logistics)
+    straight into r_logistics_emissions, one row per site, sub-material and
+    supplier. Weights and CO2 are summed; the distances are the weight-averaged
+    ones implied by them. rebuild_reports leaves that table alone, and
+    r_embodied_carbon.logistics_carbon is its total per sub-material.
+    """
+
+    def __init__(
+        self,
+        lookups: LookupTables,
+        carbon_factors: Dict[str, float] = None,
+        freight_factor: float = FREIGHT_KG_CO2E_PER_TKM,
+    ):
+        self.lookups = lookups
+        self.carbon_factors = carbon_factors or {}
+        self.freight_factor = freight_factor
+        self.totals: Dict[tuple, List[float]] = {}
+        self.removal_by_method: Dict[tuple, float] = {}  # (year, month, method) -> kg
+        # (site, sub-material, supplier) -> [weight, waste, delivery CO2, removal CO2]
+        self.logistics: Dict[tuple, List[float]] = {}
+        self.unattributed_rows = 0  # rows without a known sub-material
+
+    def _totals(self, site_id, submaterial_id, when) -> Union[List[float], None]:
+        submaterial_id = str(submaterial_id) if submaterial_id else None
+        if not site_id or submaterial_id not in self.lookups.material_of:
+            self.unattributed_rows += 1
+            return None
+        key = (str(site_id), submaterial_id) + month_of(when)
+        if key not in self.totals:
+            self.totals[key] = [0.0] * len(AGGREGATE_SUMS)
+        return self.totals[key]
+
+    def add_materials(self, rows):
+        # rows in MATERIAL_AGGREGATE_COLUMNS order
+        for site_id, submaterial_id, when, weight, volume, cost, excess in rows:
+            totals = self._totals(site_id, submaterial_id, when)
+            if totals is None:
+                continue
+            totals[0] += 1
+            totals[1] += as_float(weight)
+            totals[2] += as_float(volume)
+            totals[3] += as_float(cost)
+            if excess is not None:
+                totals[4] += float(excess)
+                totals[5] += 1
+
+    def add_removals(self, rows):
+        # rows in REMOVAL_AGGREGATE_COLUMNS order
+        buckets = {name: AGGREGATE_SUMS.index(f"{name}_weight") for name, _ in DISPOSAL_BUCKETS}
+        for site_id, submaterial_id, when, weight, volume, value, cost, method in rows:
+            totals = self._totals(site_id, submaterial_id, when)
+            if totals is None:
+                continue
+            weight = as_float(weight)
+            totals[6] += 1
+            totals[7] += weight
+            totals[8] += as_float(volume)
+            totals[9] += as_float(value)
+            totals[10] += as_float(cost)
+            bucket = self.lookups.disposal_buckets.get(str(method)) if method else None
+            if bucket:
+                totals[buckets[bucket]] += weight
+            year, month = month_of(when)
+            if method and year:
+                key = (year, month, str(method))
+                self.removal_by_method[key] = self.removal_by_method.get(key, 0.0) + weight
+
+    def add_logistics(self, rows):
+        # rows of (site_id, submaterial_id, supplier, weight_kg, waste_kg,
+        # delivery CO2, removal CO2); rows without a weight carry no emissions
+        for site_id, submaterial_id, supplier, weight, waste, delivery, removal in rows:
+            submaterial_id = str(submaterial_id) if submaterial_id else None
+            if not site_id or submaterial_id not in self.lookups.material_of:
+                continue
+            if weight is None or not math.isfinite(weight):
+                continue
+            supplier = supplier.strip()[:100] or None if isinstance(supplier, str) else None
+            totals = self.logistics.setdefault(
+                (str(site_id), submaterial_id, supplier), [0.0] * 4
+            )
+            for i, value in enumerate((weight, waste, delivery, removal)):
+                if value is not None and math.isfinite(value):
+                    totals[i] += value
+
+    def apply(self, connection, placeholder: str) -> dict:
+        """Adds the collected totals and refreshes the report rows they touch.
+        Runs in the caller's transaction."""
+        q = placeholder
+        cursor = connection.cursor()
+        columns = AGGREGATE_KEY + ["material_id"] + AGGREGATE_SUMS
+        updates = ", ".join(
+            f"{name} = r_aggregate_totals.{name} + excluded.{name}" for name in AGGREGATE_SUMS
+        )
+        totals = dict(self.totals)
+        for key, month_totals in self.totals.items():
+            all_time = totals.setdefault(key[:2] + ALL_TIME, [0.0] * len(AGGREGATE_SUMS))
+            for i, value in enumerate(month_totals):
+                all_time[i] += value
+        sites = sorted({key[0] for key in self.totals} | {key[0] for key in self.logistics})
+        months = sorted({key[2:] for key in self.totals if key[2]})
+        if q == "%s":
+            for site_id in sites:
+                cursor.execute(
+                    "SELECT pg_advisory_xact_lock(hashtext('r_aggregate_totals'), hashtext(%s))",
+                    (site_id,),
+                )
+            for year, month in months:
+                cursor.execute(
+                    "SELECT pg_advisory_xact_lock(hashtext('r_diversion_pct_by_month'), %s)",
+                    (year * 100 + month,),
+                )
+        cursor.executemany(
+            f"INSERT INTO r_aggregate_totals ({', '.join(columns)}) "
+            f"VALUES ({', '.join([q] * len(columns))}) "
+            f"ON CONFLICT ({', '.join(AGGREGATE_KEY)}) DO UPDATE SET {updates}",
+            [
+                key + (self.lookups.material_of[key[1]],) + tuple(sums)
+                for key, sums in totals.items()
+            ],
+        )
+        for (year, month, method), weight in sorted(self.removal_by_method.items()):
+            cursor.execute(
+                "UPDATE r_removal_by_month_and_method SET mass_kg = mass_kg + "
+                f"{q} WHERE year_num = {q} AND month_num = {q} AND disposal_method_id = {q}",
+                (weight, year, month, method),
+            )
+            if cursor.rowcount == 0:
+                cursor.execute(
+                    "INSERT INTO r_removal_by_month_and_method "
+                    f"(year_num, month_num, disposal_method_id, mass_kg) VALUES ({q}, {q}, {q}, {q})",
+                    (year, month, method, weight),
+                )
+        self._add_logistics(cursor, q)
+        if sites:
+            self._refresh_sites(cursor, q, sites)
+        if months:
+            self._refresh_months(cursor, q, months)
+        return {
+            "sites": len(sites),
+            "months": len(months),
+            "totals_rows": len(totals),
+            "unattributed_rows": self.unattributed_rows,
+        }
+
+    def _add_logistics(self, cursor, q: str):
+        def distance(co2: float, weight_kg: float):
+            # The weight-averaged distance that produced co2
+            if not weight_kg or not self.freight_factor:
+                return None
+            return round(co2 / (weight_kg / 1000 * self.freight_factor))
+
+        for (site_id, submaterial_id, supplier), added in sorted(
+            self.logistics.items(), key=lambda item: (item[0][:2], item[0][2] or "")
+        ):
+            cursor.execute(
+                "SELECT logistics_report_id, total_material_weight_kg, waste_weight_kg, "
+                "delivery_emissions_co2, removal_emissions_co2 FROM r_logistics_emissions "
+                f"WHERE site_id = {q} AND submaterial_id = {q} AND COALESCE(supplier, '') = {q}",
+                (site_id, submaterial_id, supplier or ""),
+            )
+            existing = cursor.fetchone()
+            weight, waste, delivery, removal = (
+                value + (as_float(existing[i + 1]) if existing else 0.0)
+                for i, value in enumerate(added)
+            )
+            values = (
+                round(weight, 2),
+                round(waste, 2),
+                distance(delivery, weight),
+                distance(removal, waste),
+                round(delivery, 2),
+                round(removal, 2),
+                round(delivery + removal, 2),
+            )
+            columns = (
+                "total_material_weight_kg, waste_weight_kg, delivery_distance_km, "
+                "removal_distance_km, delivery_emissions_co2, removal_emissions_co2, "
+                "total_emissions_co2"
+            )
+            if existing:
+                assignments = ", ".join(f"{name} = {q}" for name in columns.split(", "))
+                cursor.execute(
+                    f"UPDATE r_logistics_emissions SET {assignments} "
+                    f"WHERE logistics_report_id = {q}",
+                    values + (existing[0],),
+                )
+            else:
+                cursor.execute(
+                    "INSERT INTO r_logistics_emissions (logistics_report_id, site_id, "
+                    f"material_id, submaterial_id, supplier, {columns}) "
+                    f"VALUES ({', '.join([q] * 12)})",
+                    (
+                        str(uuid.uuid4()),
+                        site_id,
+                        self.lookups.material_of[submaterial_id],
+                        submaterial_id,
+                        supplier,
+                    )
+                    + values,
+                )
+
+    def _refresh_sites(self, cursor, q: str, sites: List[str]):
+        in_sites = ", ".join([q] * len(sites))
+        cursor.execute(
+            f"SELECT site_id, project_cost, floor_area_m_2 FROM i_sites WHERE site_id IN ({in_sites})",
+            sites,
+        )
+        site_details = {str(row[0]): (row[1], row[2]) for row in cursor.fetchall()}
+        cursor.execute(
+            f"SELECT site_id, material_id, submaterial_id, {', '.join(AGGREGATE_SUMS)} "
+            f"FROM r_aggregate_totals WHERE site_id IN ({in_sites}) "
+            f"AND year_num = {q} AND month_num = {q}",
+            sites + list(ALL_TIME),
+        )
+        by_submaterial = {
+            (str(row[0]), str(row[1]), str(row[2])): [as_float(value) for value in row[3:]]
+            for row in cursor.fetchall()
+        }
+        cursor.execute(
+            "SELECT site_id, submaterial_id, SUM(total_emissions_co2) FROM r_logistics_emissions "
+            f"WHERE site_id IN ({in_sites}) GROUP BY site_id, submaterial_id",
+            sites,
+        )
+        logistics = {(str(row[0]), str(row[1])): as_float(row[2]) for row in cursor.fetchall()}
+
+        sums = {name: i for i, name in enumerate(AGGREGATE_SUMS)}
+        by_material: Dict[tuple, List[float]] = {}
+        by_site: Dict[str, List[float]] = {}
+        waste_rows, carbon_rows = [], []
+        for (site_id, material_id, submaterial_id), totals in by_submaterial.items():
+            for group, key in ((by_material, (site_id, material_id)), (by_site, site_id)):
+                group_totals = group.setdefault(key, [0.0] * len(AGGREGATE_SUMS))
+                for i, value in enumerate(totals):
+                    group_totals[i] += value
+            t = {name: totals[i] for name, i in sums.items()}
+            diverted = sum(t[f"{bucket}_weight"] for bucket in DIVERTED_BUCKETS)
+            if t["removal_rows"]:
+                waste_rows.append(
+                    (str(uuid.uuid4()), site_id, material_id, submaterial_id)
+                    + tuple(
+                        round(t[name], 2)
+                        for name in (
+                            "waste_weight_kg",
+                            "waste_volume_m3",
+                            "waste_value",
+                            "removal_cost",
+                            "landfill_weight",
+                            "cleanfill_weight",
+                            "recycle_weight",
+                            "reuse_weight",
+                        )
+                    )
+                    + (percentage(diverted, t["waste_weight_kg"]),)
+                )
+            factor = self.carbon_factors.get(submaterial_id)
+            material_carbon = round(t["weight_kg"] * factor, 2) if factor is not None else None
+            waste_carbon = round(t["waste_weight_kg"] * factor, 2) if factor is not None else None
+            logistics_carbon = logistics.get((site_id, submaterial_id))
+            carbon_rows.append(
+                (
+                    str(uuid.uuid4()),
+                    site_id,
+                    material_id,
+                    submaterial_id,
+                    round(t["weight_kg"], 2),
+                    round(t["waste_weight_kg"], 2),
+                    factor,
+                    material_carbon,
+                    waste_carbon,
+                    logistics_carbon,
+                    round(material_carbon + waste_carbon + (logistics_carbon or 0.0), 2)
+                    if factor is not None
+                    else None,
+                )
+            )
+
+        material_rows = []
+        for (site_id, material_id), totals in by_material.items():
+            t = {name: totals[i] for name, i in sums.items()}
+            if not t["material_rows"]:
+                continue
+            budget = site_details.get(site_id, (None, None))[0]
+            budget = float(budget) if budget is not None else None
+            total_cost = round(t["total_cost"], 2)
+            material_rows.append(
+                (
+                    str(uuid.uuid4()),
+                    site_id,
+                    material_id,
+                    round(t["weight_kg"], 2),
+                    round(t["volume_m3"], 2),
+                    total_cost,
+                    round(t["excess_pct_sum"] / t["excess_pct_rows"], 2)
+                    if t["excess_pct_rows"]
+                    else None,
+                    budget,
+                    total_cost,
+                    percentage(total_cost, budget),
+                )
+            )
+
+        summary_rows = []
+        for site_id, totals in by_site.items():
+            t = {name: totals[i] for name, i in sums.items()}
+            if not t["removal_rows"]:
+                continue
+            floor_area = site_details.get(site_id, (None, None))[1]
+            diverted = sum(t[f"{bucket}_weight"] for bucket in DIVERTED_BUCKETS)
+            summary_rows.append(
+                (str(uuid.uuid4()), site_id)
+                + tuple(
+                    round(t[name], 2)
+                    for name in (
+                        "waste_weight_kg",
+                        "waste_volume_m3",
+                        "waste_value",
+                        "removal_cost",
+                        "landfill_weight",
+                        "cleanfill_weight",
+                        "recycle_weight",
+                        "reuse_weight",
+                    )
+                )
+                + (
+                    percentage(diverted, t["waste_weight_kg"]),
+                    round(t["waste_weight_kg"] / float(floor_area), 4) if floor_area else None,
+                )
+            )
+
+        for table, columns, rows in (
+            (
+                "r_materials",
+                "material_report_id, site_id, material_id, total_weight_kg, total_volume_m3, "
+                "total_cost, avg_excess_percentage, project_budget, material_total_cost, "
+                "materials_budget_percentage",
+                material_rows,
+            ),
+            (
+                "r_waste",
+                "waste_report_id, site_id, material_id, submaterial_id, waste_weight_kg, "
+                "waste_volume_m3, waste_value, removal_cost, landfill_weight, cleanfill_weight, "
+                "recycle_weight, reuse_weight, diversion_rate_pct",
+                waste_rows,
+            ),
+            (
+                "r_waste_summary",
+                "waste_summary_id, site_id, total_waste_weight_kg, total_waste_volume_m3, "
+                "total_waste_value, total_removal_cost, total_landfill_weight, "
+                "total_cleanfill_weight, total_recycle_weight, total_reuse_weight, "
+                "diversion_percentage, waste_generation_rate_kg_m2",
+                summary_rows,
+            ),
+            (
+                "r_embodied_carbon",
+                "carbon_report_id, site_id, material_id, submaterial_id, "
+                "total_material_weight_kg, waste_weight_kg, carbon_factor, material_carbon, "
+                "waste_carbon, logistics_carbon, total_embodied_carbon",
+                carbon_rows,
+            ),
+        ):
+            cursor.execute(f"DELETE FROM {table} WHERE site_id IN ({in_sites})", sites)
+            if rows:
+                values = ", ".join([q] * len(rows[0]))
+                cursor.executemany(f"INSERT INTO {table} ({columns}) VALUES ({values})", rows)
+
+    def _refresh_months(self, cursor, q: str, months: List[tuple]):
+        # r_diversion_pct_by_month covers every site
+        diverted = " + ".join(f"{bucket}_weight" for bucket in DIVERTED_BUCKETS)
+        for year, month in months:
+            cursor.execute(
+                f"SELECT SUM(waste_weight_kg), SUM({diverted}) FROM r_aggregate_totals "
+                f"WHERE year_num = {q} AND month_num = {q}",
+                (year, month),
+            )
+            waste_kg, diverted_kg = cursor.fetchone()
+            cursor.execute(
+                f"DELETE FROM r_diversion_pct_by_month WHERE year_num = {q} AND month_num = {q}",
+                (year, month),
+            )
+            if as_float(waste_kg):
+                cursor.execute(
+                    "INSERT INTO r_diversion_pct_by_month (year_num, month_num, diversion_pct) "
+                    f"VALUES ({q}, {q}, {q})",
+                    (year, month, percentage(as_float(diverted_kg), as_float(waste_kg))),
+                )
+
+
+def carbon_factors_by_id(lookups: LookupTables, carbon_factors: pd.Series) -> Dict[str, float]:
+    by_name = {normalize_lookup_name(name): float(factor) for name, factor in carbon_factors.items()}
+    return {
+        submaterial_id: by_name[sub_material]
+        for (_, sub_material), submaterial_id in lookups.submaterials.items()
+        if sub_material in by_name
+    }
+
+
+def rebuild_reports(
+    connection,
+    placeholder: str,
+    lookups: LookupTables,
+    carbon_factors: Dict[str, float] = None,
+    chunk_rows: int = 10000,
+) -> dict:
+    """Recomputes every report table from i_materials and i_resource_removal in
+    one transaction. Source rows are streamed in chunks, so memory grows with
+    the number of (site, sub-material, month) keys rather than with rows.
+    r_logistics_emissions is kept: the distances behind it are not in
+    i_materials."""
+    require_report_tables(connection, placeholder)
+    aggregator = ReportAggregator(lookups, carbon_factors)
+    source_rows = 0
+    with connection:
+        cursor = connection.cursor()
+        if placeholder == "%s":
+            # Waits for in-flight applies and holds back new ones until the
+            # rebuilt totals are committed
+            cursor.execute("LOCK TABLE r_aggregate_totals IN SHARE ROW EXCLUSIVE MODE")
+        for table in REPORT_TABLES:
+            cursor.execute(f"DELETE FROM {table}")
+        for table, columns, add in (
+            ("i_materials", MATERIAL_AGGREGATE_COLUMNS, aggregator.add_materials),
+            ("i_resource_removal", REMOVAL_AGGREGATE_COLUMNS, aggregator.add_removals),
+        ):
+            cursor.execute(f"SELECT {', '.join(columns)} FROM {table}")
+            while True:
+                rows = cursor.fetchmany(chunk_rows)
+                if not rows:
+                    break
+                source_rows += len(rows)
+                add(rows)
+        stats = aggregator.apply(connection, placeholder)
+    stats["source_rows"] = source_rows
+    return stats
+
+
+# Tracing.
+# Instead of printing whole responses, the pipe records what it does as spans:
+# one per document, and below it the ingestion, each batch, each step a batch
+# goes through and each model call attempt. Spans carry durations, row and
+# token counts, model ids, retry reasons and cache hits as attributes, and are
+# handed to an exporter as they finish: "log" prints one line per span,
+# "jsonl" appends them to a file, and "otel" replays them into the
+# OpenTelemetry SDK when it is installed. Request and response payloads are
+# only attached to spans when TRACE_PAYLOADS is on.
+
+current_span = contextvars.ContextVar("wastex_current_span", default=None)
+
+
+class Span:
+    def __init__(self, tracer, name: str, parent=None, attributes: dict = None):
+        self.tracer = tracer
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent.span_id if parent is not None else None
+        self.start_time = time.time()
+        self.end_time = None
+        self._started = time.perf_counter()
+        self.status = "ok"
+        self.attributes = dict(attributes or {})
+        self.events = []
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+        return self
+
+    def event(self, name: str, **attributes):
+        self.events.append({"name": name, "time": time.time(), **attributes})
+
+    def fail(self, error: str):
+        self.status = "error"
+        self.attributes["error"] = error
+        return self
+
+    def end(self):
+        # Spans end once; later calls are ignored.
+        if self.end_time is None:
+            self.end_time = self.start_time + (time.perf_counter() - self._started)
+            self.tracer.export(self)
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.tracer.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_time": self.start_time,
+            "end_time": self.end_time,
+            "duration_ms": round((self.end_time - self.start_time) * 1000, 3),
+            "status": self.status,
+            "attributes": self.attributes,
+            "events": self.events,
+        }
+
+
+class Tracer:
+    # One tracer per pipe invocation. Spans without an explicit parent nest
+    # under the span that is current in the running task, or under the root.
+    def __init__(self, exporter=None, payloads: bool = False):
+        self.exporter = exporter
+        self.payloads = payloads
+        self.trace_id = os.urandom(16).hex()
+        self.root = None
+
+    def start(self, name: str, parent: Span = None, **attributes) -> Span:
+        if parent is None:
+            current = current_span.get()
+            parent = current if current is not None and current.tracer is self else self.root
+        return Span(self, name, parent, attributes)
+
+    @contextlib.contextmanager
+    def span(self, name: str, parent: Span = None, **attributes):
+        span = self.start(name, parent, **attributes)
+        token = current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.fail(repr(e))
+            raise
+        finally:
+            current_span.reset(token)
+            span.end()
+
+    def warn(self, message: str, **attributes):
+        # Problems that aren't any one span's failure (bad valve entries, a
+        # failing exporter) become "warning" events on the document span, or
+        # Python warnings once it has ended.
+        if self.root is not None and self.root.end_time is None:
+            self.root.event("warning", message=message, **attributes)
+        else:
+            warnings.warn(message, RuntimeWarning, stacklevel=2)
+
+    def export(self, span: Span):
+        if self.exporter is None:
+            return
+        try:
+            self.exporter.export(span)
+            # The trace is flushed when the document ends; spans still ending
+            # after that (cancelled workers) are flushed as they come.
+            if self.root is not None and self.root.end_time is not None:
+                self.exporter.flush(self.trace_id)
+        except Exception as e:
+            self.warn(f"Span export failed: {e!r}", span=span.name)
+
+
+def span_attribute(value):
+    if isinstance(value, (str, bool, int, float)):
+        return value
+    return json.dumps(value, default=str)
+
+
+class LogSpanExporter:
+    def export(self, span: Span):
+        line = [
+            f"[{span.tracer.trace_id[:8]}] {span.name} {span.status} "
+            f"{(span.end_time - span.start_time) * 1000:.1f} ms"
+        ]
+        line += [
+            f"{key}={span_attribute(value)}"
+            for key, value in span.attributes.items()
+            if value is not None
+        ]
+        if span.events:
+            line.append(f"events={span_attribute(span.events)}")
+        print(" ".join(line))
+
+    def flush(self, trace_id: str):
+        pass
+
+
+class JsonlSpanExporter:
+    # Spans are buffered per trace and written when the document span ends.
+    def __init__(self, path: str):
+        self.path = path
+        self.pending: Dict[str, List[Span]] = {}
+
+    def export(self, span: Span):
+        self.pending.setdefault(span.tracer.trace_id, []).append(span)
+
+    def flush(self, trace_id: str):
+        spans = self.pending.pop(trace_id, [])
+        with open(self.path, "a", encoding="utf-8") as f:
+            for span in spans:
+                f.write(json.dumps(span.to_dict(), default=str) + "\n")
+
+
+class OtelSpanExporter:
+    # Replays a finished trace into the configured OpenTelemetry tracer
+    # provider, keeping the original timings and parent/child structure.
+    def __init__(self):
+        self.tracer = otel_trace.get_tracer("wastex_extraction")
+        self.pending: Dict[str, List[Span]] = {}
+
+    def export(self, span: Span):
+        self.pending.setdefault(span.tracer.trace_id, []).append(span)
+
+    def flush(self, trace_id: str):
+        spans = sorted(self.pending.pop(trace_id, []), key=lambda span: span.start_time)
+        created = {}
+        for span in spans:
+            parent = created.get(span.parent_id)
+            otel_span = self.tracer.start_span(
+                span.name,
+                context=otel_trace.set_span_in_context(parent) if parent else None,
+                start_time=int(span.start_time * 1e9),
+                attributes={
+                    key: span_attribute(value)
+                    for key, value in span.attributes.items()
+                    if value is not None
+                },
+            )
+            for event in span.events:
+                otel_span.add_event(
+                    event["name"],
+                    attributes={
+                        key: span_attribute(value)
+                        for key, value in event.items()
+                        if key not in ("name", "time")
+                    },
+                    timestamp=int(event["time"] * 1e9),
+                )
+            if span.status == "error":
+                otel_span.set_status(Status(StatusCode.ERROR, span.attributes.get("error")))
+            created[span.span_id] = otel_span
+        for span in spans:
+            created[span.span_id].end(end_time=int(span.end_time * 1e9))
+
+
+def make_span_exporter(kind: str, path: str):
+    kind = kind.strip().lower()
+    if not kind:
+        return None
+    if kind == "jsonl":
+        return JsonlSpanExporter(path)
+    if kind == "otel":
+        if otel_trace is not None:
+            return OtelSpanExporter()
+        print("opentelemetry is not installed, logging spans instead")
+    elif kind != "log":
+        print(f"Unknown span exporter {kind!r}, logging spans instead")
+    return LogSpanExporter()
+
+
+class Pipe:
+    class Valves(BaseModel):
+        MODEL_ID: str = Field(default="")
+        GOOGLE_API_KEY: str = Field(default="")
+        # Maximum number of batches in flight across the extraction pipeline
+        MAX_CONCURRENT_BATCHES: int = Field(default=4)
+        # Number of concurrent workers for each extraction step
+        STAGE_WORKERS: int = Field(default=2)
+        # Per-model requests-per-minute limits, "model:rpm" comma separated
+        MODEL_RATE_LIMITS: str = Field(default="gpt-4o:60,o3-mini:30")
+        # Per-model token budget for one batch's request and response,
+        # "model:tokens" comma separated
+        BATCH_TOKEN_BUDGETS: str = Field(default="gpt-4o:12000,o3-mini:10000,gpt-4o-mini:12000")
+        # Upper bound on rows per batch, whatever their size
+        MAX_BATCH_ROWS: int = Field(default=50)
+        # Batches shrink while calls take longer than this
+        BATCH_TARGET_SECONDS: float = Field(default=60.0)
+        # FinalOrder fields that send a row to the final order prompt when they
+        # cannot be mapped locally, comma separated ("" disables the LLM call)
+        FINAL_ORDER_LLM_FALLBACK_FIELDS: str = Field(default="item_name")
+        # Per-row cache of materials and vol/mass results
+        CACHE_ENABLED: bool = Field(default=True)
+        CACHE_PATH: str = Field(
+            default=os.path.join(os.getenv("DATA_DIR", "."), "wastex_cache.sqlite3")
+        )
+        CACHE_TTL_DAYS: float = Field(default=30)
+        CACHE_MAX_ENTRIES: int = Field(default=200000)
+        # Return the stored extraction for a re-uploaded file, and reuse the
+        # rows shared with an earlier near-duplicate document
+        DOCUMENT_DEDUP_ENABLED: bool = Field(default=True)
+        # Estimated share of rows in common for a near-duplicate (0-1)
+        NEAR_DUPLICATE_THRESHOLD: float = Field(default=0.5)
+        # Local keyword/catalogue classifier run before the materials prompt
+        LOCAL_CLASSIFIER_ENABLED: bool = Field(default=True)
+        LOCAL_CLASSIFIER_THRESHOLD: float = Field(default=0.85)
+        # Item catalogue: a CSV export of l_item_details with item_name,
+        # sub_material, weight_kg, default_excess_pct, or a database URL
+        # ("postgresql://...", "sqlite:///...") to read l_item_details from
+        ITEM_CATALOGUE_PATH: str = Field(default="")
+        # Where the catalogue's embedding index is saved and memory-mapped from
+        CATALOGUE_INDEX_DIR: str = Field(
+            default=os.path.join(os.getenv("DATA_DIR", "."), "wastex_catalogue_index")
+        )
+        # Cosine similarity from which a catalogue item supplies a row's unit
+        # weight and excess %
+        CATALOGUE_MATCH_THRESHOLD: float = Field(default=0.8)
+        # Compute volumes locally from dimensions before the vol/mass prompt
+        DIMENSION_PARSER_ENABLED: bool = Field(default=True)
+        # Fill density/weights from sub-material densities after extraction
+        DENSITY_STAGE_ENABLED: bool = Field(default=True)
+        # CSV export of l_submaterials (submaterial_name, density_kg_per_m3)
+        DENSITIES_PATH: str = Field(default="")
+        # Report embodied carbon and logistics emissions for each document
+        CARBON_STAGE_ENABLED: bool = Field(default=True)
+        # CSV of sub_material, carbon_factor (kg CO2e/kg) overriding the defaults
+        CARBON_FACTORS_PATH: str = Field(default="")
+        # CSV of supplier_name, delivery_distance_km
+        SUPPLIER_DISTANCES_PATH: str = Field(default="")
+        # Distances used when a supplier's (or the removal) distance is unknown
+        DEFAULT_DELIVERY_DISTANCE_KM: float = Field(default=30.0)
+        DEFAULT_REMOVAL_DISTANCE_KM: float = Field(default=25.0)
+        # Attempts per chat completion call, with exponential backoff + jitter
+        MAX_RETRIES: int = Field(default=3)
+        RETRY_BACKOFF_SECONDS: float = Field(default=1.0)
+        RETRY_BACKOFF_MAX_SECONDS: float = Field(default=30.0)
+        # Repair invalid responses locally and only re-request unrecoverable rows
+        RESPONSE_REPAIR_ENABLED: bool = Field(default=True)
+        # Split failed batches in half and retry them instead of failing them
+        SPLIT_FAILED_BATCHES: bool = Field(default=True)
+        # Stop splitting once a step has failed this many calls in a row
+        SPLIT_FAILURE_LIMIT: int = Field(default=8)
+        # Send only the fields each stage reads, as minified JSON
+        COMPACT_STAGE_PAYLOADS: bool = Field(default=True)
+        # Skip the gpt-4o cleaning call for CSV uploads that are already clean
+        CSV_SKIP_CLEAN_INPUT: bool = Field(default=True)
+        # Maximum number of image/PDF pages extracted by Gemini at once
+        GEMINI_PAGE_CONCURRENCY: int = Field(default=4)
+        # Straighten, crop, downsample and re-encode images before Gemini
+        IMAGE_PREPROCESS_ENABLED: bool = Field(default=True)
+        IMAGE_TARGET_DPI: int = Field(default=150)
+        IMAGE_MAX_DIMENSION: int = Field(default=2000)
+        IMAGE_JPEG_QUALITY: int = Field(default=80)
+        # Send easy rows to ROUTER_CHEAP_MODEL instead of the step's model
+        MODEL_ROUTING_ENABLED: bool = Field(default=False)
+        ROUTER_CHEAP_MODEL: str = Field(default="gpt-4o-mini")
+        # Rows with a difficulty score (0-1) below this go to the cheap model
+        ROUTER_DIFFICULTY_THRESHOLD: float = Field(default=0.4)
+        # Cheap model results with a confidence score below this are escalated
+        ROUTER_ESCALATION_CONFIDENCE: float = Field(default=0.7)
+        # USD per million input/output tokens for the routing cost report,
+        # "model:input/output" comma separated
+        MODEL_PRICES: str = Field(
+            default="gpt-4o:2.5/10,gpt-4o-mini:0.15/0.6,o3-mini:1.1/4.4"
+        )
+        # Share one in-flight extraction between identical rows, within a
+        # document and across concurrent uploads
+        COALESCE_DUPLICATE_ROWS: bool = Field(default=True)
+        # Stream NDJSON events per batch instead of returning one JSON document
+        STREAM_OUTPUT: bool = Field(default=False)
+        # Write extracted rows to i_materials: "postgresql://..." or
+        # "sqlite:///path/to/file.db" ("" returns JSON only)
+        PERSIST_DATABASE_URL: str = Field(default="")
+        # Site the rows belong to, unless the request metadata has a site_id
+        PERSIST_SITE_ID: str = Field(default="")
+        # Seconds the l_submaterials / l_units / l_suppliers lookups are reused
+        LOOKUP_CACHE_SECONDS: float = Field(default=300)
+        # Update the r_* report tables with each persisted document
+        REPORTS_ENABLED: bool = Field(default=True)
+        # Span export: "log", "jsonl" (appended to TRACE_PATH), "otel" or "" for none
+        TRACE_EXPORTER: str = Field(default="log")
+        TRACE_PATH: str = Field(
+            default=os.path.join(os.getenv("DATA_DIR", "."), "wastex_traces.jsonl")
+        )
+        # Attach full request/response payloads to spans (for debugging only)
+        TRACE_PAYLOADS: bool = Field(default=False)
+
+    def __init__(self):
+        self.valves = self.Valves(
+            **{
+                "GOOGLE_API_KEY": os.getenv("GOOGLE_API_KEY", ""),
+            }
+        )
+        self._rate_limiter = None
+        self._batcher = None
+        self._cache = None
+        self._documents = None
+        self._classifier = None
+        self._catalogue = None
+        self._catalogue_key = None
+        self._catalogue_loaded_at = 0.0
+        self._flights = SingleFlight()  # shared by every pipe invocation
+        self._lookups = None
+        self._span_exporter = None
+        self._span_exporter_key = None
+
+    def _persist_orders(
+        self,
+        orders,
+        site_id: str,
+        arrival_doc_id: str = None,
+        carbon_factors: pd.Series = None,
+        emissions: pd.DataFrame = None,
+    ) -> dict:
+        # Blocking; run in an executor. emissions is compute_emissions output
+        # for the same orders, added to r_logistics_emissions.
+        url = self.valves.PERSIST_DATABASE_URL
+        connection, placeholder = connect_database(url)
+        try:
+            started = time.perf_counter()
+            lookups = self._lookups
+            if (
+                lookups is None
+                or lookups.url != url
+                or time.monotonic() - lookups.loaded_at > self.valves.LOOKUP_CACHE_SECONDS
+            ):
+                lookups = self._lookups = LookupTables.load(connection, url)
+            if self.valves.REPORTS_ENABLED:
+                require_report_tables(connection, placeholder)
+            loaded = time.perf_counter()
+            rows, unresolved = build_material_rows(orders, lookups, site_id, arrival_doc_id)
+            resolved = time.perf_counter()
+            stats = {"persisted_rows": len(rows), "unresolved": unresolved}
+            with connection:
+                insert_material_rows(connection, placeholder, rows)
+                inserted = time.perf_counter()
+                if self.valves.REPORTS_ENABLED:
+                    if carbon_factors is None:
+                        carbon_factors = load_carbon_factors(self.valves.CARBON_FACTORS_PATH)
+                    aggregator = ReportAggregator(
+                        lookups, carbon_factors_by_id(lookups, carbon_factors)
+                    )
+                    columns = [I_MATERIALS_COLUMNS.index(name) for name in MATERIAL_AGGREGATE_COLUMNS]
+                    aggregator.add_materials(
+                        [tuple(row[i] for i in columns) for row in rows]
+                    )
+                    if emissions is not None:
+                        aggregator.add_logistics(
+                            zip(
+                                [row[1] for row in rows],
+                                [row[2] for row in rows],
+                                emissions["supplier"],
+                                emissions["total_material_weight_kg"],
+                                emissions["waste_weight_kg"],
+                                emissions["delivery_emissions_co2"],
+                                emissions["removal_emissions_co2"],
+                            )
+                        )
+                    stats["reports"] = aggregator.apply(connection, placeholder)
+            stats.update(
+                lookup_seconds=round(loaded - started, 4),
+                resolve_seconds=round(resolved - loaded, 4),
+                insert_seconds=round(inserted - resolved, 4),
+            )
+            if self.valves.REPORTS_ENABLED:
+                stats["reports_seconds"] = round(time.perf_counter() - inserted, 4)
+            return stats
+        finally:
+            connection.close()
+
+    def _get_span_exporter(self):
+        key = (self.valves.TRACE_EXPORTER, self.valves.TRACE_PATH)
+        if self._span_exporter_key != key:
+            self._span_exporter = make_span_exporter(*key)
+            self._span_exporter_key = key
+        return self._span_exporter
+
+    def _get_catalogue(self) -> Union[CatalogueIndex, None]:
+        # The catalogue is read again when the valve or the CSV file changes,
+        # and a database catalogue after LOOKUP_CACHE_SECONDS. The embeddings
+        # are only rebuilt when the item names changed.
+        source = self.valves.ITEM_CATALOGUE_PATH
+        if not source:
+            return None
+        modified = os.path.getmtime(source) if os.path.exists(source) else None
+        key = (source, self.valves.CATALOGUE_INDEX_DIR, modified)
+        if (
+            self._catalogue_key != key
+            or modified is None
+            and time.monotonic() - self._catalogue_loaded_at > self.valves.LOOKUP_CACHE_SECONDS
+        ):
+            self._catalogue = CatalogueIndex.load(source, self.valves.CATALOGUE_INDEX_DIR)
+            self._catalogue_key = key
+            self._catalogue_loaded_at = time.monotonic()
+        return self._catalogue
+
+    def _get_classifier(self) -> Union[MaterialClassifier, None]:
+        if not self.valves.LOCAL_CLASSIFIER_ENABLED:
+            return None
+        catalogue = self._get_catalogue()
+        if self._classifier is None or self._classifier.catalogue is not catalogue:
+            self._classifier = MaterialClassifier(catalogue)
+        return self._classifier
+
+    def _get_cache(self) -> Union[ExtractionCache, None]:
+        if not self.valves.CACHE_ENABLED:
+            return None
+        if self._cache is None or self._cache.path != self.valves.CACHE_PATH:
+            self._cache = ExtractionCache(
+                self.valves.CACHE_PATH,
+                self.valves.CACHE_TTL_DAYS * 24 * 3600,
+                self.valves.CACHE_MAX_ENTRIES,
+            )
+        self._cache.ttl_seconds = self.valves.CACHE_TTL_DAYS * 24 * 3600
+        self._cache.max_entries = self.valves.CACHE_MAX_ENTRIES
+        return self._cache
+
+    def _get_document_index(self) -> Union[DocumentIndex, None]:
+        if not self.valves.DOCUMENT_DEDUP_ENABLED:
+            return None
+        if self._documents is None or self._documents.path != self.valves.CACHE_PATH:
+            self._documents = DocumentIndex(
+                self.valves.CACHE_PATH, self.valves.CACHE_TTL_DAYS * 24 * 3600
+            )
+        self._documents.ttl_seconds = self.valves.CACHE_TTL_DAYS * 24 * 3600
+        return self._documents
+
+    def _get_batcher(self) -> AdaptiveBatcher:
+        # Like the rate limiter, the batcher is shared by every pipe invocation
+        # so that what it learns about each model carries over between uploads.
+        if (
+            self._batcher is None
+            or self._batcher.spec != self.valves.BATCH_TOKEN_BUDGETS
+            or self._batcher.max_rows != max(1, self.valves.MAX_BATCH_ROWS)
+        ):
+            self._batcher = AdaptiveBatcher(
+                self.valves.BATCH_TOKEN_BUDGETS, self.valves.MAX_BATCH_ROWS
+            )
+        self._batcher.target_seconds = self.valves.BATCH_TARGET_SECONDS
+        self._batcher.routed_model = (
+            self.valves.ROUTER_CHEAP_MODEL.strip() if self.valves.MODEL_ROUTING_ENABLED else ""
+        )
+        return self._batcher
+
+    def _get_rate_limiter(self) -> ModelRateLimiter:
+        # The limiter is shared by every pipe invocation so that concurrent
+        # uploads count against the same per-model budget. It is rebuilt if the
+        # valve is changed.
+        if (
+            self._rate_limiter is None
+            or self._rate_limiter.spec != self.valves.MODEL_RATE_LIMITS
+        ):
+            self._rate_limiter = ModelRateLimiter(self.valves.MODEL_RATE_LIMITS)
+        return self._rate_limiter
+
+    async def pipe(
+        self, body: dict, __user__: dict, __request__: Request
+    ) -> Union[str, AsyncGenerator[str, None]]:
+        # Retrieve user details using the provided user id.
+        user = Users.get_user_by_id(__user__["id"])
+
+        file_body = body["messages"][-1].get("file", None)
+        file_content = body["messages"][-1]["content"]
+        file_type = ""
+        if not file_body:
+            file_type = "text/csv"
+        else:
+            file_type = file_body["mime_type"]
+
+        body["stream"] = False
+        tracer = Tracer(self._get_span_exporter(), self.valves.TRACE_PAYLOADS)
+        document_span = tracer.start("document", file_type=file_type)
+        tracer.root = document_span
+
+        # ---------------------------------------------------------------------
+        # Helper function: Encodes the rows a stage sends to the model, and
+        # tracks how many input tokens the compact encoding saves over the
+        # indented JSON of the full models.
+        # ---------------------------------------------------------------------
+        payload_stats = {}  # stage -> estimated input tokens
+
+        def stage_payload(stage: str, items: list, schema_model) -> str:
+            indented = schema_model(ordered_items=items).model_dump_json(indent=4)
+            payload = (
+                encode_stage_payload(stage, items)
+                if self.valves.COMPACT_STAGE_PAYLOADS
+                else indented
+            )
+            stats = payload_stats.setdefault(stage, {"indented": 0, "sent": 0})
+            stats["indented"] += estimate_tokens(indented)
+            stats["sent"] += estimate_tokens(payload)
+            return payload
+
+        # ---------------------------------------------------------------------
+        # Helper function: Calls the chat completion API with the given model and
+        # the messages built for the batch's rows, validates the response against
+        # the provided Pydantic schema, and retries until either every row has a
+        # valid item or the call's retry budget is used up. A response that
+        # fails validation is repaired locally first, and only the rows that
+        # couldn't be recovered are sent again. Retries back off exponentially
+        # with jitter so that concurrent batches don't retry in lockstep. Each
+        # call builds its own request body so that concurrently running batches
+        # never share (and clobber) message state.
+        # ---------------------------------------------------------------------
+        async def get_validated_response(
+            schema_model,
+            prompt_desc: str,
+            model: str,
+            build_messages,
+            rows: list,
+            row_ids: List[int],
+            row_keys: List[str],
+            i: int,
+        ) -> any:
+            results = [None] * len(rows)
+            retry_reason = None
+            for attempt in range(max_retries):
+                pending = [pos for pos, item in enumerate(results) if item is None]
+                delay = 0.0
+                if attempt:
+                    delay = min(
+                        self.valves.RETRY_BACKOFF_MAX_SECONDS,
+                        self.valves.RETRY_BACKOFF_SECONDS * 2 ** (attempt - 1),
+                    ) * random.uniform(0.5, 1.5)
+                    await asyncio.sleep(delay)
+                messages = build_messages([rows[pos] for pos in pending])
+                call_body = {**body, "model": model, "messages": messages}
+                with tracer.span(
+                    "llm call",
+                    stage=prompt_desc,
+                    model=model,
+                    tier="cheap" if model == cheap_model else "strong",
+                    batch=i,
+                    attempt=attempt + 1,
+                    rows=len(pending),
+                    input_tokens=sum(estimate_tokens(m["content"]) for m in messages),
+                ) as call_span:
+                    if attempt:
+                        call_span.set(retry_reason=retry_reason, backoff_seconds=round(delay, 3))
+                    if tracer.payloads:
+                        call_span.set(request=messages)
+                    waited = time.perf_counter()
+                    await rate_limiter.acquire(model)
+                    call_started = time.perf_counter()
+                    call_span.set(rate_limit_seconds=round(call_started - waited, 3))
+                    try:
+                        chat_call = await generate_chat_completion(
+                            __request__, call_body, user
+                        )
+                        response_content = chat_call["choices"][0]["message"]["content"]
+                    except Exception as e:
+                        call_seconds = time.perf_counter() - call_started
+                        batcher.observe(prompt_desc, call_seconds, False)
+                        routing_stats.record_call(
+                            prompt_desc,
+                            model,
+                            len(pending),
+                            call_seconds,
+                            call_span.attributes["input_tokens"],
+                            0,
+                        )
+                        retry_reason = f"API error: {e}"
+                        call_span.fail(retry_reason)
+                        continue
+                    call_seconds = time.perf_counter() - call_started
+                    usage = chat_call.get("usage") or {}
+                    call_span.set(
+                        input_tokens=usage.get("prompt_tokens")
+                        or call_span.attributes["input_tokens"],
+                        output_tokens=usage.get("completion_tokens")
+                        or estimate_tokens(response_content),
+                    )
+                    routing_stats.record_call(
+                        prompt_desc,
+                        model,
+                        len(pending),
+                        call_seconds,
+                        call_span.attributes["input_tokens"],
+                        call_span.attributes["output_tokens"],
+                    )
+                    if tracer.payloads:
+                        call_span.set(response=response_content)
+                    try:
+                        validated_output = schema_model.model_validate_json(
+                            response_content
+                        )
+                        batcher.observe(prompt_desc, call_seconds, True)
+                        items = validated_output.ordered_items
+                        repaired = False
+                    except ValidationError:
+                        batcher.observe(prompt_desc, call_seconds, False)
+                        if not self.valves.RESPONSE_REPAIR_ENABLED:
+                            retry_reason = "response failed validation"
+                            call_span.fail(retry_reason)
+                            continue
+                        items = repair_response(schema_model, response_content)
+                        repaired = True
+
+                    # Join the response to the requested rows by row id; the ids and
+                    # raw data are then set from the request, not the response.
+                    recovered = match_response_items(
+                        items,
+                        [row_ids[pos] for pos in pending],
+                        [row_keys[pos] for pos in pending],
+                    )
+                    for offset, item in recovered.items():
+                        pos = pending[offset]
+                        update = {"row_id": row_ids[pos]}
+                        if "raw_data" in type(item).model_fields:
+                            update["raw_data"] = row_keys[pos]
+                        results[pos] = item.model_copy(update=update)
+                    missing = len(pending) - len(recovered)
+                    call_span.set(recovered_rows=len(recovered), repaired=repaired)
+                    if attempt or repaired or missing:
+                        repair_stats[prompt_desc] = repair_stats.get(prompt_desc, 0) + len(
+                            recovered
+                        )
+                    if not missing:
+                        failure_streaks[prompt_desc] = 0
+                        return schema_model(ordered_items=results)
+                    retry_reason = f"{missing} of {len(pending)} rows missing or invalid"
+                    call_span.fail(retry_reason)
+            failure_streaks[prompt_desc] = failure_streaks.get(prompt_desc, 0) + 1
+            return None
+
+        # ---------------------------------------------------------------------
+        # Helper function: Routes a batch's rows between the cheap and the strong
+        # model by difficulty, calls both tiers concurrently, and escalates cheap
+        # results the model wasn't confident about (or couldn't produce) to the
+        # strong model. Falls back to a single strong call when routing is off.
+        # ---------------------------------------------------------------------
+        cheap_model = self.valves.ROUTER_CHEAP_MODEL.strip()
+        routing_stats = RoutingStats()
+
+        def routes(model: str) -> bool:
+            return bool(
+                self.valves.MODEL_ROUTING_ENABLED and cheap_model and cheap_model != model
+            )
+        difficulties = {}  # row id -> difficulty score
+
+        def difficulty(row_id: int) -> float:
+            if row_id not in difficulties:
+                values = parse_csv_row(data_rows[row_id])
+                item_column = column_map.get("item_name")
+                text = (
+                    values[item_column]
+                    if item_column is not None and item_column < len(values)
+                    else data_rows[row_id]
+                )
+                # Without the local classifier there is no signal either way
+                classifier_score = classifier.classify(text)[1] if classifier else 0.5
+                difficulties[row_id] = row_difficulty(text, classifier_score)
+            return difficulties[row_id]
+
+        async def get_routed_response(
+            schema_model,
+            prompt_desc: str,
+            model: str,
+            build_messages,
+            rows: list,
+            row_ids: List[int],
+            row_keys: List[str],
+            i: int,
+            tiers: Union[list, None] = None,
+        ) -> any:
+            # tiers, if given, is filled with the model that produced each row
+            if not routes(model):
+                if tiers is not None:
+                    tiers[:] = [model] * len(rows)
+                return await get_validated_response(
+                    schema_model, prompt_desc, model, build_messages, rows, row_ids, row_keys, i
+                )
+
+            async def call_tier(tier_model: str, positions: List[int]):
+                # Returns {position: item}, or None if the call failed
+                if not positions:
+                    return {}
+                output = await get_validated_response(
+                    schema_model,
+                    prompt_desc,
+                    tier_model,
+                    build_messages,
+                    [rows[pos] for pos in positions],
+                    [row_ids[pos] for pos in positions],
+                    [row_keys[pos] for pos in positions],
+                    i,
+                )
+                if output is None:
+                    return None
+                return dict(zip(positions, output.ordered_items))
+
+            easy = [
+                pos
+                for pos, row_id in enumerate(row_ids)
+                if difficulty(row_id) < self.valves.ROUTER_DIFFICULTY_THRESHOLD
+            ]
+            easy_positions = set(easy)
+            hard = [pos for pos in range(len(rows)) if pos not in easy_positions]
+            cheap_results, results = await asyncio.gather(
+                call_tier(cheap_model, easy), call_tier(model, hard)
+            )
+            if results is None:
+                return None
+            produced_by = dict.fromkeys(hard, model)
+            if cheap_results is None:
+                escalate = easy
+            else:
+                escalate = []
+                for pos, item in cheap_results.items():
+                    confidence = result_confidence(item)
+                    if (
+                        confidence is not None
+                        and confidence < self.valves.ROUTER_ESCALATION_CONFIDENCE
+                    ):
+                        escalate.append(pos)
+                    else:
+                        results[pos] = item
+                        produced_by[pos] = cheap_model
+            if escalate:
+                routing_stats.record_escalation(prompt_desc, len(escalate))
+                escalated = await call_tier(model, escalate)
+                if escalated is None:
+                    return None
+                results.update(escalated)
+                produced_by.update(dict.fromkeys(escalate, model))
+            if tiers is not None:
+                tiers[:] = [produced_by[pos] for pos in range(len(rows))]
+            return schema_model(ordered_items=[results[pos] for pos in range(len(rows))])
+
+        # Helper function for Google Gemini API calls
+        async def call_google_gemini(
+            system_prompt, image_content, image_type="image/jpeg"
+        ):
+            # Configure Google API with the API key from environment or valves
+            if not self.valves.GOOGLE_API_KEY:
+                raise IngestionError("Error: GOOGLE_API_KEY is not set")
+            genai.configure(api_key=self.valves.GOOGLE_API_KEY)
+            model_id = "gemini-2.0-pro-exp"
+
+            # Collect the pages: a single image, or one image per PDF page
+            pages = []
+            if not isinstance(image_content, list):
+                image_data = image_content
+                if image_data.startswith("data:"):
+                    image_data = image_data.split(",")[1]
+                pages.append({"mime_type": image_type, "data": image_data})
+            else:
+                for image_item in image_content:
+                    if image_item.get("type") == "image_url":
+                        image_url = image_item["image_url"]["url"]
+                        # If it's a data URL, extract the base64 part and its type
+                        mime_type = "image/jpeg"
+                        if image_url.startswith("data:"):
+                            prefix, image_data = image_url.split(",", 1)
+                            mime_type = prefix[5:].split(";")[0] or mime_type
+                        else:
+                            image_data = image_url
+                        pages.append({"mime_type": mime_type, "data": image_data})
+
+            # Create model and configuration
+            model = genai.GenerativeModel(model_name=model_id)
+            generation_config = GenerationConfig(
+                temperature=0.7,
+                top_p=0.9,
+                top_k=40,
+                max_output_tokens=16384,
+            )
+            page_slots = asyncio.Semaphore(max(1, self.valves.GEMINI_PAGE_CONCURRENCY))
+            preprocess = self.valves.IMAGE_PREPROCESS_ENABLED and Image is not None
+            preprocess_stats = []
+
+            # Shrinks one page off the event loop; pages that can't be decoded
+            # are sent as they are.
+            async def shrink_page(page: dict, page_span: Span) -> dict:
+                try:
+                    data, mime_type, stats = await asyncio.get_running_loop().run_in_executor(
+                        None,
+                        preprocess_image,
+                        page["data"],
+                        self.valves.IMAGE_TARGET_DPI,
+                        self.valves.IMAGE_MAX_DIMENSION,
+                        self.valves.IMAGE_JPEG_QUALITY,
+                    )
+                except Exception as e:
+                    page_span.event("pre-processing failed", error=str(e))
+                    return page
+                preprocess_stats.append(stats)
+                page_span.set(
+                    original_bytes=stats["original_bytes"],
+                    bytes=stats["bytes"],
+                    preprocess_seconds=round(stats["seconds"], 3),
+                )
+                return {"mime_type": mime_type or page["mime_type"], "data": data}
+
+            # Each page is extracted with its own request, so a long docket is no
+            # longer truncated by one response's output token limit. The async
+            # client keeps the event loop free for other users meanwhile.
+            async def extract_page(page_number: int, page: dict) -> str:
+                with tracer.span("gemini page", model=model_id, page=page_number + 1) as page_span:
+                    # Add system prompt as a user message (since Gemini doesn't have system role)
+                    contents = []
+                    if system_prompt:
+                        contents.append(
+                            {"role": "user", "parts": [{"text": f"System: {system_prompt}"}]}
+                        )
+                    if preprocess:
+                        page = await shrink_page(page, page_span)
+                    contents.append({"role": "user", "parts": [{"inline_data": page}]})
+                    async with page_slots:
+                        started = time.perf_counter()
+                        response = await model.generate_content_async(
+                            contents,
+                            generation_config=generation_config,
+                        )
+                    page_span.set(call_seconds=round(time.perf_counter() - started, 3))
+                    usage = getattr(response, "usage_metadata", None)
+                    if usage is not None:
+                        page_span.set(
+                            input_tokens=usage.prompt_token_count,
+                            output_tokens=usage.candidates_token_count,
+                        )
+                    if tracer.payloads:
+                        page_span.set(response=response.text)
+                    return response.text
+
+            with tracer.span("gemini", model=model_id, pages=len(pages)) as gemini_span:
+                try:
+                    page_csvs = await asyncio.gather(
+                        *(extract_page(number, page) for number, page in enumerate(pages))
+                    )
+                except Exception as e:
+                    gemini_span.fail(str(e))
+                    raise IngestionError(f"Error calling Google Gemini API: {str(e)}") from e
+                if preprocess_stats:
+                    gemini_span.set(
+                        preprocessed_pages=len(preprocess_stats),
+                        original_bytes=sum(stats["original_bytes"] for stats in preprocess_stats),
+                        bytes=sum(stats["bytes"] for stats in preprocess_stats),
+                        preprocess_seconds=round(
+                            sum(stats["seconds"] for stats in preprocess_stats), 3
+                        ),
+                    )
+            return merge_page_csvs(page_csvs)
+
+        # ---------------------------------------------------------------------
+        # Duplicate uploads: a file that was already extracted for the same
+        # site (or, without a site, by the same user) gets its stored
+        # extraction back without any model call. Its rows are not persisted
+        # again; an upload for another site is extracted and persisted as
+        # usual.
+        # ---------------------------------------------------------------------
+        metadata = body.get("metadata") or {}
+        site_id = metadata.get("site_id") or self.valves.PERSIST_SITE_ID
+        arrival_doc_id = metadata.get("arrival_doc_id")
+        documents = self._get_document_index()
+        doc_hash = document_fingerprint(
+            file_type, file_content, f"site:{site_id}" if site_id else f"user:{__user__['id']}"
+        )
+        stored_output = documents.get_output(doc_hash) if documents is not None else None
+        stored = None
+        if stored_output is not None:
+            stored = ExtendedFinalOrderExtraction.model_validate_json(stored_output)
+        if stored is not None and stored.ordered_items:
+            document_span.set(
+                duplicate_of=doc_hash[:16], extracted_rows=len(stored.ordered_items)
+            )
+            document_span.end()
+            if not self.valves.STREAM_OUTPUT:
+                return stored_output
+
+            async def stream_stored():
+                items = [item.model_dump() for item in stored.ordered_items]
+                yield json.dumps({"event": "started", "total_rows": len(items)}) + "\n"
+                if items:
+                    yield json.dumps(
+                        {
+                            "event": "ordered_items",
+                            "row_start": 0,
+                            "duplicate": True,
+                            "ordered_items": items,
+                        }
+                    ) + "\n"
+                yield json.dumps(
+                    {
+                        "event": "done",
+                        "extracted_rows": len(items),
+                        "failed_rows": 0,
+                        "elapsed_seconds": 0.0,
+                    }
+                ) + "\n"
+
+            return stream_stored()
+
+        # ---------------------------------------------------------------------
+        # First model call: Branch based on file type.
+        # ---------------------------------------------------------------------
+        ingested = None
+        try:
+            with tracer.span("ingest") as ingest_span:
+                if file_type == "text/csv":
+                    # CSVs that are already well formed skip the cleaning call.
+                    ingested = ingest_csv(file_content)
+                    ingest_span.set(csv=ingested[2])
+                    if not (self.valves.CSV_SKIP_CLEAN_INPUT and ingested[2]["clean"]):
+                        body["model"] = "gpt-4o"
+                        body["messages"][0]["content"] = CSV_CLEANING_PROMPT
+
+                        # Call the completion function to obtain the cleaned CSV output.
+                        with tracer.span(
+                            "llm call",
+                            stage="cleaning",
+                            model="gpt-4o",
+                            input_tokens=estimate_tokens(file_content),
+                        ) as call_span:
+                            first_call = await generate_chat_completion(
+                                __request__, body, user
+                            )
+                            first_response = first_call["choices"][0]["message"]["content"]
+                            call_span.set(output_tokens=estimate_tokens(first_response))
+                        ingested = None
+                    else:
+                        ingest_span.set(cleaning_skipped=True)
+
+                elif file_type == "image/png" or file_type == "image/jpeg":
+                    # For image files, use Google Gemini
+                    first_response = await call_google_gemini(
+                        IMAGE_EXTRACTION_PROMPT, file_content, file_type
+                    )
+
+                else:
+                    # For PDF files (which are a list of images)
+                    first_response = await call_google_gemini(
+                        IMAGE_EXTRACTION_PROMPT, file_content
+                    )
+                if ingested is None:
+                    if tracer.payloads:
+                        ingest_span.set(received=first_response)
+                    ingested = ingest_csv(first_response)
+                    ingest_span.set(csv=ingested[2])
+        except IngestionError as e:
+            # Returned to the user as before, but never parsed as CSV (or
+            # recorded as the document's extraction)
+            document_span.fail(str(e))
+            document_span.end()
+            return str(e)
+        except Exception as e:
+            document_span.fail(repr(e))
+            document_span.end()
+            raise
+
+        # Parse the CSV output and separate the header from data rows.
+        header_row, data_rows, _ = ingested
+        if not header_row:
+            document_span.fail("error in parsing rows")
+            document_span.end()
+            return "error in parsing rows"  # or handle error accordingly
+
+        # ---------------------------------------------------------------------
+        # Near-duplicate documents: rows that an earlier, mostly identical
+        # document already had reuse its stored items, and only the remaining
+        # rows are extracted. positions maps the rows left in data_rows back to
+        # their index in the uploaded document.
+        # ---------------------------------------------------------------------
+        document_row_keys = [document_row_key(header_row, row) for row in data_rows]
+        signature = minhash_signature(document_row_keys)
+        total_rows = len(data_rows)
+        reused_items = []
+        positions = None
+        if documents is not None and data_rows:
+            with tracer.span("near duplicates", rows=total_rows) as dedup_span:
+                match = documents.find_similar(signature, self.valves.NEAR_DUPLICATE_THRESHOLD)
+                stored_items = {}
+                if match is not None:
+                    stored_items = documents.get_items(match[0], document_row_keys)
+                    dedup_span.set(
+                        similar_to=match[0][:16],
+                        similarity=round(match[1], 3),
+                        reused_rows=sum(1 for key in document_row_keys if key in stored_items),
+                    )
+                if stored_items:
+                    positions = []
+                    for idx, key in enumerate(document_row_keys):
+                        if key in stored_items:
+                            reused_items.append(
+                                ExtendedFinalOrder.model_validate_json(
+                                    stored_items[key]
+                                ).model_copy(update={"row_id": idx})
+                            )
+                        else:
+                            positions.append(idx)
+                    data_rows = [data_rows[idx] for idx in positions]
+
+        def document_row(idx: int) -> int:
+            return idx if positions is None else positions[idx]
+
+        all_extracted_final_items = []
+        batcher = self._get_batcher()  # Packs rows into batches by token count
+        max_retries = max(1, self.valves.MAX_RETRIES)  # Attempts per API call
+        rate_limiter = self._get_rate_limiter()
+        for valve, entries in (
+            ("BATCH_TOKEN_BUDGETS", batcher.invalid_entries),
+            ("MODEL_RATE_LIMITS", rate_limiter.invalid_entries),
+        ):
+            for entry in entries:
+                tracer.warn(f"Ignoring invalid {valve} entry", valve=valve, entry=entry)
+        batch_slots = asyncio.Semaphore(max(1, self.valves.MAX_CONCURRENT_BATCHES))
+        stage_workers = max(1, self.valves.STAGE_WORKERS)
+        column_map = map_header_columns(header_row)
+        fallback_fields = {
+            field.strip()
+            for field in self.valves.FINAL_ORDER_LLM_FALLBACK_FIELDS.split(",")
+            if field.strip()
+        }
+        document_span.set(rows=total_rows, columns=column_map)
+        if reused_items:
+            document_span.set(reused_rows=len(reused_items))
+        if tracer.payloads:
+            document_span.set(header_row=header_row)
+
+        # ---------------------------------------------------------------------
+        # Cache helpers: look up each row of a batch, write back fresh results,
+        # and splice cached and fresh items back together in row order.
+        # ---------------------------------------------------------------------
+        cache = self._get_cache()
+
+        # Results are cached under the model that produced them. Returns
+        # (cached results, {model: row keys}); with routing on, a row may have
+        # been answered by either tier, and the step's own model comes first.
+        def lookup_cached_rows(
+            stage: str, model: str, prompt: str, rows, schema_model, classifications=None
+        ):
+            texts = [
+                cache_row_text(stage, row, column_map, classification)
+                for row, classification in zip(rows, classifications or [None] * len(rows))
+            ]
+            keys = {
+                tier: [
+                    ExtractionCache.make_key(stage, tier, prompt, header_row, text)
+                    for text in texts
+                ]
+                for tier in ([model, cheap_model] if routes(model) else [model])
+            }
+            if cache is None:
+                return [None] * len(rows), keys
+            found = cache.get_many(stage, [key for tier_keys in keys.values() for key in tier_keys])
+            cached = []
+            for pos in range(len(rows)):
+                hits = [found[k[pos]] for k in keys.values() if k[pos] in found]
+                value = hits[0] if hits else None
+                cached.append(None if value is None else schema_model.model_validate_json(value))
+            return cached, keys
+
+        def store_cached_rows(stage: str, keys, fresh_values):
+            # Only store when the model returned exactly one item per requested
+            # row; otherwise the results can't be attributed to rows reliably.
+            if cache is None or len(keys) != len(fresh_values):
+                return
+            cache.put_many(
+                stage,
+                {key: value.model_dump_json() for key, value in zip(keys, fresh_values)},
+            )
+
+        # Requests the cache misses of a batch, coalescing rows that are already
+        # in flight. request(positions) returns (fresh items, model that produced
+        # each) for those positions, or None if the request failed; value_of(item)
+        # is the per-row result that is cached and shared. Rows served by another
+        # row's request are filled into cached. Returns (fresh items, number
+        # of coalesced rows), or (None, 0) on failure.
+        flights = self._flights if self.valves.COALESCE_DUPLICATE_ROWS else None
+        coalesce_stats = {}  # stage -> rows served by another row's request
+
+        async def extract_coalesced(stage: str, keys, cached, request, value_of):
+            tier_keys, keys = keys, next(iter(keys.values()))
+            send, waiting, owned = [], [], {}
+            for pos, (key, hit) in enumerate(zip(keys, cached)):
+                if hit is not None:
+                    continue
+                if flights is None:
+                    send.append(pos)
+                elif key in owned:
+                    waiting.append((pos, owned[key]))
+                else:
+                    future, is_owner = flights.claim((stage, key))
+                    if is_owner:
+                        owned[key] = future
+                        send.append(pos)
+                    else:
+                        waiting.append((pos, future))
+
+            fresh_items = []
+            coalesced = 0
+            try:
+                while send or waiting:
+                    if send:
+                        response = await request(send)
+                        if response is None:
+                            return None, 0
+                        items, tiers = response
+                        fresh_items.extend(items)
+                        store_cached_rows(
+                            stage,
+                            [tier_keys[tier][pos] for pos, tier in zip(send, tiers)],
+                            [value_of(item) for item in items],
+                        )
+                        for pos, item in zip(send, items):
+                            future = owned.pop(keys[pos], None)
+                            if future is not None:
+                                flights.resolve((stage, keys[pos]), future, value_of(item))
+                    send = []
+                    for pos, future in waiting:
+                        # Shielded, so a cancelled waiter can't cancel the flight
+                        # for everyone else waiting on it
+                        value = await asyncio.shield(future)
+                        if value is None:
+                            send.append(pos)
+                        else:
+                            cached[pos] = value
+                            coalesced += 1
+                    waiting = []
+            finally:
+                for key, future in owned.items():
+                    flights.resolve((stage, key), future, None)
+            coalesce_stats[stage] = coalesce_stats.get(stage, 0) + coalesced
+            return fresh_items, coalesced
+
+        # Fill in cache misses whose local classification is confident enough.
+        # Locally classified rows count as hits for the materials step.
+        classifier = self._get_classifier()
+        local_stats = {"rows": 0, "resolved": 0, "seconds": 0.0}
+
+        def classify_locally(rows, cached):
+            if classifier is None:
+                return cached
+            started = time.perf_counter()
+            item_column = column_map.get("item_name")
+            texts = [None] * len(rows)
+            for pos, (row, hit) in enumerate(zip(rows, cached)):
+                if hit is None:
+                    values = parse_csv_row(row)
+                    texts[pos] = (
+                        values[item_column]
+                        if item_column is not None and item_column < len(values)
+                        else row
+                    )
+            # One catalogue search for the whole batch
+            classifier.prepare([text for text in texts if text is not None])
+            classified = []
+            for text, hit in zip(texts, cached):
+                if hit is None:
+                    local, score = classifier.classify(text)
+                    local_stats["rows"] += 1
+                    if local is not None and score >= self.valves.LOCAL_CLASSIFIER_THRESHOLD:
+                        hit = local
+                        local_stats["resolved"] += 1
+                classified.append(hit)
+            local_stats["seconds"] += time.perf_counter() - started
+            return classified
+
+        # Fill in vol/mass cache misses the dimension parser can resolve. Lines
+        # that aren't materials get "Insufficient Data" without a model call.
+        parse_stats = {"rows": 0, "resolved": 0, "seconds": 0.0}
+
+        def parse_locally(items, cached):
+            if not self.valves.DIMENSION_PARSER_ENABLED:
+                return cached
+            started = time.perf_counter()
+            parsed = []
+            for item, hit in zip(items, cached):
+                if hit is None:
+                    parse_stats["rows"] += 1
+                    values = parse_csv_row(item.raw_data)
+
+                    def column(field: str) -> str:
+                        idx = column_map.get(field)
+                        return values[idx] if idx is not None and idx < len(values) else ""
+
+                    sub_material = item.material_classification.sub_material
+                    if sub_material == "not applicable":
+                        hit = VolumeMassData(
+                            total_volume_m3=INSUFFICIENT_DATA,
+                            purchase_weight_kg=INSUFFICIENT_DATA,
+                            weight_per_unit=INSUFFICIENT_DATA,
+                            calculation_method="not applicable",
+                            mass_calculation_method="not applicable",
+                            conversion_steps=[],
+                            confidence=Confidence(
+                                score=0,
+                                reasoning="Line item is not a material",
+                                assumptions=[],
+                            ),
+                        )
+                    else:
+                        hit = parse_volume_mass(
+                            column("item_name") or item.raw_data,
+                            column("unit_quantities"),
+                            column("unit_measure"),
+                            sub_material,
+                        )
+                    if hit is not None:
+                        parse_stats["resolved"] += 1
+                parsed.append(hit)
+            parse_stats["seconds"] += time.perf_counter() - started
+            return parsed
+
+        def merge_cached_rows(row_ids, cached_items, fresh_items):
+            fresh = {item.row_id: item for item in fresh_items}
+            merged = []
+            for row_id, item in zip(row_ids, cached_items):
+                item = item if item is not None else fresh.get(row_id)
+                if item is not None:
+                    merged.append(item)
+            return merged
+
+        # ---------------------------------------------------------------------
+        # The three extraction steps run as a producer/consumer pipeline: each
+        # step has its own pool of workers and hands finished batches to the
+        # next step through a queue. While batch N is in the vol/mass step,
+        # batch N+1 can already be in the materials step, so every model
+        # endpoint stays busy. MAX_CONCURRENT_BATCHES bounds how many batches
+        # are in flight across the whole pipeline.
+        #
+        # A batch is a (start, end) range of data rows. When a step fails for a
+        # batch, the batch is split in half and both halves go back through the
+        # pipeline (rows that already made it through are served from the
+        # cache), so one bad row can't sink the rest of its batch. A single row
+        # that still fails is reported in failed_rows instead of aborting the
+        # document.
+        #
+        # Splitting stops once a step has failed SPLIT_FAILURE_LIMIT calls in a
+        # row without a single success in between: at that point the model (not
+        # the rows) is the problem, and splitting further would only multiply
+        # the number of calls spent on rows that won't come back.
+        # ---------------------------------------------------------------------
+        batch_results = {}  # batch start -> list of extracted items
+        failed_rows = []
+        failure_streaks = {}  # step -> consecutive failed calls
+        repair_stats = {}  # step -> rows kept from partially valid responses
+        materials_queue = asyncio.Queue()
+        vol_mass_queue = asyncio.Queue(maxsize=stage_workers * 2)
+        final_order_queue = asyncio.Queue(maxsize=stage_workers * 2)
+
+        # Batches are packed just ahead of the materials workers, so budget
+        # changes from earlier batches already apply to later ones.
+        row_tokens = [estimate_tokens(row) for row in data_rows]
+        batch_spans = {}  # batch -> span open until the batch finishes or splits
+        batches_wanted = asyncio.Event()
+        batches_wanted.set()
+
+        async def feed_batches():
+            start = 0
+            while start < len(data_rows):
+                await batches_wanted.wait()
+                end, binding = batcher.pack(row_tokens, start)
+                batch_spans[(start, end)] = tracer.start(
+                    "batch",
+                    document_span,
+                    row_start=start,
+                    rows=end - start,
+                    row_tokens=sum(row_tokens[start:end]),
+                    limited_by=binding,
+                )
+                materials_queue.put_nowait((start, end))
+                if materials_queue.qsize() >= stage_workers:
+                    batches_wanted.clear()
+                start = end
+
+        # Finished batches (extracted items or failed rows) are also pushed onto
+        # batch_events as they complete, for streaming output. all_done is set
+        # once every data row is accounted for.
+        batch_events = asyncio.Queue()
+        pending_rows = {"count": len(data_rows)}
+        all_done = asyncio.Event()
+        if not data_rows:
+            all_done.set()
+
+        def finish_batch(batch, result):
+            start, end = batch
+            if result and isinstance(result[0], FailedRow):
+                failed_rows.extend(result)
+            else:
+                if positions is not None:
+                    result = [
+                        item.model_copy(update={"row_id": document_row(item.row_id)})
+                        for item in result
+                    ]
+                batch_results[start] = result
+            batch_span = batch_spans.pop(batch, None)
+            if batch_span is not None:
+                if result and isinstance(result[0], FailedRow):
+                    batch_span.fail(f"{result[0].stage}: {result[0].reason}")
+                    batch_span.set(failed_rows=len(result))
+                batch_span.end()
+            batch_events.put_nowait((start, result))
+            batch_slots.release()
+            pending_rows["count"] -= end - start
+            if pending_rows["count"] <= 0:
+                all_done.set()
+
+        def fail_batch(batch, stage: str, reason: str):
+            start, end = batch
+            if (
+                self.valves.SPLIT_FAILED_BATCHES
+                and end - start > 1
+                and failure_streaks.get(stage, 0) < self.valves.SPLIT_FAILURE_LIMIT
+            ):
+                middle = (start + end) // 2
+                batch_span = batch_spans.pop(batch, None)
+                for half in ((start, middle), (middle, end)):
+                    batch_spans[half] = tracer.start(
+                        "batch",
+                        batch_span or document_span,
+                        row_start=half[0],
+                        rows=half[1] - half[0],
+                        row_tokens=sum(row_tokens[half[0] : half[1]]),
+                        limited_by="split",
+                    )
+                    materials_queue.put_nowait(half)
+                if batch_span is not None:
+                    batch_span.fail(f"{stage}: {reason}").set(split_at=middle)
+                    batch_span.end()
+                batch_slots.release()
+                return
+            finish_batch(
+                batch,
+                [
+                    FailedRow(
+                        row_index=document_row(idx),
+                        raw_data=data_rows[idx],
+                        stage=stage,
+                        reason=reason,
+                    )
+                    for idx in range(start, end)
+                ],
+            )
+
+        # ---------------------------
+        # Step 1: Material Classification Extraction
+        # ---------------------------
+        async def materials_stage():
+            while True:
+                batch = await materials_queue.get()
+                batches_wanted.set()
+                i = batch[0]
+                try:
+                    await batch_slots.acquire()
+                    with tracer.span(
+                        "materials", batch_spans.get(batch), rows=batch[1] - batch[0]
+                    ) as stage_span:
+                        batch_rows = data_rows[batch[0] : batch[1]]
+                        batch_ids = list(range(batch[0], batch[1]))
+                        cached, cache_keys = lookup_cached_rows(
+                            "materials",
+                            "gpt-4o",
+                            MATERIALS_PROMPT,
+                            batch_rows,
+                            MaterialClassification,
+                        )
+                        cache_hits = sum(hit is not None for hit in cached)
+                        cached = classify_locally(batch_rows, cached)
+                        misses = sum(hit is None for hit in cached)
+                        stage_span.set(
+                            cache_hits=cache_hits,
+                            classified_locally=len(batch_rows) - cache_hits - misses,
+                            llm_rows=misses,
+                        )
+                        batcher.observe_share("materials", misses, len(batch_rows))
+
+                        # Create a batch that includes the header row and the rows
+                        # that weren't served from the cache, each prefixed with
+                        # its row id.
+                        async def request_rows(positions):
+                            miss_rows = [(batch_ids[pos], batch_rows[pos]) for pos in positions]
+                            tiers = []
+                            output = await get_routed_response(
+                                MaterialsExtraction,
+                                "materials",
+                                "gpt-4o",
+                                lambda rows: [
+                                    {"role": "system", "content": MATERIALS_PROMPT},
+                                    {
+                                        "role": "user",
+                                        "content": "Here is the table data: \n"
+                                        + "\n".join(
+                                            ["row_id," + header_row]
+                                            + [f"{row_id},{row}" for row_id, row in rows]
+                                        ),
+                                    },
+                                ],
+                                miss_rows,
+                                [row_id for row_id, _ in miss_rows],
+                                [row for _, row in miss_rows],
+                                i,
+                                tiers,
+                            )
+                            return (output.ordered_items, tiers) if output else None
+
+                        fresh_items, coalesced = await extract_coalesced(
+                            "materials",
+                            cache_keys,
+                            cached,
+                            request_rows,
+                            lambda item: item.material_classification,
+                        )
+                        if fresh_items is None:
+                            stage_span.fail(VALIDATION_FAILED)
+                            fail_batch(batch, "materials", VALIDATION_FAILED)
+                            continue
+                        stage_span.set(coalesced_rows=coalesced)
+
+                        materials_output = MaterialsExtraction(
+                            ordered_items=merge_cached_rows(
+                                batch_ids,
+                                [
+                                    OrderedItem(
+                                        row_id=row_id,
+                                        raw_data=row,
+                                        material_classification=hit,
+                                    )
+                                    if hit is not None
+                                    else None
+                                    for row_id, row, hit in zip(batch_ids, batch_rows, cached)
+                                ],
+                                fresh_items,
+                            )
+                        )
+                        if tracer.payloads:
+                            stage_span.set(output=materials_output.model_dump())
+                    await vol_mass_queue.put((batch, materials_output))
+                except Exception as e:
+                    fail_batch(batch, "materials", f"Unexpected error: {e}")
+
+        # ---------------------------
+        # Step 2: Volume/Mass Extraction
+        # ---------------------------
+        async def vol_mass_stage():
+            while True:
+                batch, materials_output = await vol_mass_queue.get()
+                i = batch[0]
+                try:
+                    with tracer.span(
+                        "vol/mass", batch_spans.get(batch), rows=batch[1] - batch[0]
+                    ) as stage_span:
+                        batch_items = materials_output.ordered_items
+                        cached, cache_keys = lookup_cached_rows(
+                            "vol_mass",
+                            "o3-mini",
+                            VOLUME_MASS_PROMPT,
+                            [item.raw_data for item in batch_items],
+                            VolumeMassData,
+                            [item.material_classification for item in batch_items],
+                        )
+                        cache_hits = sum(hit is not None for hit in cached)
+                        cached = parse_locally(batch_items, cached)
+                        misses = sum(hit is None for hit in cached)
+                        batcher.observe_share("vol/mass", misses, len(batch_items))
+                        stage_span.set(
+                            cache_hits=cache_hits,
+                            parsed_locally=len(batch_items) - cache_hits - misses,
+                            llm_rows=misses,
+                        )
+
+                        async def request_rows(positions):
+                            items = [batch_items[pos] for pos in positions]
+                            tiers = []
+                            output = await get_routed_response(
+                                VolumeMassExtraction,
+                                "vol/mass",
+                                "o3-mini",
+                                lambda items: [
+                                    {"role": "system", "content": VOLUME_MASS_PROMPT},
+                                    {
+                                        "role": "user",
+                                        "content": "Here are the column names (associated with the 'raw_data' attribute): \n"
+                                        + header_row
+                                        + "\n\nHere is the data: \n"
+                                        + stage_payload("vol/mass", items, MaterialsExtraction),
+                                    },
+                                ],
+                                items,
+                                [item.row_id for item in items],
+                                [item.raw_data for item in items],
+                                i,
+                                tiers,
+                            )
+                            return (output.ordered_items, tiers) if output else None
+
+                        fresh_items, coalesced = await extract_coalesced(
+                            "vol_mass",
+                            cache_keys,
+                            cached,
+                            request_rows,
+                            lambda item: item.volume_mass_data,
+                        )
+                        if fresh_items is None:
+                            stage_span.fail(VALIDATION_FAILED)
+                            fail_batch(batch, "vol/mass", VALIDATION_FAILED)
+                            continue
+                        stage_span.set(coalesced_rows=coalesced)
+
+                        vol_mass_output = VolumeMassExtraction(
+                            ordered_items=merge_cached_rows(
+                                [item.row_id for item in batch_items],
+                                [
+                                    OrderedItem2(
+                                        row_id=item.row_id,
+                                        raw_data=item.raw_data,
+                                        volume_mass_data=hit,
+                                    )
+                                    if hit is not None
+                                    else None
+                                    for item, hit in zip(batch_items, cached)
+                                ],
+                                fresh_items,
+                            )
+                        )
+                        if tracer.payloads:
+                            stage_span.set(output=vol_mass_output.model_dump())
+                    await final_order_queue.put((batch, materials_output, vol_mass_output))
+                except Exception as e:
+                    fail_batch(batch, "vol/mass", f"Unexpected error: {e}")
+
+        # ---------------------------
+        # Step 3: Combine Extraction Results
+        # Step 4: Final Order Mapping (LLM only for unresolved rows)
+        # ---------------------------
+        async def final_order_stage():
+            while True:
+                batch, materials_output, vol_mass_output = await final_order_queue.get()
+                i = batch[0]
+                try:
+                    with tracer.span(
+                        "final order", batch_spans.get(batch), rows=batch[1] - batch[0]
+                    ) as stage_span:
+                        # Join the two steps' outputs on row id
+                        materials_by_id = {
+                            mat.row_id: mat for mat in materials_output.ordered_items
+                        }
+                        vol_mass_by_id = {
+                            vm.row_id: vm for vm in vol_mass_output.ordered_items
+                        }
+                        missing_ids = [
+                            row_id
+                            for row_id in range(batch[0], batch[1])
+                            if row_id not in materials_by_id or row_id not in vol_mass_by_id
+                        ]
+                        if missing_ids:
+                            reason = f"Rows missing after extraction: {missing_ids}"
+                            stage_span.fail(reason)
+                            fail_batch(batch, "combine", reason)
+                            continue
+                        row_ids = list(range(batch[0], batch[1]))
+                        materials_metadata = {
+                            row_id: materials_by_id[row_id].material_classification.confidence
+                            for row_id in row_ids
+                        }
+                        vol_mass_metadata = {
+                            row_id: VolMassMetadata(
+                                calculation_method=vm.volume_mass_data.calculation_method,
+                                mass_calculation_method=vm.volume_mass_data.mass_calculation_method,
+                                conversion_steps=vm.volume_mass_data.conversion_steps,
+                                confidence=vm.volume_mass_data.confidence,
+                            )
+                            for row_id, vm in vol_mass_by_id.items()
+                        }
+
+                        try:
+                            combined_items = [
+                                CombinedItem(
+                                    row_id=row_id,
+                                    raw_data=materials_by_id[row_id].raw_data,
+                                    volume_mass_data=vol_mass_by_id[row_id].volume_mass_data,
+                                    material_classification=materials_by_id[
+                                        row_id
+                                    ].material_classification,
+                                )
+                                for row_id in row_ids
+                            ]
+                        except (ValidationError, AttributeError, TypeError) as e:
+                            stage_span.fail(f"Error during combination: {e}")
+                            fail_batch(batch, "combine", f"Error during combination: {e}")
+                            continue
+
+                        # Map every row locally, and collect the rows that are
+                        # missing a field only the LLM can fill in.
+                        final_orders = []
+                        fallback_rows = []
+                        for idx, combined_item in enumerate(combined_items):
+                            final_order, unresolved = map_final_order(
+                                combined_item, column_map
+                            )
+                            final_orders.append(final_order)
+                            if fallback_fields.intersection(unresolved):
+                                fallback_rows.append(idx)
+
+                        batcher.observe_share(
+                            "final order", len(fallback_rows), len(combined_items)
+                        )
+                        stage_span.set(
+                            mapped_locally=len(combined_items) - len(fallback_rows),
+                            llm_rows=len(fallback_rows),
+                        )
+                        if fallback_rows:
+                            fallback_items = [combined_items[idx] for idx in fallback_rows]
+                            final_order_output = await get_routed_response(
+                                FinalOrderExtraction,
+                                "final order",
+                                "gpt-4o",
+                                lambda items: [
+                                    {"role": "system", "content": FINAL_ORDER_PROMPT},
+                                    {
+                                        "role": "user",
+                                        "content": "Here are the column names (associated with the 'raw_data' attribute): \n"
+                                        + header_row
+                                        + "\n\nHere is the data: \n"
+                                        + stage_payload("final order", items, ComboExtraction),
+                                    },
+                                ],
+                                fallback_items,
+                                [item.row_id for item in fallback_items],
+                                [item.raw_data for item in fallback_items],
+                                i,
+                            )
+                            if not final_order_output:
+                                stage_span.fail(VALIDATION_FAILED)
+                                fail_batch(batch, "final order", VALIDATION_FAILED)
+                                continue
+
+                            # Locally mapped values take precedence; the model only
+                            # fills in what the mapping could not resolve.
+                            llm_orders = {
+                                order.row_id: order for order in final_order_output.ordered_items
+                            }
+                            for idx in fallback_rows:
+                                llm_order = llm_orders[final_orders[idx].row_id]
+                                merged = final_orders[idx].model_dump()
+                                for field, value in llm_order.model_dump().items():
+                                    if merged[field] == INSUFFICIENT_DATA:
+                                        merged[field] = value
+                                final_orders[idx] = FinalOrder(**merged)
+
+                        extended_orders = [
+                            ExtendedFinalOrder(
+                                **final_order.dict(),
+                                materials_metadata=materials_metadata[final_order.row_id],
+                                vol_mass_metadata=vol_mass_metadata[final_order.row_id],
+                            )
+                            for final_order in final_orders
+                        ]
+                    finish_batch(batch, extended_orders)
+                except Exception as e:
+                    fail_batch(batch, "final order", f"Unexpected error: {e}")
+
+        workers = [
+            asyncio.create_task(stage())
+            for stage in (materials_stage, vol_mass_stage, final_order_stage)
+            for _ in range(stage_workers)
+        ]
+        workers.append(asyncio.create_task(feed_batches()))
+
+        async def run_pipeline():
+            try:
+                await all_done.wait()
+            finally:
+                for worker in workers:
+                    worker.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+
+        pipeline = asyncio.create_task(run_pipeline())
+
+        densities = load_densities(self.valves.DENSITIES_PATH)
+        catalogue = self._get_catalogue()
+        carbon_factors = load_carbon_factors(self.valves.CARBON_FACTORS_PATH)
+
+        # Fill in densities and weights for a list of final orders in one pass.
+        def fill_densities(items):
+            if not self.valves.DENSITY_STAGE_ENABLED:
+                return items
+            with tracer.span("densities", document_span, rows=len(items)):
+                return apply_densities(
+                    items, densities, catalogue, self.valves.CATALOGUE_MATCH_THRESHOLD
+                )
+
+        # Totals the document's embodied carbon and logistics emissions on the
+        # trace. Returns the per-row emissions for persist.
+        def report_emissions(items: list):
+            if not self.valves.CARBON_STAGE_ENABLED or not items:
+                return None
+            with tracer.span("carbon", document_span, rows=len(items)) as span:
+                emissions = compute_emissions(
+                    items,
+                    densities,
+                    carbon_factors,
+                    load_supplier_distances(self.valves.SUPPLIER_DISTANCES_PATH),
+                    self.valves.DEFAULT_DELIVERY_DISTANCE_KM,
+                    self.valves.DEFAULT_REMOVAL_DISTANCE_KM,
+                )
+                totals = emissions[
+                    ["material_carbon", "waste_carbon", "logistics_carbon", "total_embodied_carbon"]
+                ].sum()
+                span.set(
+                    **{f"{name}_kg": round(float(value), 2) for name, value in totals.items()},
+                    rows_without_factor=int(emissions["carbon_factor"].isna().sum()),
+                    rows_without_weight=int(emissions["total_material_weight_kg"].isna().sum()),
+                )
+                if tracer.payloads:
+                    span.set(by_sub_material=summarize_embodied_carbon(emissions).to_dict("records"))
+                return emissions
+
+        # Writes the extracted rows to i_materials when PERSIST_DATABASE_URL is
+        # set. A failed write is recorded on the trace; the extraction is still
+        # returned.
+        async def persist(items: list, emissions: pd.DataFrame = None):
+            if not self.valves.PERSIST_DATABASE_URL or not items:
+                return
+            with tracer.span("persist", document_span, rows=len(items)) as span:
+                if not site_id:
+                    span.fail("no site_id to persist rows against")
+                    return
+                try:
+                    stats = await asyncio.get_running_loop().run_in_executor(
+                        None,
+                        self._persist_orders,
+                        items,
+                        site_id,
+                        arrival_doc_id,
+                        carbon_factors,
+                        emissions,
+                    )
+                except Exception as e:
+                    span.fail(repr(e))
+                    return
+                span.set(**stats)
+
+        # Records the document for duplicate and near-duplicate uploads. The
+        # whole extraction is only stored when no row failed.
+        def remember_document(items: list, output: str = None):
+            # A document without data rows is more likely a failed ingestion
+            # than an empty docket, so it is never recorded
+            if documents is None or not total_rows:
+                return
+            if output is None and not failed_rows:
+                output = ExtendedFinalOrderExtraction(
+                    ordered_items=sorted(items, key=lambda item: item.row_id)
+                ).model_dump_json(indent=4)
+            documents.put(
+                doc_hash,
+                signature,
+                {
+                    document_row_keys[item.row_id]: item.model_dump_json(exclude={"row_id"})
+                    for item in items
+                },
+                None if failed_rows else output,
+            )
+
+        # Summarises the run on the document span and ends it, which flushes
+        # the trace to the exporter.
+        def finish_document(extracted: int):
+            if cache is not None:
+                document_span.set(cache=cache.stats())
+            if classifier is not None:
+                document_span.set(
+                    local_classifier={
+                        "resolved": local_stats["resolved"],
+                        "rows": local_stats["rows"],
+                        "ms": round(local_stats["seconds"] * 1000, 1),
+                    }
+                )
+            if self.valves.DIMENSION_PARSER_ENABLED:
+                document_span.set(
+                    dimension_parser={
+                        "resolved": parse_stats["resolved"],
+                        "rows": parse_stats["rows"],
+                        "ms": round(parse_stats["seconds"] * 1000, 1),
+                    }
+                )
+            if self.valves.MODEL_ROUTING_ENABLED:
+                invalid_prices = []
+                prices = parse_model_prices(self.valves.MODEL_PRICES, invalid_prices)
+                for entry in invalid_prices:
+                    tracer.warn(
+                        "Ignoring invalid MODEL_PRICES entry", valve="MODEL_PRICES", entry=entry
+                    )
+                document_span.set(routing=routing_stats.summary(cheap_model, prices))
+            document_span.set(
+                batch_budgets=batcher.summary(),
+                payload_tokens=payload_stats,
+                rows_recovered=repair_stats,
+                rows_coalesced=coalesce_stats,
+                extracted_rows=extracted,
+                failed_rows=len(failed_rows),
+            )
+            document_span.end()
+
+        # ---------------------------------------------------------------------
+        # Streaming output: one NDJSON line per event, yielded as soon as each
+        # batch is validated. Batches can finish out of order, so every
+        # "ordered_items" event carries the index of its first row.
+        # ---------------------------------------------------------------------
+        async def stream_results():
+            def event(payload: dict) -> str:
+                return json.dumps(payload) + "\n"
+
+            started = time.perf_counter()
+            yield event(
+                {
+                    "event": "started",
+                    "total_rows": total_rows,
+                    "max_batch_rows": batcher.max_rows,
+                }
+            )
+            if reused_items:
+                yield event(
+                    {
+                        "event": "ordered_items",
+                        "row_start": reused_items[0].row_id,
+                        "reused": True,
+                        "ordered_items": [item.model_dump() for item in reused_items],
+                    }
+                )
+            completed = extracted = len(reused_items)
+            extracted_items = list(reused_items)
+            try:
+                while completed < total_rows:
+                    i, batch_result = await batch_events.get()
+                    batch_results.pop(i, None)
+                    completed += len(batch_result)
+                    if batch_result and isinstance(batch_result[0], FailedRow):
+                        yield event(
+                            {
+                                "event": "failed_rows",
+                                "row_start": document_row(i),
+                                "failed_rows": [row.model_dump() for row in batch_result],
+                            }
+                        )
+                    else:
+                        items = fill_densities(batch_result)
+                        extracted += len(items)
+                        extracted_items.extend(items)
+                        yield event(
+                            {
+                                "event": "ordered_items",
+                                "row_start": document_row(i),
+                                "ordered_items": [item.model_dump() for item in items],
+                            }
+                        )
+                    yield event(
+                        {
+                            "event": "progress",
+                            "completed_rows": completed,
+                            "total_rows": total_rows,
+                            "elapsed_seconds": round(time.perf_counter() - started, 3),
+                        }
+                    )
+                await pipeline
+                remember_document(extracted_items)
+                emissions = report_emissions(extracted_items)
+                await persist(extracted_items, emissions)
+                finish_document(extracted)
+                yield event(
+                    {
+                        "event": "done",
+                        "extracted_rows": extracted,
+                        "failed_rows": len(failed_rows),
+                        "elapsed_seconds": round(time.perf_counter() - started, 3),
+                    }
+                )
+            finally:
+                # Stop the workers if the client went away mid-stream.
+                pipeline.cancel()
+                if document_span.end_time is None:
+                    document_span.fail("stream closed before the document finished")
+                    finish_document(extracted)
+
+        if self.valves.STREAM_OUTPUT:
+            return stream_results()
+
+        await pipeline
+
+        # Reassemble the batches in document order.
+        for i in sorted(batch_results):
+            # Append the extracted final order items to the complete list.
+            all_extracted_final_items.extend(batch_results[i])
+
+        all_extracted_final_items = fill_densities(all_extracted_final_items)
+        if reused_items:
+            all_extracted_final_items = sorted(
+                reused_items + all_extracted_final_items, key=lambda item: item.row_id
+            )
 
-        # Combine all final order items into the final extraction JSON.
+        # Combine all final order items into the final extraction JSON,
+        # together with any rows that could not be extracted.
         final_extraction = ExtendedFinalOrderExtraction(
-            ordered_items=all_extracted_final_items
+            ordered_items=all_extracted_final_items,
+            failed_rows=sorted(failed_rows, key=lambda row: row.row_index),
         )
-        print("FINAL FINAL: \n\n" + final_extraction.model_dump_json(indent=4))
-        return final_extraction.model_dump_json(indent=4)
+        output = final_extraction.model_dump_json(indent=4)
+        if tracer.payloads:
+            document_span.set(output=output)
+        remember_document(all_extracted_final_items, output)
+        emissions = report_emissions(all_extracted_final_items)
+        await persist(all_extracted_final_items, emissions)
+        finish_document(len(all_extracted_final_items))
+        return output
@@ -0,0 +1,20 @@
+"""
+The pipe is loaded from its function export the same way the benchmarks load
+it, with Open WebUI, FastAPI and the Gemini SDK stubbed out when missing.
+
+    python -m pytest OpenWebUI/tests
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "benchmarks"))
+
+from common import load_pipe_module  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def wastex():
+    return load_pipe_module()
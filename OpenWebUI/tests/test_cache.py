@@ -0,0 +1,44 @@
+HEADER = "Date,Supplier,Item,Qty,Unit,Total"
+
+
+def classification(wastex, sub_material):
+    return wastex.MaterialClassification(
+        material=wastex.MATERIAL_PAIRS[sub_material],
+        sub_material=sub_material,
+        confidence={"score": 0.9, "reasoning": "", "assumptions": []},
+    )
+
+
+def test_materials_key_uses_only_the_item(wastex):
+    column_map = wastex.map_header_columns(HEADER)
+    a = wastex.cache_row_text("materials", "1/2/24,ITM,GIB 13mm,10,ea,$100", column_map)
+    b = wastex.cache_row_text("materials", "3/4/24,Carters,gib  13MM,2,ea,$20", column_map)
+    assert a == b
+
+
+def test_vol_mass_key_ignores_prices_and_dates(wastex):
+    column_map = wastex.map_header_columns(HEADER)
+    a = wastex.cache_row_text("vol_mass", "1/2/24,ITM,GIB 13mm,10,ea,$100", column_map)
+    b = wastex.cache_row_text("vol_mass", "3/4/24,Carters,GIB 13mm,10,ea,$90", column_map)
+    c = wastex.cache_row_text("vol_mass", "3/4/24,Carters,GIB 13mm,12,ea,$90", column_map)
+    assert a == b != c
+
+
+def test_vol_mass_key_includes_the_classification(wastex):
+    column_map = wastex.map_header_columns(HEADER)
+    row = "1/2/24,ITM,Sheet 2400x1200,10,ea,$100"
+    keys = {
+        wastex.cache_row_text("vol_mass", row, column_map, classification(wastex, sub_material))
+        for sub_material in ("Plasterboard", "Fibre Cement (Cladding)")
+    }
+    assert len(keys) == 2
+
+
+def test_cache_round_trip(wastex, tmp_path):
+    cache = wastex.ExtractionCache(str(tmp_path / "cache.sqlite3"), 3600, 100)
+    key = wastex.ExtractionCache.make_key("vol_mass", "o3-mini", "prompt", HEADER, "row")
+    assert cache.get_many("vol_mass", [key]) == {}
+    cache.put_many("vol_mass", {key: '{"a": 1}'})
+    assert cache.get_many("vol_mass", [key]) == {key: '{"a": 1}'}
+    other_prompt = wastex.ExtractionCache.make_key("vol_mass", "o3-mini", "v2", HEADER, "row")
+    assert cache.get_many("vol_mass", [other_prompt]) == {}
@@ -0,0 +1,51 @@
+import os
+import time
+
+import pandas as pd
+
+
+def write_catalogue(wastex, path, names):
+    pd.DataFrame(
+        [(name, "Plasterboard", 20.0, 10.0) for name in names], columns=wastex.CATALOGUE_COLUMNS
+    ).to_csv(path, index=False)
+
+
+def test_search_and_reload(wastex, tmp_path):
+    source = str(tmp_path / "l_item_details.csv")
+    write_catalogue(wastex, source, ["GIB BD 3000X1200X13MM STANDARD SH", "HEBEL POWERPANEL 50MM"])
+    index_dir = str(tmp_path / "index")
+    built = wastex.CatalogueIndex.load(source, index_dir)
+    assert built.build_seconds is not None
+    indices, scores = built.search(["gib standard 3000x1200x13mm"], 1)
+    assert indices[0, 0] == 0 and scores[0, 0] > 0.5
+
+    loaded = wastex.CatalogueIndex.load(source, index_dir)
+    assert loaded.build_seconds is None
+    assert (loaded.search(["hebel powerpanel 50"], 1)[0] == [[1]]).all()
+    assert not [name for name in os.listdir(index_dir) if ".tmp." in name]
+
+
+def test_earlier_builds_are_kept_for_the_grace_period(wastex, tmp_path):
+    source = str(tmp_path / "l_item_details.csv")
+    index_dir = str(tmp_path / "index")
+    write_catalogue(wastex, source, ["GIB BD 3000X1200X13MM STANDARD SH"])
+    first = wastex.CatalogueIndex.load(source, index_dir)
+    first_files = set(os.listdir(index_dir))
+
+    # A process that still maps the first build can keep searching it
+    write_catalogue(wastex, source, ["GIB BD 3000X1200X13MM STANDARD SH", "HEBEL BLOCK"])
+    wastex.CatalogueIndex.load(source, index_dir)
+    assert first_files < set(os.listdir(index_dir))
+    assert first.search(["gib standard"], 1)[0][0, 0] == 0
+
+    # Once they are older than the grace period, they are removed by the next build
+    stale = time.time() - wastex.CATALOGUE_BUILD_GRACE_SECONDS - 60
+    for name in first_files:
+        os.utime(os.path.join(index_dir, name), (stale, stale))
+    write_catalogue(
+        wastex, source, ["GIB BD 3000X1200X13MM STANDARD SH", "HEBEL BLOCK", "PINK BATTS"]
+    )
+    wastex.CatalogueIndex.load(source, index_dir)
+    remaining = set(os.listdir(index_dir))
+    assert not first_files & remaining
+    assert len(remaining) == 4
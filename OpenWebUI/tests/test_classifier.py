@@ -0,0 +1,49 @@
+import pytest
+
+
+@pytest.fixture(scope="module")
+def classifier(wastex):
+    return wastex.MaterialClassifier()
+
+
+@pytest.mark.parametrize(
+    "text, sub_material",
+    [
+        ("Plasterboard 13mm", "Plasterboard"),
+        ("Treated pine 100x50", "Treated"),
+        ("Carpet tiles", "Carpet Tiles"),
+        # Ambiguous tokens backed by another keyword for the same material
+        ("H4 pine post", "Treated"),
+        ("RAD KD 90x45 4.8m", "Timber"),
+        ("Reinforcing mesh SE62", "Steel"),
+        ("TPS cable flex", "Cable (copper)"),
+        ("45 X 45 Rad Framing No 2 H1.2 Mg Kd Per Mtr", "Treated"),
+    ],
+)
+def test_confident_keywords(wastex, classifier, text, sub_material):
+    classification, score = classifier.classify(text)
+    assert classification.sub_material == sub_material
+    assert score >= wastex.Pipe.Valves().LOCAL_CLASSIFIER_THRESHOLD
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "Flex duct 150mm",
+        "H4 post 125x125",
+        "Fly mesh roll",
+        "D10 bar",
+        "UT 90x45",
+        "Framing inspection",
+        "Framing Design Bracing Design Foundation Design Post Fire and Wingwall Design",
+    ],
+)
+def test_ambiguous_tokens_alone_go_to_the_model(wastex, classifier, text):
+    _, score = classifier.classify(text)
+    assert score < wastex.Pipe.Valves().LOCAL_CLASSIFIER_THRESHOLD
+
+
+def test_conflicting_materials_lower_confidence(classifier):
+    _, plain = classifier.classify("Plasterboard 13mm")
+    _, conflicted = classifier.classify("Plasterboard 13mm steel")
+    assert conflicted < plain
@@ -0,0 +1,41 @@
+import time
+
+
+def row_keys(wastex, rows):
+    return [wastex.document_row_key("Description,Qty", row) for row in rows]
+
+
+def test_identical_upload_returns_stored_output(wastex, tmp_path):
+    index = wastex.DocumentIndex(str(tmp_path / "cache.sqlite3"), 3600)
+    doc_hash = wastex.document_fingerprint("text/csv", "a,1\nb,2", "site-1")
+    keys = row_keys(wastex, ["a,1", "b,2"])
+    index.put(doc_hash, wastex.minhash_signature(keys), {keys[0]: "{}"}, '{"ordered_items": []}')
+    assert index.get_output(doc_hash) == '{"ordered_items": []}'
+    # The same file for another site is a different document
+    assert index.get_output(wastex.document_fingerprint("text/csv", "a,1\nb,2", "site-2")) is None
+
+
+def test_near_duplicate_reuses_shared_rows(wastex, tmp_path):
+    index = wastex.DocumentIndex(str(tmp_path / "cache.sqlite3"), 3600)
+    rows = [f"Item {i},{i}" for i in range(40)]
+    keys = row_keys(wastex, rows)
+    index.put("earlier", wastex.minhash_signature(keys), {key: key[:8] for key in keys}, None)
+
+    edited = row_keys(wastex, rows[:36] + ["New item,1", "Other,2"])
+    found = index.find_similar(wastex.minhash_signature(edited), 0.6)
+    assert found is not None and found[0] == "earlier"
+    items = index.get_items("earlier", edited)
+    assert set(items) == set(keys[:36])
+
+    unrelated = row_keys(wastex, [f"Other {i},{i}" for i in range(40)])
+    assert index.find_similar(wastex.minhash_signature(unrelated), 0.6) is None
+
+
+def test_expired_documents_are_ignored(wastex, tmp_path):
+    index = wastex.DocumentIndex(str(tmp_path / "cache.sqlite3"), 3600)
+    keys = row_keys(wastex, ["a,1"])
+    signature = wastex.minhash_signature(keys)
+    index.put("old", signature, {}, "output")
+    index._conn.execute("UPDATE extracted_documents SET created_at = ?", (time.time() - 7200,))
+    assert index.get_output("old") is None
+    assert index.find_similar(signature, 0.5) is None
@@ -0,0 +1,73 @@
+import pytest
+
+HEADER = "Project,Delivery Date,Supplier,Item,Qty,Unit,Unit Price,Total"
+
+
+def combined_item(wastex, row_id, raw_data, text, quantity, unit, sub_material="Steel"):
+    return wastex.CombinedItem(
+        row_id=row_id,
+        raw_data=raw_data,
+        volume_mass_data=wastex.parse_volume_mass(text, quantity, unit, sub_material),
+        material_classification=wastex.MaterialClassification(
+            material=wastex.MATERIAL_PAIRS[sub_material],
+            sub_material=sub_material,
+            confidence={"score": 0.9, "reasoning": "", "assumptions": []},
+        ),
+    )
+
+
+def test_map_final_order(wastex):
+    raw_data = 'P-1,12/03/2024,ITM,Rebar HD10 6M,"1,200",ea,$4.50,'
+    item = combined_item(wastex, 3, raw_data, "Rebar HD10 6M", "1,200", "ea")
+    order, unresolved = wastex.map_final_order(item, wastex.map_header_columns(HEADER))
+    assert order.row_id == 3
+    assert (order.material, order.sub_material) == ("Metals", "Steel")
+    assert order.delivery_date == "2024-03-12"
+    assert (order.trade_provider, order.item_name) == ("ITM", "Rebar HD10 6M")
+    assert (order.unit_quantities, order.unit_measure) == ("1,200", "ea")
+    assert order.cubic_m3 == pytest.approx(0.565487)
+    # The total is derived from the unit price and the quantity
+    assert order.price_per_unit == 4.5
+    assert order.purchase_cost_total == 5400.0
+    assert "purchase_cost_total" not in unresolved
+    assert "delivery_date" not in unresolved
+
+
+def test_map_final_order_reports_unresolved_fields(wastex):
+    item = combined_item(wastex, 4, "P-1,,ITM,Rebar,10,ea,,", "Rebar HD10 6M", "10", "ea")
+    order, unresolved = wastex.map_final_order(item, wastex.map_header_columns(HEADER))
+    assert order.delivery_date == wastex.INSUFFICIENT_DATA
+    assert {"delivery_date", "price_per_unit", "purchase_cost_total"} <= set(unresolved)
+
+
+def final_order(wastex, **fields):
+    order = {field: wastex.INSUFFICIENT_DATA for field in wastex.FinalOrder.model_fields}
+    order.update(row_id=0, material="Metals", sub_material="Steel")
+    order.update(fields)
+    return wastex.FinalOrder(**order)
+
+
+def test_apply_densities_from_volume(wastex):
+    # "1,200" is twelve hundred units, not one
+    orders = [
+        final_order(wastex, cubic_m3=0.565487, unit_quantities="1,200", excess_percentage=5.0)
+    ]
+    (order,) = wastex.apply_densities(orders, wastex.load_densities())
+    assert order.density == 7850
+    assert order.total_material_weight == pytest.approx(0.565487 * 7850, abs=0.001)
+    assert order.weight_per_unit == pytest.approx(0.565487 * 7850 / 1200, abs=0.001)
+    assert order.waste_weight == pytest.approx(0.565487 * 7850 * 0.05, abs=0.001)
+
+
+def test_apply_densities_from_unit_weight(wastex):
+    orders = [final_order(wastex, weight_per_unit=20.0, unit_quantities="1,200 bags")]
+    (order,) = wastex.apply_densities(orders, wastex.load_densities())
+    assert order.total_material_weight == 24000.0
+    assert order.waste_weight == wastex.INSUFFICIENT_DATA
+
+
+def test_apply_densities_without_data(wastex):
+    orders = [final_order(wastex, sub_material="Unknown")]
+    (order,) = wastex.apply_densities(orders, wastex.load_densities())
+    assert order.density == wastex.INSUFFICIENT_DATA
+    assert order.total_material_weight == wastex.INSUFFICIENT_DATA
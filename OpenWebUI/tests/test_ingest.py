@@ -0,0 +1,38 @@
+def test_clean_csv(wastex):
+    header, rows, report = wastex.ingest_csv(
+        'Item,Qty,Unit\nGIB board,10,ea\n"Timber, treated",5,m\n'
+    )
+    assert header == "Item,Qty,Unit"
+    assert rows == ["GIB board,10,ea", '"Timber, treated",5,m']
+    assert report["clean"]
+
+
+def test_semicolon_delimiter(wastex):
+    header, rows, report = wastex.ingest_csv("Item;Qty;Unit\nGIB board;10;ea\nTimber;5;m\n")
+    assert report["delimiter"] == ";"
+    assert header == "Item,Qty,Unit"
+    assert rows == ["GIB board,10,ea", "Timber,5,m"]
+
+
+def test_code_fence_is_stripped(wastex):
+    header, rows, report = wastex.ingest_csv("```csv\nItem,Qty,Unit\nGIB,1,ea\n```")
+    assert (header, rows) == ("Item,Qty,Unit", ["GIB,1,ea"])
+    assert report["clean"]
+
+
+def test_preamble_and_repeated_header(wastex):
+    header, rows, report = wastex.ingest_csv(
+        "Delivery docket 123,,\nSupplier: ITM,,\nItem,Qty,Unit\nGIB board,10,ea\n"
+        "Timber,5,m\n,,\nItem,Qty,Unit\nNails,2,kg\n"
+    )
+    assert header == "Item,Qty,Unit"
+    assert rows == ["GIB board,10,ea", "Timber,5,m", "Nails,2,kg"]
+    assert report["preamble_rows"] == 2
+    assert report["header_sections"] == 2
+    assert not report["clean"]
+
+
+def test_empty_input(wastex):
+    header, rows, report = wastex.ingest_csv("")
+    assert (header, rows) == ("", [])
+    assert not report["clean"]
@@ -0,0 +1,44 @@
+import pytest
+
+from bench_persistence import seed_lookups
+from common import create_sqlite_schema
+
+
+@pytest.fixture
+def lookups(wastex, tmp_path):
+    url = f"sqlite:///{tmp_path / 'wastex.db'}"
+    connection, q = wastex.connect_database(url)
+    create_sqlite_schema(connection)
+    seed_lookups(connection, q, wastex)
+    yield wastex.LookupTables.load(connection, url)
+    connection.close()
+
+
+def order(wastex, **fields):
+    values = {field: wastex.INSUFFICIENT_DATA for field in wastex.FinalOrder.model_fields}
+    values.update(row_id=0, material="Metals", sub_material="Steel")
+    values.update(fields)
+    return wastex.FinalOrder(**values)
+
+
+@pytest.mark.parametrize(
+    "quantity, stored, unresolved",
+    [("1,200", 1200.0, 0), ("24 lengths", 24.0, 0), ("-5", -5.0, 0), ("Insufficient Data", 0, 1)],
+)
+def test_quantities_are_parsed_like_the_weights(wastex, lookups, quantity, stored, unresolved):
+    rows, counts = wastex.build_material_rows(
+        [order(wastex, unit_quantities=quantity)], lookups, "site"
+    )
+    assert rows[0][wastex.I_MATERIALS_COLUMNS.index("quantity")] == stored
+    assert counts["quantity"] == unresolved
+
+
+def test_unknown_lookups_are_noted(wastex, lookups):
+    rows, counts = wastex.build_material_rows(
+        [order(wastex, unit_quantities="2", trade_provider="Nobody Ltd")], lookups, "site"
+    )
+    row = dict(zip(wastex.I_MATERIALS_COLUMNS, rows[0]))
+    assert row["submaterial_id"] is not None
+    assert row["supplier_id"] is None
+    assert counts["supplier"] == 1
+    assert "supplier 'Nobody Ltd' not found" in row["notes"]
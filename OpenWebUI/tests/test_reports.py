@@ -0,0 +1,162 @@
+import random
+import sqlite3
+
+import pytest
+
+from bench_persistence import seed_lookups
+from bench_reports import REMOVAL_COLUMNS, same, seed_sites, snapshot, synthetic_document
+from common import create_sqlite_schema
+
+
+@pytest.fixture
+def database(wastex, tmp_path):
+    url = f"sqlite:///{tmp_path / 'wastex.db'}"
+    connection, q = wastex.connect_database(url)
+    create_sqlite_schema(connection)
+    rng = random.Random(0)
+    sites, methods = seed_sites(connection, q, seed_lookups(connection, q, wastex), 2, rng)
+    yield connection, q, wastex.LookupTables.load(connection, url), sites, methods
+    connection.close()
+
+
+def load_document(wastex, connection, q, lookups, material_rows, removal_rows):
+    material_columns = [
+        wastex.I_MATERIALS_COLUMNS.index(name) for name in wastex.MATERIAL_AGGREGATE_COLUMNS
+    ]
+    removal_columns = [REMOVAL_COLUMNS.index(name) for name in wastex.REMOVAL_AGGREGATE_COLUMNS]
+    with connection:
+        wastex.insert_material_rows(connection, q, material_rows)
+        connection.cursor().executemany(
+            "INSERT INTO i_resource_removal ({}) VALUES ({})".format(
+                ", ".join(REMOVAL_COLUMNS), ", ".join([q] * len(REMOVAL_COLUMNS))
+            ),
+            removal_rows,
+        )
+        aggregator = wastex.ReportAggregator(lookups)
+        aggregator.add_materials([tuple(row[i] for i in material_columns) for row in material_rows])
+        aggregator.add_removals([tuple(row[i] for i in removal_columns) for row in removal_rows])
+        return aggregator.apply(connection, q)
+
+
+def test_incremental_updates_match_a_rebuild(wastex, database):
+    connection, q, lookups, sites, methods = database
+    rng = random.Random(1)
+    for month in (1, 2, 3):
+        for site_id in sites:
+            for _ in range(2):
+                load_document(
+                    wastex,
+                    connection,
+                    q,
+                    lookups,
+                    *synthetic_document(lookups, site_id, 2024, month, 20, methods, rng),
+                )
+    incremental = snapshot(connection)
+    assert incremental["r_materials"] and incremental["r_diversion_pct_by_month"]
+    wastex.rebuild_reports(connection, q, lookups)
+    assert same(incremental, snapshot(connection))
+
+
+def test_site_totals(wastex, database):
+    connection, q, lookups, sites, methods = database
+    rng = random.Random(2)
+    material_rows, removal_rows = synthetic_document(
+        lookups, sites[0], 2024, 5, 10, methods, rng
+    )
+    stats = load_document(wastex, connection, q, lookups, material_rows, removal_rows)
+    assert stats["sites"] == 1
+    assert stats["months"] == 1
+    attributed = [row for row in material_rows if row[2] is not None]
+    assert stats["unattributed_rows"] == len(material_rows) - len(attributed)
+    cursor = connection.cursor()
+    cursor.execute(
+        f"SELECT SUM(total_weight_kg), SUM(total_cost) FROM r_materials WHERE site_id = {q}",
+        (sites[0],),
+    )
+    weight, cost = cursor.fetchone()
+    assert weight == pytest.approx(sum(row[5] for row in attributed), abs=0.01 * len(attributed))
+    assert cost == pytest.approx(sum(row[8] for row in attributed), abs=0.01 * len(attributed))
+    cursor.execute(f"SELECT COUNT(*) FROM r_materials WHERE site_id = {q}", (sites[1],))
+    assert cursor.fetchone()[0] == 0
+
+
+def test_a_second_document_adds_to_the_totals(wastex, database):
+    connection, q, lookups, sites, methods = database
+    submaterial_id = sorted(lookups.material_of)[0]
+    unit_id = sorted(lookups.units.values())[0]
+
+    def material_row(weight):
+        row = dict.fromkeys(wastex.I_MATERIALS_COLUMNS)
+        row.update(
+            material_entry_id=f"m-{weight}",
+            site_id=sites[0],
+            submaterial_id=submaterial_id,
+            quantity=1,
+            unit_id=unit_id,
+            weight_kg=weight,
+            total_cost=10.0,
+            delivery_date="2024-06-01",
+        )
+        return tuple(row[name] for name in wastex.I_MATERIALS_COLUMNS)
+
+    load_document(wastex, connection, q, lookups, [material_row(100.0)], [])
+    load_document(wastex, connection, q, lookups, [material_row(50.0)], [])
+    cursor = connection.cursor()
+    cursor.execute(
+        f"SELECT total_weight_kg, total_cost FROM r_materials WHERE site_id = {q}", (sites[0],)
+    )
+    assert cursor.fetchall() == [(150.0, 20.0)]
+
+
+def test_logistics_emissions_add_up_per_supplier(wastex, database):
+    connection, q, lookups, sites, methods = database
+    submaterial_id = sorted(lookups.material_of)[0]
+    unit_id = sorted(lookups.units.values())[0]
+    row = dict.fromkeys(wastex.I_MATERIALS_COLUMNS)
+    row.update(
+        material_entry_id="m-1",
+        site_id=sites[0],
+        submaterial_id=submaterial_id,
+        quantity=1,
+        unit_id=unit_id,
+        weight_kg=3000.0,
+        delivery_date="2024-06-01",
+    )
+    material_row = tuple(row[name] for name in wastex.I_MATERIALS_COLUMNS)
+    with connection:
+        wastex.insert_material_rows(connection, q, [material_row])
+
+    def apply(rows):
+        aggregator = wastex.ReportAggregator(lookups)
+        aggregator.add_logistics(rows)
+        with connection:
+            aggregator.apply(connection, q)
+
+    # 1 t over 10 km and 2 t over 40 km: 3 t averaging 30 km
+    apply([(sites[0], submaterial_id, "Acme ", 1000.0, 100.0, 1.35, 0.27)])
+    apply(
+        [
+            (sites[0], submaterial_id, "Acme", 2000.0, float("nan"), 10.8, float("nan")),
+            (sites[0], submaterial_id, float("nan"), 500.0, 0.0, 0.5, 0.0),
+            (sites[0], None, "Acme", 500.0, 0.0, 0.5, 0.0),
+        ]
+    )
+    cursor = connection.cursor()
+    cursor.execute(
+        "SELECT supplier, total_material_weight_kg, delivery_distance_km, "
+        "total_emissions_co2 FROM r_logistics_emissions ORDER BY supplier"
+    )
+    assert cursor.fetchall() == [(None, 500.0, 7, 0.5), ("Acme", 3000.0, 30, 12.42)]
+
+    wastex.rebuild_reports(connection, q, lookups)
+    cursor.execute(
+        f"SELECT logistics_carbon FROM r_embodied_carbon WHERE submaterial_id = {q}",
+        (submaterial_id,),
+    )
+    assert cursor.fetchall() == [(12.92,)]
+
+
+def test_missing_aggregate_table(wastex):
+    connection = sqlite3.connect(":memory:")
+    with pytest.raises(RuntimeError, match="r_aggregate_totals"):
+        wastex.require_report_tables(connection, "?")
@@ -0,0 +1,95 @@
+import json
+
+
+def materials_item(row_id, raw_data, material="Timber", sub_material="Treated"):
+    return {
+        "row_id": row_id,
+        "raw_data": raw_data,
+        "material_classification": {
+            "material": material,
+            "sub_material": sub_material,
+            "confidence": {"score": 0.9, "reasoning": "", "assumptions": []},
+        },
+    }
+
+
+def test_repair_response_valid(wastex):
+    content = json.dumps({"ordered_items": [materials_item(0, "a"), materials_item(1, "b")]})
+    items = wastex.repair_response(wastex.MaterialsExtraction, content)
+    assert [item.row_id for item in items] == [0, 1]
+
+
+def test_repair_response_truncated(wastex):
+    content = json.dumps({"ordered_items": [materials_item(0, "a"), materials_item(1, "b")]})
+    items = wastex.repair_response(wastex.MaterialsExtraction, content[:-40])
+    assert [item.row_id for item in items] == [0]
+
+
+def test_repair_response_keeps_valid_items(wastex):
+    content = json.dumps(
+        {
+            "ordered_items": [
+                materials_item(0, "a"),
+                {"row_id": 1, "raw_data": "b"},
+                materials_item(2, "c", material="Unobtainium", sub_material="x"),
+            ]
+        }
+    )
+    items = wastex.repair_response(wastex.MaterialsExtraction, content)
+    assert items[0].row_id == 0
+    assert items[1:] == [None, None]
+
+
+def test_repair_response_bare_list_in_code_fence(wastex):
+    content = "```json\n" + json.dumps([materials_item(0, "a")]) + "\n```"
+    items = wastex.repair_response(wastex.MaterialsExtraction, content)
+    assert [item.row_id for item in items] == [0]
+
+
+def parsed(wastex, *items):
+    return [wastex.OrderedItem.model_validate(item) for item in items]
+
+
+def test_match_by_row_id(wastex):
+    items = parsed(wastex, materials_item(11, "b"), materials_item(10, "a"))
+    matched = wastex.match_response_items(items, [10, 11], ["a", "b"])
+    assert {pos: item.row_id for pos, item in matched.items()} == {0: 10, 1: 11}
+
+
+def test_match_ignores_unrequested_and_repeated_ids(wastex):
+    items = parsed(
+        wastex, materials_item(10, "a"), materials_item(10, "again"), materials_item(99, "x")
+    )
+    matched = wastex.match_response_items(items, [10, 11], ["a", "b"])
+    assert list(matched) == [0]
+    assert matched[0].raw_data == "a"
+
+
+def test_match_positionally_without_ids(wastex):
+    items = parsed(wastex, materials_item(None, "x"), materials_item(None, "y"))
+    matched = wastex.match_response_items(items, [10, 11], ["a", "b"])
+    assert [item.raw_data for item in matched.values()] == ["x", "y"]
+
+
+def test_match_on_raw_data_when_counts_differ(wastex):
+    items = parsed(wastex, materials_item(None, " b "))
+    matched = wastex.match_response_items(items, [10, 11, 12], ["a", "b", "b"])
+    assert list(matched) == [1]
+
+
+def test_parse_json_leniently(wastex):
+    assert wastex.parse_json_leniently('```json\n{"a": [1, 2,],}\n```') == {"a": [1, 2]}
+    assert wastex.parse_json_leniently('Here you go: {"a": 1} Thanks!') == {"a": 1}
+    assert wastex.parse_json_leniently('{"a": ') is None
+
+
+def test_salvage_json_items_stops_at_the_truncated_item(wastex):
+    text = '{"ordered_items": [{"row_id": 0}, {"row_id": 1} ,{"row_id": 2, "raw'
+    assert wastex.salvage_json_items(text) == [{"row_id": 0}, {"row_id": 1}]
+    assert wastex.salvage_json_items('{"items": []}') == []
+
+
+def test_repair_response_snaps_misspelled_material(wastex):
+    content = json.dumps({"ordered_items": [materials_item(0, "a", material="timbre")]})
+    [item] = wastex.repair_response(wastex.MaterialsExtraction, content)
+    assert item.material_classification.material == "Timber"
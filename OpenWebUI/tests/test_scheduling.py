@@ -0,0 +1,72 @@
+import asyncio
+import time
+
+
+def test_rate_limiter_spaces_calls_per_model(wastex):
+    limiter = wastex.ModelRateLimiter("gpt-4o:1200")  # one call every 50 ms
+
+    async def run():
+        started = time.monotonic()
+        for _ in range(3):
+            await limiter.acquire("gpt-4o")
+        limited = time.monotonic() - started
+        started = time.monotonic()
+        for _ in range(3):
+            await limiter.acquire("o3-mini")
+        return limited, time.monotonic() - started
+
+    limited, unlimited = asyncio.run(run())
+    assert limited >= 0.09
+    assert unlimited < 0.05
+
+
+def test_batcher_packs_to_the_smallest_stage_budget(wastex):
+    batcher = wastex.AdaptiveBatcher("gpt-4o:2000,o3-mini:2000", 50)
+    # final order has the largest per-row overhead (550), so it binds first:
+    # three rows of 50 tokens cost 1800 and a fourth would take it to 2400
+    assert batcher.pack([50] * 10, 0) == (3, "final order")
+    assert batcher.pack([50] * 10, 8) == (10, None)
+    assert wastex.AdaptiveBatcher("", 3).pack([1] * 10, 0) == (3, "max rows")
+    # A row over budget on its own still gets a batch of one
+    assert batcher.pack([5000, 10], 0) == (1, "materials")
+
+
+def test_batcher_budget_follows_routed_model_and_failures(wastex):
+    batcher = wastex.AdaptiveBatcher("gpt-4o:12000,gpt-4o-mini:4000", 50)
+    assert batcher.budget("materials") == 12000
+    batcher.routed_model = "gpt-4o-mini"
+    assert batcher.budget("materials") == 4000
+    for _ in range(20):
+        batcher.observe("materials", 1.0, ok=False)
+    assert batcher.scale["materials"] == wastex.MIN_BUDGET_SCALE
+    batcher.observe("materials", 1.0, ok=True)
+    assert batcher.scale["materials"] > wastex.MIN_BUDGET_SCALE
+    assert batcher.summary()["materials"]["failures"] == 20
+
+
+def test_single_flight_shares_the_owners_result(wastex):
+    flights = wastex.SingleFlight()
+    key = ("materials", "row")
+
+    async def run():
+        owned, owner = flights.claim(key)
+        waiting, second = flights.claim(key)
+        assert owner and not second and waiting is owned
+        flights.resolve(key, owned, "item")
+        assert await waiting == "item"
+        assert key not in flights.pending
+        # The next claim starts a new flight
+        return flights.claim(key)[1]
+
+    assert asyncio.run(run())
+
+
+def test_single_flight_is_per_event_loop(wastex):
+    flights = wastex.SingleFlight()
+
+    async def claim():
+        return flights.claim(("materials", "row"))[1]
+
+    # A flight left pending by an earlier loop can't be awaited from a new one
+    assert asyncio.run(claim())
+    assert asyncio.run(claim())
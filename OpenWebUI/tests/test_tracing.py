@@ -0,0 +1,36 @@
+import pytest
+
+
+class FailingExporter:
+    def export(self, span):
+        raise OSError("disk full")
+
+    def flush(self, trace_id):
+        pass
+
+
+def test_invalid_valve_entries_are_collected(wastex):
+    limiter = wastex.ModelRateLimiter("gpt-4o:60,o3-mini:fast")
+    assert limiter.limits == {"gpt-4o": 60.0}
+    assert limiter.invalid_entries == ["o3-mini:fast"]
+    batcher = wastex.AdaptiveBatcher("gpt-4o:12000,o3-mini:lots", 50)
+    assert batcher.invalid_entries == ["o3-mini:lots"]
+    invalid = []
+    prices = wastex.parse_model_prices("gpt-4o:2.5/10,gpt-4o-mini:0.15", invalid)
+    assert prices == {"gpt-4o": (2.5, 10.0)}
+    assert invalid == ["gpt-4o-mini:0.15"]
+
+
+def test_export_failures_are_warnings_on_the_document_span(wastex):
+    tracer = wastex.Tracer(FailingExporter())
+    tracer.root = tracer.start("document")
+    with tracer.span("batch"):
+        pass
+    [event] = tracer.root.events
+    assert event["name"] == "warning"
+    assert event["span"] == "batch"
+    assert "disk full" in event["message"]
+
+    # Once the document span has ended there is nothing left to record on
+    with pytest.warns(RuntimeWarning, match="disk full"):
+        tracer.root.end()
@@ -0,0 +1,48 @@
+import pytest
+
+
+@pytest.mark.parametrize(
+    "text, quantity, unit, sub_material, volume, weight, weight_per_unit",
+    [
+        # Sheet dimensions: 3.0 x 1.2 x 0.013 m per sheet
+        ("GIB BD 3000X1200X13MM STANDARD SH", "10", "ea", "Plasterboard", 0.468, None, None),
+        # Weight per unit in the item text
+        ("Cement 20kg bag", "5", "ea", "", None, 100.0, 20.0),
+        # Ordered by weight
+        ("Sand", "2.5", "t", "", None, 2500.0, None),
+        # Ordered by volume
+        ("Concrete 20MPa", "3", "m3", "Concrete-based", 3.0, None, None),
+        # Bar diameter and length, with a thousands separator in the quantity
+        ("Rebar HD10 6M", "1,200", "ea", "Steel", 0.565487, None, None),
+    ],
+)
+def test_parse_volume_mass(
+    wastex, text, quantity, unit, sub_material, volume, weight, weight_per_unit
+):
+    result = wastex.parse_volume_mass(text, quantity, unit, sub_material)
+    for value, expected in (
+        (result.total_volume_m3, volume),
+        (result.purchase_weight_kg, weight),
+        (result.weight_per_unit, weight_per_unit),
+    ):
+        if expected is None:
+            assert value == wastex.INSUFFICIENT_DATA
+        else:
+            assert value == pytest.approx(expected)
+    assert result.conversion_steps
+
+
+@pytest.mark.parametrize("quantity", ["", "0", "n/a"])
+def test_parse_volume_mass_needs_a_quantity(wastex, quantity):
+    assert wastex.parse_volume_mass("GIB 2400x1200x10mm", quantity, "ea") is None
+
+
+def test_tongue_and_groove_is_not_a_weight(wastex):
+    # "1200 T&G" once read as 1200 tonnes per sheet
+    result = wastex.parse_volume_mass("Strandfloor H3.1 20mm 3600 x 1200 T&G", "60", "ea", "Timber")
+    assert result is None or result.purchase_weight_kg == wastex.INSUFFICIENT_DATA
+
+
+def test_weight_is_not_read_from_the_dimensions(wastex):
+    result = wastex.parse_volume_mass("Sheet 2400 x 1200 t 10kg", "2", "ea")
+    assert result.weight_per_unit == 10.0
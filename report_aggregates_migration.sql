@@ -0,0 +1,51 @@
+-- Running totals behind the r_* report tables (see ReportAggregator in the
+-- WasteX extraction pipe). Safe to run more than once. After applying it, run
+-- rebuild_reports once to fill r_aggregate_totals from the existing
+-- i_materials and i_resource_removal rows.
+begin;
+
+create table if not exists public.r_aggregate_totals
+(
+    site_id          uuid                  not null
+        references public.i_sites,
+    submaterial_id   uuid                  not null
+        references public.l_submaterials,
+    year_num         integer               not null,
+    month_num        integer               not null,
+    material_id      uuid                  not null
+        references public.l_materials,
+    material_rows    integer     default 0 not null,
+    weight_kg        numeric     default 0 not null,
+    volume_m3        numeric     default 0 not null,
+    total_cost       numeric     default 0 not null,
+    excess_pct_sum   numeric     default 0 not null,
+    excess_pct_rows  integer     default 0 not null,
+    removal_rows     integer     default 0 not null,
+    waste_weight_kg  numeric     default 0 not null,
+    waste_volume_m3  numeric     default 0 not null,
+    waste_value      numeric     default 0 not null,
+    removal_cost     numeric     default 0 not null,
+    landfill_weight  numeric     default 0 not null,
+    cleanfill_weight numeric     default 0 not null,
+    recycle_weight   numeric     default 0 not null,
+    reuse_weight     numeric     default 0 not null,
+    primary key (site_id, submaterial_id, year_num, month_num)
+);
+
+alter table public.r_aggregate_totals
+    owner to postgres;
+
+create index if not exists idx_r_aggregate_totals_month
+    on public.r_aggregate_totals (year_num, month_num);
+
+grant delete, insert, references, select, trigger, truncate, update on public.r_aggregate_totals to anon;
+
+grant delete, insert, references, select, trigger, truncate, update on public.r_aggregate_totals to authenticated;
+
+grant delete, insert, references, select, trigger, truncate, update on public.r_aggregate_totals to service_role;
+
+-- numeric(5, 2) overflowed above 999.99 kg of removals in a month
+alter table public.r_removal_by_month_and_method
+    alter column mass_kg type numeric(12, 2);
+
+commit;
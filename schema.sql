@@ -921,7 +921,7 @@ create table r_removal_by_month_and_method
         constraint check_valid_month
             check ((month_num >= 1) AND (month_num <= 12)),
     disposal_method_id uuid,
-    mass_kg            numeric(5, 2)
+    mass_kg            numeric(12, 2)
 )
     using ???;
 
@@ -948,4 +948,45 @@ grant delete, insert, references, select, trigger, truncate, update on l_stages
 
 grant delete, insert, references, select, trigger, truncate, update on l_stages to authenticated;
 
-grant delete, insert, references, select, trigger, truncate, update on l_stages to service_role;
\ No newline at end of file
+grant delete, insert, references, select, trigger, truncate, update on l_stages to service_role;
+
+create table r_aggregate_totals
+(
+    site_id          uuid                  not null
+        references i_sites,
+    submaterial_id   uuid                  not null
+        references l_submaterials,
+    year_num         integer               not null,
+    month_num        integer               not null,
+    material_id      uuid                  not null
+        references l_materials,
+    material_rows    integer     default 0 not null,
+    weight_kg        numeric     default 0 not null,
+    volume_m3        numeric     default 0 not null,
+    total_cost       numeric     default 0 not null,
+    excess_pct_sum   numeric     default 0 not null,
+    excess_pct_rows  integer     default 0 not null,
+    removal_rows     integer     default 0 not null,
+    waste_weight_kg  numeric     default 0 not null,
+    waste_volume_m3  numeric     default 0 not null,
+    waste_value      numeric     default 0 not null,
+    removal_cost     numeric     default 0 not null,
+    landfill_weight  numeric     default 0 not null,
+    cleanfill_weight numeric     default 0 not null,
+    recycle_weight   numeric     default 0 not null,
+    reuse_weight     numeric     default 0 not null,
+    primary key (site_id, submaterial_id, year_num, month_num)
+)
+    using ???;
+
+alter table r_aggregate_totals
+    owner to postgres;
+
+create index idx_r_aggregate_totals_month
+    on r_aggregate_totals using ??? (year_num, month_num);
+
+grant delete, insert, references, select, trigger, truncate, update on r_aggregate_totals to anon;
+
+grant delete, insert, references, select, trigger, truncate, update on r_aggregate_totals to authenticated;
+
+grant delete, insert, references, select, trigger, truncate, update on r_aggregate_totals to service_role;
\ No newline at end of file